@@ -16,7 +16,6 @@
 #-------------------------
 
 import furnace_backend as be
-import time
 
 
 class AppBE(object):
@@ -24,11 +23,11 @@ class AppBE(object):
     def __init__(self, ctx):
         """
         Tenant's backend constructor
-        :param ctx: Currently unused, passed as an empty dict.
+        :param ctx: Dict of metadata.  ctx['be'] is this backend's API handle, with the same calls as the module
+            (ctx['be'].notify, ...), for tenants that share a process with others (bemain --host).
         """
         be.log('in example constructor')
         be.set_name('example_backend')
-        self.felist = {}
 
         e = {'event_type': be.FE,
              'callback': self.fe_callback}
@@ -38,21 +37,26 @@ class AppBE(object):
              'callback': self.timer_callback}
         be.event_register(e)
 
+        e = {'event_type': be.FE_EVICT, 'idle_timeout': 120.0,  # seconds
+             'callback': self.evict_callback}
+        be.event_register(e)
+
         be.log('leaving example constructor')
 
 
     def fe_callback(self, ctx):
         """
         Called when messages arrive from apps
-        :param ctx: a ctx named tuple collections.namedtuple('ctx', 'ident sync message')
+        :param ctx: a ctx named tuple collections.namedtuple('ctx', 'ident sync message data body')
              ident (string): ID of sending app.
              sync (bool): if True, the app is blocking on a response.
              message (string): Contents of message.
+             data (memoryview): Binary payload of the message, or None.
+             body: The payload decoded with the registered payload codec (JSON by default), decoded on first read.
         :returns: a string reply to send to the app
         """
         be.log('BE CALLBACK')
-        be.log(f'in: {ctx}')
-        self.felist[ctx.ident] = time.time()
+        be.log('in: %s', ctx)
         if ctx.sync == be.SYNC:  # the FE is blocking on our reply
             msg = f'ok: {id(ctx)}'
             be.log('returning: {msg}')
@@ -66,8 +70,18 @@ class AppBE(object):
         :returns: Nothing.
         """
         be.log('BE TIMER')
-        be.log(f'FEs I have seen: {self.felist}')
-        for key, last_seen in self.felist.items():
-            if key[-1] == 'd':
-                be.log(f'notifying {key}')
-                be.notify(key, f'hi {key}')
+        fes = be.fe_list()
+        be.log('FEs I have seen: %s', fes)
+        targets = [rec.ident for rec in fes if rec.ident[-1] == 'd']
+        if targets:
+            be.log('notifying %s', targets)
+            be.notify_many(targets, 'hi')
+
+
+    def evict_callback(self, rec):
+        """
+        Called when the backend evicts an app that went silent
+        :param rec: the app's FERecord (ident first_seen last_seen msgs_in bytes_in msgs_out bytes_out drops codec state)
+        :returns: Nothing.
+        """
+        be.log('app %s went away after %d msgs', rec.ident, rec.msgs_in)
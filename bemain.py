@@ -21,17 +21,48 @@ Command line interface to start a tenant backend.
 """
 
 # stdlib
+import time
+STARTUP_T0 = time.monotonic()  # before the imports, for the startup breakdown
 import sys
 import argparse
+import json
 import os
 
 # furnace
 import furnace_backend as be
+import furnace_backend_async as be_async
+import furnace_forkserver
+import furnace_host
+import furnace_profile
+import furnace_replay
+import furnace_shard
 
-def main():
+def load_tenant(bei, target_component, target_module):
+    """
+    Loads the tenant's backend into a constructed BE.  The tenant's constructor gets ctx['be'], its own API handle,
+    for tenants sharing a process with others.
+    """
+    bei.load_tenant(target_component, target_module)
+
+
+def start_tenant(bei, target_component, target_module):
+    """
+    Loads the tenant's backend into a constructed BE, then runs its event loop.
+    """
+    load_tenant(bei, target_component, target_module)
+    bei.loop()
+
+
+def main(argv=None, startup=None):
     """
     Parses command line input, sets up env, then runs the tenant's desired backend.
+    :param argv: Command line without the program name, sys.argv[1:] by default.
+    :param startup: StartupTimer already running, e.g. in a fork server child.  By default the clock starts before
+        this module's imports.
     """
+    if startup is None:
+        startup = furnace_profile.StartupTimer(STARTUP_T0)
+        startup.mark('imports')
 
     parser = argparse.ArgumentParser()
     parser.add_argument('-c', dest='component', default='app_be', metavar='component',
@@ -40,40 +71,172 @@ def main():
                         help='Python MODULE inside that file (default: AppBE)')
     parser.add_argument('-d', dest='debug', default=False, action='store_true',
                         help='Enable debugging to console')
-    parser.add_argument('--ep', dest='be_ip', required=True, metavar='be_ip',
-                        help='IP of backend')
-    parser.add_argument('--et', dest='be_base_port', required=True, type=int, metavar='be_base_port',
-                        help='Base port of backend to connect to (RTR, PUB, ->DLR<-, SUB)')
-    parser.add_argument('--ak', dest='ak', required=True, metavar='appkey',
-                        help='The Curve public key used by any connecting VMI apps')
-    parser.add_argument('--bk', dest='bk', required=True, metavar='bekey',
-                        help='The Curve public and private keys for this backend')
-    args = parser.parse_args()
+    parser.add_argument('--asyncio', dest='use_asyncio', default=False, action='store_true',
+                        help='Run the asyncio event loop, allowing async def callbacks')
+    parser.add_argument('--shards', dest='shards', default=1, type=int, metavar='shards',
+                        help='Run N tenant worker processes behind a front process, routing each app to one worker (default: 1)')
+    parser.add_argument('--log-file', dest='log_file', default=None, metavar='log_file',
+                        help='Also log INFO and above to this rotating log file')
+    parser.add_argument('--metrics-port', dest='metrics_port', default=None, type=int, metavar='metrics_port',
+                        help='Serve Prometheus metrics on http://127.0.0.1:PORT/ (shard workers use PORT+1..PORT+N)')
+    parser.add_argument('--kv-store', dest='kv_path', default=None, metavar='kv_path',
+                        help='Persist the Get/Set KV facility to this SQLite file (shard workers use PATH.0..PATH.N-1)')
+    parser.add_argument('--kv-cache-mb', dest='kv_cache_mb', default=be.KV_CACHE_BYTES >> 20, type=int, metavar='kv_cache_mb',
+                        help=f'KV facility in-memory cache budget in MiB (default: {be.KV_CACHE_BYTES >> 20})')
+    parser.add_argument('--sndhwm', dest='sndhwm', default=be.BE_SNDHWM, type=int, metavar='sndhwm',
+                        help=f'Send high-water mark of the FE-facing sockets, in messages (default: {be.BE_SNDHWM})')
+    parser.add_argument('--rcvhwm', dest='rcvhwm', default=be.BE_RCVHWM, type=int, metavar='rcvhwm',
+                        help=f'Receive high-water mark of the FE-facing sockets, in messages (default: {be.BE_RCVHWM})')
+    parser.add_argument('--fe-queue', dest='fe_queue_max', default=be.FE_QUEUE_MAX, type=int, metavar='fe_queue',
+                        help=f'Outbound messages queued per app while the dealer socket is full (default: {be.FE_QUEUE_MAX})')
+    parser.add_argument('--send-policy', dest='send_policy', default='drop', choices=('drop', 'block'),
+                        help='When an app\'s outbound queue is full: drop and count the message, or block up to '
+                             f'{be.SEND_TIMEOUT}ms for room (default: drop)')
+    parser.add_argument('--compress-min', dest='compress_min', default=be.COMPRESS_MIN_BYTES, type=int,
+                        metavar='bytes', help='Smallest binary payload compressed for apps that negotiated a codec '
+                                              f'(default: {be.COMPRESS_MIN_BYTES})')
+    parser.add_argument('--hot-reload', dest='hot_reload', default=False, action='store_true',
+                        help='SIGHUP re-imports the tenant and rebuilds its app, keeping app connections, queues and '
+                             'the KV store')
+    parser.add_argument('--fork-server', dest='fork_server', default=None, metavar='socket',
+                        help='Run a fork server on this Unix socket instead of a backend.  It preloads the backend '
+                             'modules and the --ak/--bk keys, and keeps --warm children ready for --spawn requests')
+    parser.add_argument('--warm', dest='warm', default=be.FORK_WARM, type=int, metavar='warm',
+                        help=f'Idle children a fork server keeps ready (default: {be.FORK_WARM})')
+    parser.add_argument('--spawn', dest='spawn', default=None, metavar='socket',
+                        help='Start this backend in the fork server listening on this Unix socket, print its pid '
+                             'and exit')
+    parser.add_argument('--host', dest='host_config', default=None, metavar='host_config',
+                        help='Run every tenant listed in this JSON file in one process, sharing a ZMQ context, CURVE '
+                             'authenticator and event loop.  Replaces -c, -m, --ipc, --ep, --et, --ak, --bk, '
+                             '--kv-store, --metrics-port and --capture, which are set per tenant in the file')
+    parser.add_argument('--capture', dest='capture_path', default=None, metavar='capture_path',
+                        help='Record every packet apps send to this capture file, for --replay (shard workers use '
+                             'PATH.0..PATH.N-1)')
+    parser.add_argument('--capture-max-mb', dest='capture_max_mb', default=be.CAPTURE_MAX_BYTES >> 20, type=int,
+                        metavar='capture_max_mb',
+                        help=f'Stop capturing once the file reaches this size in MiB (default: {be.CAPTURE_MAX_BYTES >> 20})')
+    parser.add_argument('--replay', dest='replay_path', default=None, metavar='replay_path',
+                        help='Replay this capture into the tenant without sockets, print the results as JSON and exit')
+    parser.add_argument('--replay-speed', dest='replay_speed', default=1.0, type=float, metavar='speed',
+                        help='Replay rate relative to the capture, e.g. 10 for ten times faster; 0 replays as fast as '
+                             'the tenant goes (default: 1)')
+    parser.add_argument('--replay-start', dest='replay_start', default=None, type=float, metavar='time',
+                        help='Skip the packets captured before this Unix time')
+    parser.add_argument('--replay-limit', dest='replay_limit', default=None, type=int, metavar='packets',
+                        help='Replay at most this many packets')
+    parser.add_argument('--ipc', dest='ipc_dir', default=None, metavar='ipc_dir',
+                        help='Bind ipc://IPC_DIR/be-dealer and ipc://IPC_DIR/be-pub without CURVE, for a proxy on this '
+                             'host, instead of TCP.  The directory\'s permissions are the only access control')
+    parser.add_argument('--phase-timing', dest='phase_timing', default=False, action='store_true',
+                        help='Time each phase of the event loop (poll, recv, parse, callback, serialize, send, timers)')
+    parser.add_argument('--profile-dir', dest='profile_dir', default=None, metavar='profile_dir',
+                        help='Enable on-demand profiling into this directory: SIGUSR1 profiles the event loop for '
+                             '--profile-seconds, SIGUSR2 logs and resets the loop phase timings')
+    parser.add_argument('--profile-seconds', dest='profile_seconds', default=be.PROFILE_SECONDS, type=float,
+                        metavar='seconds', help=f'Length of a profiling window (default: {be.PROFILE_SECONDS})')
+    parser.add_argument('--profile-format', dest='profile_format', default='pstats', choices=('pstats', 'collapsed'),
+                        help='cProfile output for pstats, or sampled stacks for flame graphs (default: pstats)')
+    parser.add_argument('--ep', dest='be_ip', default=None, metavar='be_ip',
+                        help='IP of backend (required without --ipc)')
+    parser.add_argument('--et', dest='be_base_port', default=None, type=int, metavar='be_base_port',
+                        help='Base port of backend to connect to (RTR, PUB, ->DLR<-, SUB) (required without --ipc)')
+    parser.add_argument('--ak', dest='ak', default=None, metavar='appkey',
+                        help='The Curve public key used by any connecting VMI apps (required without --ipc)')
+    parser.add_argument('--bk', dest='bk', default=None, metavar='bekey',
+                        help='The Curve public and private keys for this backend (required without --ipc)')
+    args = parser.parse_args(argv)
+
+    if args.fork_server is not None:
+        server = furnace_forkserver.ForkServer(args.fork_server, main, warm=args.warm)
+        server.preload([args.ak, args.bk])
+        server.serve()
+        return
+    if args.spawn is not None:
+        argv = sys.argv[1:] if argv is None else argv
+        i = argv.index('--spawn') if '--spawn' in argv else None
+        child_argv = argv[:i] + argv[i + 2:] if i is not None else [a for a in argv if not a.startswith('--spawn=')]
+        print(furnace_forkserver.spawn(args.spawn, child_argv))
+        return
+
+    if args.host_config is not None and (args.use_asyncio or args.shards > 1):
+        parser.error('--host cannot be combined with --asyncio or --shards')
+    if args.replay_path is not None and (args.use_asyncio or args.shards > 1 or args.host_config is not None):
+        parser.error('--replay cannot be combined with --asyncio, --shards or --host')
+    if args.replay_path is None and args.host_config is None and args.ipc_dir is None \
+            and None in (args.be_ip, args.be_base_port, args.ak, args.bk):
+        parser.error('--ep, --et, --ak and --bk are required unless --ipc, --host or --replay is given')
     print(f'{"#"*10}\nmain, starting Backend with args: {args}\n{"#"*10}')
 
-    if not os.path.isfile(args.ak) \
-        or not os.path.isfile(args.bk):
-        print(f'ERROR: either {args.ak} or {args.bk} is missing!')
-        sys.exit()
-    kp = {'be_key': args.bk,
-          'app_key': args.ak}
-    print(f'startup: keys OK')
+    if args.replay_path is not None:
+        kp = None
+    elif args.host_config is not None:
+        kp = None
+        tenants = furnace_host.read_config(args.host_config)
+        print(f'startup: hosting {len(tenants)} tenants from {args.host_config}')
+    elif args.ipc_dir is not None:
+        kp = None
+        print(f'startup: IPC transport in {args.ipc_dir}, CURVE disabled')
+    else:
+        if not os.path.isfile(args.ak) \
+            or not os.path.isfile(args.bk):
+            print(f'ERROR: either {args.ak} or {args.bk} is missing!')
+            sys.exit()
+        kp = {'be_key': args.bk,
+              'app_key': args.ak}
+        print(f'startup: keys OK')
 
     target_component = args.component
     target_module = args.module
 
-    bei = be.BE(kp, debug=args.debug, be_ip=args.be_ip, be_base_port=args.be_base_port)
-    bei.module_register()
-
-    # unused for now, but could be used to pass metadata into the tenant's backend constructor.
-    ctx = {}
+    be_kwargs = {'debug': args.debug,
+                 'ipc_dir': args.ipc_dir,
+                 'sndhwm': args.sndhwm,
+                 'rcvhwm': args.rcvhwm,
+                 'send_policy': be.SEND_BLOCK if args.send_policy == 'block' else be.SEND_DROP,
+                 'fe_queue_max': args.fe_queue_max,
+                 'compress_min': args.compress_min,
+                 'phase_timing': args.phase_timing,
+                 'profile_dir': args.profile_dir,
+                 'profile_seconds': args.profile_seconds,
+                 'profile_format': be.PROFILE_COLLAPSED if args.profile_format == 'collapsed' else be.PROFILE_PSTATS,
+                 'hot_reload': args.hot_reload}
+    if args.replay_path is not None:
+        del be_kwargs['ipc_dir']
+        result = furnace_replay.run_replay(lambda bei: load_tenant(bei, target_component, target_module),
+                                           args.replay_path, speed=args.replay_speed, start_time=args.replay_start,
+                                           limit=args.replay_limit, metrics_port=args.metrics_port,
+                                           kv_path=args.kv_path, kv_cache_bytes=args.kv_cache_mb << 20,
+                                           log_file=args.log_file, startup=startup, **be_kwargs)
+        print(json.dumps(result, indent=2))
+        return
+    if args.host_config is not None:
+        del be_kwargs['ipc_dir']
+        furnace_host.run_host(lambda bei, tenant: load_tenant(bei, tenant['component'], tenant['module']),
+                              tenants, log_file=args.log_file, kv_cache_bytes=args.kv_cache_mb << 20,
+                              capture_max_bytes=args.capture_max_mb << 20, **be_kwargs)
+        return
+    if args.ipc_dir is None:
+        be_kwargs.update(be_ip=args.be_ip, be_base_port=args.be_base_port)
 
-    comp = __import__(target_component, fromlist=[target_module])
-    appClass = getattr(comp, target_module)
-    app = appClass(ctx)
+    if args.shards > 1:
+        furnace_shard.run_sharded(lambda bei: start_tenant(bei, target_component, target_module),
+                                  args.shards, kp, use_asyncio=args.use_asyncio,
+                                  metrics_port=args.metrics_port, log_file=args.log_file,
+                                  kv_path=args.kv_path, kv_cache_bytes=args.kv_cache_mb << 20,
+                                  capture_path=args.capture_path, capture_max_bytes=args.capture_max_mb << 20,
+                                  **be_kwargs)
+        return
 
-    bei.post_app_init(app=app)
-    bei.loop()
+    be_class = be_async.AsyncBE if args.use_asyncio else be.BE
+    bei = be_class(kp, log_file=args.log_file, startup=startup, **be_kwargs)
+    if args.metrics_port is not None:
+        bei.start_metrics(args.metrics_port)
+    if args.kv_path is not None:
+        bei.start_kv(args.kv_path, max_bytes=args.kv_cache_mb << 20)
+    if args.capture_path is not None:
+        bei.start_capture(args.capture_path, max_bytes=args.capture_max_mb << 20)
+    start_tenant(bei, target_component, target_module)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,449 @@
+#-------------------------
+# Furnace (c) 2017-2018 Micah Bushouse
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#-------------------------
+"""
+Backend benchmark.  Runs a BE on localhost with throwaway CURVE keys and drives it with simulated frontends.
+
+    python bench/furnace_bench.py sync --fes 4 --size 256 --duration 5
+    python bench/furnace_bench.py async --fes 8 --size 1024 --asyncio
+    python bench/furnace_bench.py broadcast --fes 4 --count 20000
+    python bench/furnace_bench.py bulk --fes 2 --size 65536 --bulk-mb 256 --compare last.json
+
+Scenarios:
+    sync       each FE runs SYNC round trips back to back; latency is the round trip
+    async      each FE floods ASYNC messages; latency is send to tenant callback
+    broadcast  the tenant broadcasts count messages; latency is broadcast to SUB receipt, lost counts PUB drops
+    bulk       each FE sends bulk-mb through a stream, within its credit; latency is chunk sent to credit covering it
+
+As in production, the FEs reach the backend through a ROUTER/DEALER proxy, the proxy's link to the backend uses
+CURVE (or plain ipc:// with --ipc), and FEs subscribe to the backend's PUB socket directly.  Every process runs on this host, so latencies
+share one monotonic clock.  Prints one JSON object with throughput and latency percentiles in microseconds.
+Needs facilities_pb2.py generated from facilities.proto, like the backend itself.
+"""
+
+import argparse
+import collections
+import json
+import multiprocessing as mp
+import os
+import struct
+import sys
+import tempfile
+import time
+
+# 3p
+import zmq
+import zmq.auth
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# internal
+import furnace_backend as be
+import furnace_backend_async as be_async
+from furnace_metrics import Histogram, latency
+import facilities_pb2
+
+SCENARIOS = ('sync', 'async', 'broadcast', 'bulk')
+TS = struct.Struct('<Q')  # perf_counter_ns() send time, leading every timed payload
+
+
+class NullSink(object):
+    """
+    Stream sink that only counts bytes.
+    """
+
+    def __init__(self):
+        self.nbytes = 0
+
+    def write(self, offset, data):
+        self.nbytes += len(data)
+
+    def close(self, complete):
+        pass
+
+
+class BenchTenant(object):
+    """
+    Tenant loaded into the benchmarked BE.  Messages are told apart by their value field.
+    """
+
+    def __init__(self, batch, window):
+        self.hist = Histogram()
+        self.msgs = 0
+        self.stream_bytes = 0
+        if batch:
+            be.event_register({'event_type': be.FE_BATCH, 'callback': self.fe_batch})
+        else:
+            be.event_register({'event_type': be.FE, 'callback': self.fe})
+        be.event_register({'event_type': be.STREAM, 'callback': self.stream, 'window': window})
+
+    def fe(self, ctx):
+        msg = ctx.message
+        if msg == 'a':  # one ASYNC flood message
+            self.hist.record(time.perf_counter_ns() - TS.unpack_from(ctx.data)[0])
+            self.msgs += 1
+        elif msg == 'rt':  # SYNC echo
+            return ctx.data.tobytes() if ctx.data is not None else 'ok'
+        elif msg.startswith('bcast'):
+            _, count, size = msg.split()
+            filler = bytes(max(0, int(size) - TS.size))
+            for _ in range(int(count)):
+                be.broadcast_bytes(TS.pack(time.perf_counter_ns()) + filler)
+            return 'ok'
+        elif msg == 'report':
+            report = {'msgs': self.msgs, 'stream_bytes': self.stream_bytes,
+                      'hist': self.hist.counts, 'hist_total': self.hist.total}
+            self.hist = Histogram()
+            self.msgs = 0
+            self.stream_bytes = 0
+            return json.dumps(report)
+        elif ctx.sync == be.SYNC:  # barrier
+            return 'ok'
+
+    def fe_batch(self, ctxs):
+        return [self.fe(ctx) or 'ok' for ctx in ctxs]
+
+    def stream(self, sctx):
+        tenant = self
+
+        class CountingSink(NullSink):
+            def close(self, complete):
+                tenant.stream_bytes += self.nbytes
+
+        return CountingSink()
+
+    def shutdown(self):
+        pass
+
+
+def make_keys(directory):
+    """
+    :returns: Tuple of (kp for BE, backend public key file, app secret key file).
+    """
+    be_public, be_secret = zmq.auth.create_certificates(directory, 'be')
+    app_public, app_secret = zmq.auth.create_certificates(directory, 'app')
+    return {'be_key': be_secret, 'app_key': app_secret}, be_public, app_secret
+
+
+def curve_client(sock, curve):
+    """
+    Makes sock a CURVE client of the backend.
+    :param curve: Tuple of (backend public key file, app secret key file), or None for the IPC transport.
+    """
+    if curve is None:
+        return
+    pub, sec = zmq.auth.load_certificate(curve[1])
+    srv, _ = zmq.auth.load_certificate(curve[0])
+    sock.curve_publickey, sock.curve_secretkey, sock.curve_serverkey = pub, sec, srv
+
+
+def run_backend(kp, port, ipc_dir, args, ready):
+    """
+    Backend process.
+    """
+    sys.stdout = sys.stderr  # keep stdout for the JSON result
+    be_class = be_async.AsyncBE if args.use_asyncio else be.BE
+    bei = be_class(kp, be_base_port=port, ipc_dir=ipc_dir)
+    bei.module_register()
+    bei.post_app_init(app=BenchTenant(args.batch, args.window))
+    ready.set()
+    bei.loop()
+
+
+def run_proxy(port, dealer_ep, curve, ready):
+    """
+    Proxy process: FEs connect to a ROUTER, whose routing IDs become the idents the backend sees.
+    """
+    ctx = zmq.Context()
+    front = ctx.socket(zmq.ROUTER)
+    front.bind(f'tcp://127.0.0.1:{port + 2}')
+    back = ctx.socket(zmq.DEALER)
+    curve_client(back, curve)
+    back.connect(dealer_ep)
+    ready.set()
+    zmq.proxy(front, back)
+
+
+class FE(object):
+    """
+    One simulated frontend.
+    """
+
+    def __init__(self, i, port, pub_ep, curve):
+        self.ident = f'fe{i}'
+        self.ctx = zmq.Context()
+        self.sock = self.ctx.socket(zmq.DEALER)
+        self.sock.setsockopt(zmq.ROUTING_ID, self.ident.encode())
+        self.sock.connect(f'tcp://127.0.0.1:{port + 2}')
+        self.sub = None
+        self.pub_ep = pub_ep
+        self.curve = curve
+
+    def subscribe(self):
+        self.sub = self.ctx.socket(zmq.SUB)
+        curve_client(self.sub, self.curve)
+        self.sub.setsockopt(zmq.SUBSCRIBE, b'')
+        self.sub.connect(self.pub_ep)
+
+    def send(self, sync, value, data=None, **fields):
+        msg = facilities_pb2.FacMessage()
+        msg.type.append(msg.BE_MSG)
+        sub = msg.be_msg.add(status=0, value=value)
+        if data is not None:
+            sub.data = data
+        for k, v in fields.items():
+            setattr(sub, k, v)
+        raw = msg.SerializeToString()
+        self.sock.send_multipart([b'', raw] if sync else [raw])
+
+    def recv(self):
+        msg = facilities_pb2.FacMessage()
+        msg.ParseFromString(self.sock.recv_multipart()[-1])
+        return msg
+
+    def call(self, value, data=None):
+        self.send(True, value, data)
+        return self.recv()
+
+
+def fe_sync(fe, args, hist):
+    payload = bytes(args.size)
+    ops = 0
+    end = time.perf_counter() + args.duration
+    while time.perf_counter() < end:
+        t0 = time.perf_counter_ns()
+        fe.call('rt', payload)
+        hist.record(time.perf_counter_ns() - t0)
+        ops += 1
+    return ops, ops * args.size * 2
+
+
+def fe_async(fe, args, hist):
+    filler = bytes(max(0, args.size - TS.size))
+    ops = 0
+    end = time.perf_counter() + args.duration
+    while time.perf_counter() < end:
+        for _ in range(100):
+            fe.send(False, 'a', TS.pack(time.perf_counter_ns()) + filler)
+        ops += 100
+    fe.call('barrier')  # every flood message from this FE has been handled
+    return ops, ops * args.size
+
+
+def fe_broadcast(fe, args, hist):
+    ops = 0
+    fe.sub.setsockopt(zmq.RCVTIMEO, 1000)
+    try:
+        while ops < args.count:
+            data = facilities_pb2.FacMessage()
+            data.ParseFromString(fe.sub.recv())
+            hist.record(time.perf_counter_ns() - TS.unpack_from(data.be_msg[0].data)[0])
+            ops += 1
+    except zmq.Again:
+        pass  # the rest were dropped
+    return ops, ops * args.size
+
+
+def fe_bulk(fe, args, hist):
+    total = args.bulk_mb << 20
+    chunk = bytes(args.size)
+    fe.send(False, 'bulk', op=be.STREAM_OPEN, stream=1, offset=total)
+    sent = 0
+    limit = 0
+    inflight = collections.deque()  # (end offset, send time)
+    while True:
+        if sent < total and sent < limit:
+            n = min(args.size, total - sent, limit - sent)
+            fe.send(False, '', chunk[:n], op=be.STREAM_DATA, stream=1, offset=sent)
+            sent += n
+            inflight.append((sent, time.perf_counter_ns()))
+            if sent == total:
+                fe.send(False, '', op=be.STREAM_CLOSE, stream=1, offset=total)
+            if not fe.sock.poll(0):
+                continue
+        ctl = fe.recv().be_msg[0]
+        if ctl.op == be.STREAM_ABORT:
+            raise Exception(f'stream aborted: {ctl.value}')
+        acked = ctl.offset
+        t_sent = None
+        while inflight and inflight[0][0] <= acked:
+            t_sent = inflight.popleft()[1]
+        if t_sent is not None:
+            hist.record(time.perf_counter_ns() - t_sent)
+        limit = acked + ctl.credit
+        if ctl.credit == 0 and acked >= total:
+            return 1, total
+
+
+FE_SCENARIOS = {'sync': fe_sync, 'async': fe_async, 'broadcast': fe_broadcast, 'bulk': fe_bulk}
+
+
+def run_fe(i, port, pub_ep, curve, args, start, results):
+    """
+    Frontend process.  Puts (ops, bytes, histogram counts, histogram total, seconds) on results.
+    """
+    fe = FE(i, port, pub_ep, curve)
+    if args.scenario == 'broadcast':
+        fe.subscribe()
+    fe.call('barrier')  # connected end to end
+    start.wait()
+    hist = Histogram()
+    t0 = time.perf_counter()
+    ops, nbytes = FE_SCENARIOS[args.scenario](fe, args, hist)
+    results.put((ops, nbytes, hist.counts, hist.total, time.perf_counter() - t0))
+
+
+def merge(counts_list, totals):
+    """
+    :returns: One Histogram summing several Histogram.counts lists.
+    """
+    hist = Histogram()
+    for counts in counts_list:
+        hist.counts = [a + b for a, b in zip(hist.counts, counts)]
+    hist.count = sum(hist.counts)
+    hist.total = sum(totals)
+    return hist
+
+
+def run(args):
+    """
+    Runs one scenario.
+    :returns: The result dict.
+    """
+    port = args.port
+    procs = []
+    with tempfile.TemporaryDirectory(prefix='furnace_bench') as keydir:
+        kp, be_public, app_secret = make_keys(keydir)
+        if args.ipc:  # endpoint names as in BE.endpoints
+            ipc_dir = keydir
+            dealer_ep, pub_ep = f'ipc://{keydir}/be-dealer', f'ipc://{keydir}/be-pub'
+            curve = None
+        else:
+            ipc_dir = None
+            dealer_ep, pub_ep = f'tcp://127.0.0.1:{port}', f'tcp://127.0.0.1:{port + 1}'
+            curve = (be_public, app_secret)
+        be_ready = mp.Event()
+        proxy_ready = mp.Event()
+        procs.append(mp.Process(target=run_backend, args=(kp, port, ipc_dir, args, be_ready), daemon=True))
+        procs.append(mp.Process(target=run_proxy, args=(port, dealer_ep, curve, proxy_ready), daemon=True))
+        for p in procs:
+            p.start()
+        be_ready.wait(10)
+        proxy_ready.wait(10)
+
+        start = mp.Event()
+        results = mp.Queue()
+        fes = [mp.Process(target=run_fe, args=(i, port, pub_ep, curve, args, start, results), daemon=True)
+               for i in range(args.fes)]
+        for p in fes:
+            p.start()
+        procs += fes
+
+        driver = FE('driver', port, pub_ep, curve)
+        driver.call('barrier')
+        time.sleep(0.5)  # FE barriers done and, for broadcast, SUB connections joined
+        start.set()
+        t0 = time.perf_counter()
+        if args.scenario == 'broadcast':
+            driver.call(f'bcast {args.count} {args.size}')
+        fe_results = [results.get() for _ in fes]
+        elapsed = time.perf_counter() - t0
+        report = json.loads(driver.call('report').be_msg_ret[0].value)
+
+        for p in procs:
+            p.terminate()
+
+    ops = sum(r[0] for r in fe_results)
+    nbytes = sum(r[1] for r in fe_results)
+    if args.scenario == 'async':  # measured where the messages land
+        hist = merge([report['hist']], [report['hist_total']])
+    else:
+        hist = merge([r[2] for r in fe_results], [r[3] for r in fe_results])
+
+    result = {'scenario': args.scenario,
+              'fes': args.fes,
+              'size': args.size,
+              'transport': 'ipc' if args.ipc else 'curve',
+              'asyncio': args.use_asyncio,
+              'batch': args.batch,
+              'seconds': round(elapsed, 3),
+              'ops': ops,
+              'ops_per_s': round(ops / elapsed, 1),
+              'mb_per_s': round(nbytes / elapsed / 1e6, 2),
+              'latency_us': latency(hist)}
+    if args.scenario == 'broadcast':
+        result['lost'] = args.count * args.fes - ops
+    if args.scenario == 'bulk':
+        result['ops'] = result['ops_per_s'] = None
+        result['stream_bytes'] = report['stream_bytes']
+    return result
+
+
+def compare(result, path):
+    """
+    :returns: Ratios of this run to a saved one, > 1.0 meaning more throughput or more latency.
+    """
+    with open(path) as f:
+        base = json.load(f)
+    ratios = {}
+    for key in ('ops_per_s', 'mb_per_s'):
+        if result.get(key) and base.get(key):
+            ratios[key] = round(result[key] / base[key], 3)
+    for key in ('p50', 'p99', 'p999'):
+        if result['latency_us'][key] and base['latency_us'][key]:
+            ratios[key] = round(result['latency_us'][key] / base['latency_us'][key], 3)
+    return ratios
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Furnace backend benchmark')
+    parser.add_argument('scenario', choices=SCENARIOS)
+    parser.add_argument('--fes', dest='fes', default=4, type=int, help='Simulated frontends (default: 4)')
+    parser.add_argument('--size', dest='size', default=256, type=int,
+                        help='Payload bytes per message, or per chunk for bulk (default: 256)')
+    parser.add_argument('--duration', dest='duration', default=5.0, type=float,
+                        help='Seconds each FE runs sync and async scenarios (default: 5)')
+    parser.add_argument('--count', dest='count', default=10000, type=int,
+                        help='Messages broadcast in the broadcast scenario (default: 10000)')
+    parser.add_argument('--bulk-mb', dest='bulk_mb', default=64, type=int,
+                        help='MiB each FE streams in the bulk scenario (default: 64)')
+    parser.add_argument('--window', dest='window', default=be.STREAM_WINDOW, type=int,
+                        help=f'Stream credit window in bytes (default: {be.STREAM_WINDOW})')
+    parser.add_argument('--asyncio', dest='use_asyncio', default=False, action='store_true',
+                        help='Benchmark AsyncBE instead of BE')
+    parser.add_argument('--batch', dest='batch', default=False, action='store_true',
+                        help='Register the tenant with FE_BATCH instead of FE')
+    parser.add_argument('--ipc', dest='ipc', default=False, action='store_true',
+                        help='Connect the proxy and subscribers over ipc:// without CURVE')
+    parser.add_argument('--port', dest='port', default=16561, type=int,
+                        help='Base port; the backend uses PORT and PORT+1, the proxy PORT+2 (default: 16561)')
+    parser.add_argument('--out', dest='out', default=None, help='Also write the JSON result to this file')
+    parser.add_argument('--compare', dest='compare', default=None,
+                        help='A previous --out file; adds this run\'s ratios to it under "vs_baseline"')
+    args = parser.parse_args()
+
+    result = run(args)
+    if args.compare:
+        result['vs_baseline'] = compare(result, args.compare)
+    text = json.dumps(result, indent=2)
+    print(text)
+    if args.out:
+        with open(args.out, 'w') as f:
+            f.write(text + '\n')
+
+
+if __name__ == '__main__':
+    main()
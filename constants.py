@@ -32,9 +32,39 @@ TIMER = 6
 BE = 7
 FE = 8
 SYSCALL_PLUGIN = 9
+FE_BATCH = 10
+STREAM = 11
+FE_EVICT = 12
 # event status
 ACTIVE = 20
 INACTIVE = 21
+# timer modes
+TIMER_FIXED_RATE = 40  # deadlines advance by the period
+TIMER_FIXED_DELAY = 41  # next deadline is the period after the callback returns
+# worker pool types
+WORKER_THREAD = 50
+WORKER_PROCESS = 51
+# stream ops
+STREAM_OPEN = 60
+STREAM_DATA = 61
+STREAM_CLOSE = 62
+STREAM_CREDIT = 63
+STREAM_ABORT = 64
+# outbound send policies, when an app's queue is full
+SEND_DROP = 80  # drop the message and count it
+SEND_BLOCK = 81  # wait up to SEND_TIMEOUT for room, then drop and count it
+# FE registry states
+FE_ALIVE = 70
+FE_SUSPECT = 71  # silent for longer than the heartbeat interval
+FE_EVICTED = 72
+# payload codecs, the wire values of Be_msg.codec and FacMessage.codecs, see furnace_compress.py
+CODEC_NONE = 0
+CODEC_ZLIB = 1
+CODEC_LZ4 = 2
+CODEC_ZSTD = 3
+# profiler output formats, see furnace_profile.py
+PROFILE_PSTATS = 90  # cProfile, read with pstats
+PROFILE_COLLAPSED = 91  # sampled stacks, one 'a;b;c count' line each
 # sync options
 SYNC = 30
 ASYNC = 31
@@ -49,5 +79,55 @@ F_OVERWRITE = 3
 # poll timeout
 TIMEOUT_BE = 250  # ms
 
+# socket high-water marks (the libzmq defaults, made explicit) and outbound queueing
+BE_SNDHWM = 1000  # messages
+BE_RCVHWM = 1000  # messages
+FE_QUEUE_MAX = 1024  # messages per app held while the dealer socket is full
+SEND_TIMEOUT = 1000  # ms, for SEND_BLOCK
+
+# FE_BATCH drain limits, per poll cycle
+FE_BATCH_COUNT = 256  # packets
+FE_BATCH_BYTES = 4194304  # 2^22 B
+
+# coroutine FE/FE_BATCH packets in flight before the asyncio backend stops reading, see furnace_backend_async.py
+ASYNC_MAX_PENDING = 1024
+
+# default per-stream credit window
+STREAM_WINDOW = 8388608  # 2^23 B
+STREAM_CHECKPOINT = 16777216  # 2^24 B written between FileSink resume checkpoints
+
+# KV facility defaults
+KV_CACHE_BYTES = 67108864  # 2^26 B of keys and values
+KV_DIRTY_MAX = 4096  # keys waiting for write-behind before an early flush
+KV_FLUSH_INTERVAL = 1.0  # seconds
+
+# payload compression: payloads below the threshold are sent as is, inbound payloads may expand to at most the limit
+COMPRESS_MIN_BYTES = 1024
+COMPRESS_MAX_RAW = 268435456  # 2^28 B
+
+# on-demand profiling defaults
+PROFILE_SECONDS = 30.0  # length of a profiling window
+PROFILE_SAMPLE_INTERVAL = 0.005  # seconds between PROFILE_COLLAPSED stack samples
+
+# fork server defaults
+FORK_WARM = 2  # idle children kept ready
+FORK_TIMEOUT = 10.0  # seconds a client waits for the server
+FORK_READ_TIMEOUT = 1.0  # seconds the server waits for a connected client's request
+FORK_MAX_REQUEST = 65536  # bytes
+
+# sharded backend defaults
+SHARD_STOP_TIMEOUT = 5.0  # seconds a worker gets to shut down before it is killed
+
+# traffic capture defaults
+CAPTURE_MAX_BYTES = 1073741824  # 2^30 B, capture stops beyond this
+CAPTURE_BUFFER = 1048576  # 2^20 B write buffer
+CAPTURE_FLUSH_INTERVAL = 1.0  # seconds of packets a killed backend may lose
+CAPTURE_INDEX_EVERY = 1024  # records between index entries
+
+# FE registry liveness defaults, in seconds
+FE_HEARTBEAT = 60.0
+FE_IDLE_TIMEOUT = 600.0
+FE_WHEEL_TICK = 1.0
+
 # max bytes size for protobufs
 MAX_FIELD_SIZE = 11056943
@@ -57,7 +57,7 @@ class AppBE(object):
             return msg
 
         feid = ctx.ident
-        msg = json.loads(ctx.message)
+        msg = ctx.body
         record = self.felist.get(feid, {'last_contact': time.time(), 'state': None, 'cmd_index': 0})
 
         if feid not in self.felist:
@@ -65,7 +65,7 @@ class AppBE(object):
 
         be.log(f'{self.felist}')
         be.log(f'sending to main')
-        self.pub.send(json.dumps(ctx._asdict()).encode())
+        self.pub.send(json.dumps(ctx._replace(data=None, body=None)._asdict()).encode())
 
     def timer_callback(self, ctx):
         be.log('timer_callback')
@@ -17,7 +17,6 @@
 
 import furnace_backend as be
 import time
-import json
 #import hashlib
 import binascii
 
@@ -31,7 +30,6 @@ class AppBE(object):
         self.felist = {}
         self.cycle_count = 1
         self.stime = 0.0
-        self.zdo = zlib.decompressobj()
         self.decompressed_data = b''
         self.total_recv_bytes = 0
         self.ix_recv = {}
@@ -59,14 +57,17 @@ class AppBE(object):
         # FE: hi, waiting, memdump_running, memdump_done, error
         # BE: memdump_cmd: go, stop
         feid = ctx.ident
-        msg = json.loads(ctx.message)
-        record = self.felist.get(feid, {'last_contact': time.time(), 'state': None, 'bytes':b''})
+        msg = ctx.body
+        record = self.felist.get(feid)
+        if record is None:  # first message from this FE; its decompressor must outlive this message
+            record = {'last_contact': time.time(), 'state': None, 'sink': None, 'offset': 0,
+                      'zdo': zlib.decompressobj()}
         record['state'] = msg['cmd']
 
         if msg['cmd'] in ['hi', 'waiting']:
             if self.cycle_count > 0:
                 self.cycle_count -= 1
-                be.notify(feid, json.dumps({'cmd': 'memdump_cmd', 'data': 'go'}))
+                be.notify(feid, {'cmd': 'memdump_cmd', 'data': 'go'})
                 self.stime = time.time()
             else:
                 be.log('cycle_count < 1')
@@ -76,16 +77,22 @@ class AppBE(object):
 
         elif msg['cmd'] in ['memdump']:
 
-            res = ''
-            compressed_size = 0
-
-            for chunk in msg['data']:
-                compressed_size += len(chunk)
-                cres = self.zdo.decompress(binascii.a2b_base64(chunk.encode()))
+            if record['sink'] is None:
+                record['sink'] = be.MmapSink.for_ident('.', feid)
+            if ctx.data is not None:  # binary payload, already decompressed by the backend if the FE negotiated a codec
+                recv_size = len(ctx.data)
+                chunks = [ctx.data]
+            else:  # legacy FEs send their own zlib stream, base64 encoded; one stream per FE
+                raw = [binascii.a2b_base64(chunk.encode()) for chunk in msg['data']]
+                recv_size = sum(len(chunk) for chunk in raw)
+                chunks = [record['zdo'].decompress(chunk) for chunk in raw]
+
+            for cres in chunks:
                 self.total_recv_bytes += len(cres)
-                #res += cres
+                record['sink'].write(record['offset'], cres)
+                record['offset'] += len(cres)
 
-            #shahash = hashlib.sha256(res).hexdigest()
+            #shahash = hashlib.sha256(record['sink'].view()).hexdigest()
             #orighash = msg['hash']
             ix = msg['ix']
             try:
@@ -93,20 +100,16 @@ class AppBE(object):
             except KeyError:
                 self.ix_recv[feid] = [ix]
 
-            be.log(f'{feid} got memdump ix={ix}:{compressed_size} -> {self.total_recv_bytes} B')
+            be.log(f'{feid} got memdump ix={ix}:{recv_size} -> {self.total_recv_bytes} B')
             #be.log(f'{feid} theirs={orighash}')
             #be.log(f'{feid} mine  ={shahash}')
-
-            # TODO: for benchmarking, we dump the bytes right on the ground
-            # instead, they could be saved to disk
-            #record['bytes'] += res  # need to eventually bytes() this
-
-            #recsize = len(record['bytes'])
-            #be.log(f'{feid} current memdump: recordsize={recsize} B')
+            be.log(f'{feid} current memdump: {record["offset"]} B in {record["sink"].path}')
 
         elif msg['cmd'] in ['memdump_done']:
             rt = round(time.time()-self.stime,2)
-            #rate = round((len(record['bytes'])/rt) / 1000000, 2)
+            if record['sink'] is not None:
+                record['sink'].close()
+                record['sink'] = None
             rate = round((self.total_recv_bytes/rt) / 1000000, 2)
             be.log(f'{feid} memdump finished')
             be.log(f'{feid} total_recv_bytes={self.total_recv_bytes}, runtime={rt}, rate={rate} MBps')
@@ -114,7 +117,7 @@ class AppBE(object):
             be.log('exiting...')
             for feid in self.felist:
                 be.log(f'telling {feid} to exit')
-                be.notify(feid, json.dumps({'cmd': 'memdump_cmd', 'data': 'exit'}))
+                be.notify(feid, {'cmd': 'memdump_cmd', 'data': 'exit'})
             be.exit()
 
         elif msg['cmd'] in ['error']:
@@ -17,7 +17,6 @@
 
 import furnace_backend as be
 import time
-import json
 import zmq
 
 class AppBE(object):
@@ -68,7 +67,7 @@ class AppBE(object):
         # FE: hi, waiting, rekall_running, rekall_done
         # BE: rekall_cmd
         feid = ctx.ident
-        msg = json.loads(ctx.message)
+        msg = ctx.body
         record = self.felist.get(feid, {'last_contact': time.time(), 'state': None, 'cmd_index': 0})
         record['state'] = msg['cmd']
 
@@ -77,7 +76,7 @@ class AppBE(object):
                 self.cycle_count -= 1
                 ix = (record['cmd_index'] + 1) % len(self.rekall_cmds)
                 record['cmd_index'] = ix
-                be.notify(feid, json.dumps({'cmd': 'rekall_cmd', 'data': self.rekall_cmds[ix]}))
+                be.notify(feid, {'cmd': 'rekall_cmd', 'data': self.rekall_cmds[ix]})
             else:
                 be.log('cycle_count < 1')
 
@@ -21,12 +21,20 @@ Main Furnace backend library.  Exposes API to tenant code. Formats and sends IPC
 import os
 import time
 import sys
+import importlib
+import traceback
 import logging
 from pprint import pformat as pf
 from pprint import pprint as pp
 import uuid
 import re
 import collections
+import heapq
+import concurrent.futures
+import multiprocessing
+import signal
+import tempfile
+import threading
 
 # 3p
 import zmq
@@ -37,60 +45,224 @@ from google.protobuf.internal import api_implementation
 # internal
 from constants import *
 import furnace_runtime
+import furnace_metrics
+import furnace_capture
+import furnace_compress
+import furnace_kv
+import furnace_payload
+import furnace_profile
+import furnace_registry
+import furnace_stream
+import furnace_wire
+from furnace_stream import FileSink, MmapSink
 import facilities_pb2
 
 bei = None
 broadcast = None
 notify = None
+broadcast_bytes = None
+notify_bytes = None
+notify_many = None
+publish = None
+fe_lookup = None
+fe_list = None
+send_stats = None
+profile = None
+reload = None
+kv_get = None
+kv_set = None
 event_register = None
 event_clear = None
 log = None
 set_name = None
 exit = None
 
+_pool_callback = None
+_pool_context = None
+_pool_payload = None
+_certificates = {}  # key file path -> (public, secret), see load_certificate
+
+# FacMessage type name -> (enum value, repeated field name), for mmsg_helper and msg_helper
+MSG_FIELDS = {name: (num, name.lower()) for name, num in furnace_wire.MSG_TYPES.items()}
+KV_GET = furnace_wire.MSG_TYPES['GET']
+KV_SET = furnace_wire.MSG_TYPES['SET']
+
 
 class BE(furnace_runtime.FurnaceRuntime):
     """
     Main Furnace backend class.  Actions all API calls.
     """
 
-    def __init__(self, kp, debug=False, be_ip='127.0.0.1', be_base_port=5561):
+    def __init__(self, kp, debug=False, be_ip='127.0.0.1', be_base_port=5561, log_file=None,
+                 sndhwm=BE_SNDHWM, rcvhwm=BE_RCVHWM, send_policy=SEND_DROP, fe_queue_max=FE_QUEUE_MAX,
+                 compress_min=COMPRESS_MIN_BYTES, ipc_dir=None, phase_timing=False, profile_dir=None,
+                 profile_seconds=PROFILE_SECONDS, profile_format=PROFILE_PSTATS, hot_reload=False, host=None,
+                 tenant_name=None, startup=None):
         """
         Constructor, ZMQ connections are built here.
-        :param kp: The keypair to use, in the form {'be_key': '[path]', 'app_key': '[path]'}
+        :param kp: The keypair to use, in the form {'be_key': '[path]', 'app_key': '[path]'}.  Unused with ipc_dir.
+        :param log_file: If set, also log at INFO and above to this rotating file.
+        :param sndhwm: ZMQ send high-water mark of the FE-facing sockets, in messages.
+        :param rcvhwm: ZMQ receive high-water mark of the FE-facing sockets, in messages.
+        :param send_policy: SEND_DROP or SEND_BLOCK, applied when an app's outbound queue is full.  With SEND_BLOCK,
+            broadcasts also wait for a full subscriber instead of being silently dropped by ZMQ.
+        :param fe_queue_max: Messages per app held while the dealer socket is at its high-water mark.
+        :param compress_min: Smallest binary payload compressed for apps that negotiated a codec.
+        :param ipc_dir: If set, bind the FE-facing sockets as ipc:// endpoints in this directory instead of CURVE over
+            TCP.  There is no encryption or authentication; the directory's permissions decide who may connect.
+        :param phase_timing: Time each phase of the event loop from the start, see furnace_profile.PhaseTimer.
+        :param profile_dir: If set, profiles are written here and SIGUSR1 opens a profiling window of profile_seconds
+            in profile_format, while SIGUSR2 logs and resets the phase timings (turning phase timing on if it was off).
+        :param hot_reload: If True, SIGHUP reloads the tenant's code, see reload.
+        :param host: If set, a furnace_host.Host whose ZMQ context, CURVE authenticator, poller, logger and signal
+            handlers this backend shares with the host's other tenants.  The host runs the event loop.
+        :param tenant_name: Prefix for this backend's log lines, to tell tenants apart in a shared log.
+        :param startup: furnace_profile.StartupTimer started before this constructor, e.g. before the imports.  The
+            breakdown is logged once the tenant is loaded.
         """
+        if send_policy not in (SEND_DROP, SEND_BLOCK):
+            raise Exception('unknown send_policy')
+        self.startup = startup if startup is not None else furnace_profile.StartupTimer()
 
-        super(BE, self).__init__(debug=debug)
+        super(BE, self).__init__(debug=debug, log_file=log_file, logger=host.logger if host is not None else None,
+                                 log_prefix=f'{tenant_name}: ' if tenant_name else '')
 
         self.be_ip = be_ip
         self.be_base_port = be_base_port
+        self.ipc_dir = ipc_dir
+        self.host = host
+        self.auth = None  # CURVE authenticator thread, TCP only and not shared with a host
         self.kp = kp
         self.name = 'UNK_BE'
         self.start_time = time.time()
         self.already_shutdown = False
+        self.app = None
+        self.tenant_spec = None  # (component, module) the tenant was loaded from, see load_tenant
 
         self.timerlist = {}
+        self.timerheap = []  # (deadline, tid), ordered by time.monotonic() deadline
         self.next_tid = 0
         self.fe_info = None
-        self.Context = collections.namedtuple('ctx', 'ident sync message')
+        self.Context = collections.namedtuple('ctx', 'ident sync message data body', defaults=(None, None))
+
+        # optional worker pool for SYNC messages, see start_pool
+        self.pool = None
+        self.pool_fn = None
+        self.pool_max_pending = 0
+        self.pool_args = None  # start_pool arguments, to restart the pool if a reload fails
+        self.pool_pending = 0
+        self.pool_done = collections.deque()  # (ident, future), appended from pool threads
+        self.pool_wakeup = None  # (read fd, write fd)
+        self.dealer_paused = False
+        self.loop_thread = None  # ident of the thread running the event loop, see on_loop
+        self.loop_calls = collections.deque()  # (function, args) API calls from pool threads, see defer
+
+        self.streams = None  # StreamManager, once the tenant registers a STREAM callback
+        self.metrics = None  # furnace_metrics.Metrics, see start_metrics
+        self.registry = furnace_registry.Registry()
+        self.evict_info = None  # FE_EVICT registration, if any
+        self.kv = furnace_kv.KVStore()  # memory-only until start_kv
+        self.capture = None  # furnace_capture.CaptureWriter, see start_capture
+
+        # payload compression, see furnace_compress.py
+        self.compress_min = compress_min
+        self.decoders = furnace_compress.Decoders()
+        self.compress_saved = 0  # outbound bytes saved by compression
+
+        # instrumentation, see control
+        self.phases = furnace_profile.PhaseTimer() if phase_timing else None
+        self.profiler = furnace_profile.Profiler(profile_dir or tempfile.gettempdir())
+        self.profile_seconds = profile_seconds
+        self.profile_format = profile_format
+        self.control_pending = False  # checked once per loop iteration
+        self.profile_requested = False
+        self.phase_report_requested = False
+        self.reload_requested = False
+        self.reload_handover = True
+
+        # outbound backpressure, see send_fe
+        self.sndhwm = sndhwm
+        self.rcvhwm = rcvhwm
+        self.send_policy = send_policy
+        self.fe_queue_max = fe_queue_max
+        self.outq = {}  # raw ident -> deque of multipart messages waiting for the dealer socket
+        self.outq_order = collections.deque()  # idents with a backlog, flushed round-robin
+        self.dealer_flags = 0  # events dealer_be is registered for in the poller
+        self.drops = 0  # messages to single apps dropped, see send_fe
+        self.broadcast_drops = 0  # broadcasts dropped, only detectable under SEND_BLOCK
 
         self.msg_in = facilities_pb2.FacMessage()
         self.msg_out = facilities_pb2.FacMessage()
-        self.context = zmq.Context(io_threads=2)
+        self.context = host.context if host is not None else zmq.Context(io_threads=2)
+
+        impl = api_implementation.Type()
+        if impl == 'python':
+            self.tprint('warning', 'protobuf is using the pure-python implementation, expect slow message parsing')
+        else:
+            self.tprint('info', 'protobuf implementation: %s', impl)
+        self.tprint('info', 'payload codecs: %s', ' '.join(c.name for c in furnace_compress.CODECS.values()))
+        self.startup.mark('init')
+
+        self.open_sockets()
+        self.dealer_sync = self.dealer_be  # blocking waits for SEND_BLOCK go through this handle
+
+        self.poller = host.poller if host is not None else zmq.Poller()
+        self.dealer_poll()
+
+        signals = []
+        if profile_dir is not None:
+            signals += [signal.SIGUSR1, signal.SIGUSR2]
+            self.tprint('info', f'profiling: SIGUSR1 profiles for {profile_seconds}s into {profile_dir}, '
+                                f'SIGUSR2 reports loop phases')
+        if hot_reload:
+            signals.append(signal.SIGHUP)
+            self.tprint('info', 'hot reload: SIGHUP reloads the tenant')
+        if signals and host is None:  # a host forwards its signals to every tenant
+            if threading.current_thread() is threading.main_thread():
+                for signum in signals:
+                    signal.signal(signum, self.control_signal)
+            else:
+                self.tprint('warning', 'control signals can only be installed from the main thread')
+
+
+    def endpoints(self):
+        """
+        Internal use only.
+        :returns: Tuple of (dealer endpoint, pub endpoint) that the FE-facing sockets bind to.
+        """
+        if self.ipc_dir is not None:
+            return f'ipc://{self.ipc_dir}/be-dealer', f'ipc://{self.ipc_dir}/be-pub'
+        return f'tcp://{self.be_ip}:{self.be_base_port+0}', f'tcp://{self.be_ip}:{self.be_base_port+1}'
+
+
+    def open_sockets(self):
+        """
+        Internal use only.
+        Starts CURVE authentication, then binds the FE-facing dealer_be and pub_be sockets.
+        :returns: Nothing.
+        """
+        if self.ipc_dir is not None:
+            self.open_ipc_sockets()
+            return
 
         # crypto bootstrap
-        auth = ThreadAuthenticator(self.context)
-        auth.start()
-        auth.configure_curve(domain='*', location=zmq.auth.CURVE_ALLOW_ANY)
+        if self.host is not None:
+            self.host.start_auth()
+        else:
+            self.auth = ThreadAuthenticator(self.context)
+            self.auth.start()
+            self.auth.configure_curve(domain='*', location=zmq.auth.CURVE_ALLOW_ANY)
+        self.startup.mark('auth')
 
-        pub_public, pub_secret = zmq.auth.load_certificate(kp['be_key'])
-        sub_public, sub_secret = zmq.auth.load_certificate(kp['app_key'])
+        pub_public, pub_secret = load_certificate(self.kp['be_key'])
+        sub_public, sub_secret = load_certificate(self.kp['app_key'])
+        self.startup.mark('keys')
 
-        TCP_BE_DLR = f'tcp://{self.be_ip}:{self.be_base_port+0}'
-        TCP_BE_SUB = f'tcp://{self.be_ip}:{self.be_base_port+1}'
+        TCP_BE_DLR, TCP_BE_SUB = self.endpoints()
 
         # use this to receive and send messages to FEs
         self.dealer_be = self.context.socket(zmq.DEALER)
+        self.configure_socket(self.dealer_be)
         # crypto start
         self.dealer_be.curve_publickey = pub_public
         self.dealer_be.curve_secretkey = pub_secret
@@ -101,6 +273,7 @@ class BE(furnace_runtime.FurnaceRuntime):
 
         # outgoing pub messages to FEs
         self.pub_be = self.context.socket(zmq.PUB)
+        self.configure_socket(self.pub_be)
         # crypto start
         self.pub_be.curve_publickey = pub_public
         self.pub_be.curve_secretkey = pub_secret
@@ -108,9 +281,109 @@ class BE(furnace_runtime.FurnaceRuntime):
         # crypto end
         self.tprint('info', f'PXY--BE: Binding as Subscriber to {TCP_BE_SUB}')
         self.pub_be.bind(TCP_BE_SUB)
+        self.startup.mark('bind')
+
+
+    def open_ipc_sockets(self):
+        """
+        Internal use only.
+        Binds dealer_be and pub_be in plaintext under ipc_dir, for a proxy on the same host.  No authenticator runs.
+        The directory is created owner-only if missing; an existing one keeps its permissions.
+        :returns: Nothing.
+        """
+        os.makedirs(self.ipc_dir, mode=0o700, exist_ok=True)
+        if os.stat(self.ipc_dir).st_mode & 0o007:
+            self.tprint('warning', 'IPC directory %s is open to other users, and its permissions are the only access '
+                                   'control without CURVE', self.ipc_dir)
+        IPC_BE_DLR, IPC_BE_SUB = self.endpoints()
+
+        self.dealer_be = self.context.socket(zmq.DEALER)
+        self.configure_socket(self.dealer_be)
+        self.tprint('info', f'PXY--BE: Binding as Dealer to {IPC_BE_DLR}, without CURVE')
+        self.dealer_be.bind(IPC_BE_DLR)
+
+        self.pub_be = self.context.socket(zmq.PUB)
+        self.configure_socket(self.pub_be)
+        self.tprint('info', f'PXY--BE: Binding as Subscriber to {IPC_BE_SUB}, without CURVE')
+        self.pub_be.bind(IPC_BE_SUB)
+        self.startup.mark('bind')
+
+
+    def configure_socket(self, sock):
+        """
+        Internal use only.
+        Applies the high-water marks and send policy to a FE-facing socket.  Call before bind/connect.
+        :param sock: A new ZMQ socket.
+        :returns: Nothing.
+        """
+        sock.setsockopt(zmq.SNDHWM, self.sndhwm)
+        sock.setsockopt(zmq.RCVHWM, self.rcvhwm)
+        if sock.socket_type == zmq.PUB and self.send_policy == SEND_BLOCK:
+            sock.setsockopt(zmq.XPUB_NODROP, 1)  # full subscribers make send fail instead of silently dropping
 
-        self.poller = zmq.Poller()
-        self.poller.register(self.dealer_be, zmq.POLLIN)
+
+    def start_metrics(self, port):
+        """
+        Internal use only.
+        Enables metrics collection and serves them over HTTP on localhost:port.  Call before the tenant's constructor
+        runs so its callbacks are instrumented as they are registered.
+        :param port: TCP port for the metrics endpoint.
+        :returns: Nothing.
+        """
+        self.metrics = furnace_metrics.Metrics(self)
+        self.metrics.gauges['furnace_startup_seconds'] = lambda: self.startup.total()
+        self.metrics.gauges['furnace_timers'] = lambda: len(self.timerheap)
+        self.metrics.gauges['furnace_fes'] = lambda: len(self.registry.fes)
+        self.metrics.gauges['furnace_kv_cached_keys'] = lambda: len(self.kv.cache)
+        self.metrics.gauges['furnace_kv_cache_hits'] = lambda: self.kv.hits
+        self.metrics.gauges['furnace_kv_cache_misses'] = lambda: self.kv.misses
+        self.metrics.gauges['furnace_kv_dirty_keys'] = lambda: len(self.kv.dirty)
+        self.metrics.gauges['furnace_pool_pending'] = lambda: self.pool_pending
+        self.metrics.gauges['furnace_outq_messages'] = lambda: sum(len(q) for q in list(self.outq.values()))
+        self.metrics.gauges['furnace_fe_drops'] = lambda: self.drops
+        self.metrics.gauges['furnace_broadcast_drops'] = lambda: self.broadcast_drops
+        self.metrics.gauges['furnace_compress_saved_bytes'] = lambda: self.compress_saved
+        self.metrics.gauges['furnace_streams_open'] = lambda: len(self.streams.streams) if self.streams else 0
+        self.metrics.gauges['furnace_stream_buffered_bytes'] = \
+            lambda: sum(st.pending_bytes for st in list(self.streams.streams.values())) if self.streams else 0
+        self.metrics.serve(port)
+        self.tprint('info', f'serving metrics on http://127.0.0.1:{port}/')
+
+
+    def start_kv(self, path, max_bytes=KV_CACHE_BYTES):
+        """
+        Internal use only.
+        Replaces the default memory-only KV store with one persisted to an SQLite file.
+        :param path: SQLite file, created if missing.
+        :param max_bytes: Cache budget, see KVStore.
+        :returns: Nothing.
+        """
+        self.kv.close()
+        self.kv = furnace_kv.KVStore(path, max_bytes=max_bytes, log=self.tprint)
+        self.tprint('info', f'KV store persisted to {path}')
+
+
+    def start_capture(self, path, max_bytes=CAPTURE_MAX_BYTES):
+        """
+        Internal use only.
+        Records every packet apps send to this backend, for replay with furnace_replay.
+        :param path: Capture file, truncated if it exists.
+        :param max_bytes: Capture stops once the file reaches this size.
+        :returns: Nothing.
+        """
+        self.capture = furnace_capture.CaptureWriter(path, max_bytes=max_bytes)
+        self.tprint('info', f'capturing inbound packets to {path}, up to {max_bytes >> 20}MiB')
+
+
+    def stop_capture(self):
+        """
+        Internal use only.
+        Closes the capture file.
+        :returns: Nothing.
+        """
+        capture, self.capture = self.capture, None
+        capture.close()
+        self.tprint('info', f'captured {capture.count} packets, {capture.offset}B to {capture.path}')
 
 
     def module_register(self):
@@ -121,12 +394,27 @@ class BE(furnace_runtime.FurnaceRuntime):
         """
         global bei
         global broadcast, notify
+        global broadcast_bytes, notify_bytes
+        global notify_many, publish
+        global fe_lookup, fe_list, send_stats, profile, reload
+        global kv_get, kv_set
         global event_register, event_clear, log, set_name
         global request
         global exit
         bei = self
         broadcast = self.broadcast
         notify = self.notify
+        broadcast_bytes = self.broadcast_bytes
+        notify_bytes = self.notify_bytes
+        notify_many = self.notify_many
+        publish = self.publish
+        fe_lookup = self.fe_lookup
+        fe_list = self.fe_list
+        send_stats = self.send_stats
+        profile = self.profile
+        reload = self.reload
+        kv_get = self.kv_get
+        kv_set = self.kv_set
         #broadcast_py = self.broadcast_py
         #notify_py = self.notify_py
         event_register = self.event_register
@@ -136,6 +424,26 @@ class BE(furnace_runtime.FurnaceRuntime):
         exit = self.exit
 
 
+    def load_tenant(self, component, module, ctx=None):
+        """
+        Internal use only.
+        Imports the tenant's backend class and constructs it on this backend.
+        :param component: Module holding the tenant, e.g. app_be.
+        :param module: Class inside that module, e.g. AppBE.
+        :param ctx: Extra metadata for the tenant's constructor.  ctx['be'] is always this backend.
+        :returns: Nothing.
+        """
+        self.module_register()
+        comp = __import__(component, fromlist=[module])
+        self.startup.mark('tenant_import')
+        app = getattr(comp, module)(dict(ctx or {}, be=self))
+        self.post_app_init(app=app)
+        self.startup.mark('tenant_init')
+        if self.tenant_spec is None:
+            self.tprint('info', self.startup.report())
+        self.tenant_spec = (component, module)
+
+
     def post_app_init(self, app):
         """
         Internal use only.
@@ -146,98 +454,1036 @@ class BE(furnace_runtime.FurnaceRuntime):
         :raises: Exception when caller failed register any FE callback.
         """
         self.app = app
-        be_ok = False
+        fe_ok = False
         for tk in self.timerlist:
             tv = self.timerlist[tk]
-            if tv['event_type'] == FE:
-                if be_ok:
+            if tv['event_type'] in (FE, FE_BATCH):
+                if fe_ok:
                     raise Exception('Tenant backend cannot register more than one FE callback')
                 fe_ok = True
         if not fe_ok:
             raise Exception('Tenant backend failed to register a FE callback')
-        self.tprint('debug', 'post_app_init TIMERLIST:\n{timerlist}'.format(timerlist=pf(self.timerlist)))
+        self.event_register({'event_type': TIMER, 'time_value': self.registry.tick, 'callback': self.registry_tick})
+        if self.kv.db is not None:
+            self.event_register({'event_type': TIMER, 'time_value': KV_FLUSH_INTERVAL, 'callback': lambda ctx: self.kv.try_flush()})
+        if self.logger.isEnabledFor(logging.DEBUG):
+            self.tprint('debug', 'post_app_init TIMERLIST:\n%s', pf(self.timerlist))
 
 
     def loop(self):
         """
         Internal use only.
         Main event loop.  Polls (with timeout) on ZMQ sockets waiting for data from tenant apps.  Calls tenant-registered callbacks.
+        The poll timeout is the time left until the next timer deadline, capped at TIMEOUT_BE.
         :returns: Nothing.
         """
-        cleanup_tids = list()
-
+        self.loop_thread = threading.get_ident()
         while True:
-            socks = dict(self.poller.poll(TIMEOUT_BE))
-
-            # Message from a Frontend
-            if self.dealer_be in socks:
-                pkt = self.dealer_be.recv_multipart()
-                self.msgin += 1
-                if len(pkt) == 3:  # SYNC message, FE is blocked until our reply
-                    sync = SYNC
-                    ident, empty, raw_msg = pkt
-                    self.msg_in.ParseFromString(raw_msg)
-
-                    index = 0
-                    submsg_list = getattr(self.msg_in, 'be_msg')
-                    val = submsg_list[index].value
-                    ctx = self.Context(ident=ident.decode(), sync=sync, message=val.decode())
-                    '''
-                    cb_data = {'ident': ident.decode(),
-                               'sync': sync,
-                               'message': val.decode()}
-                    ret_data = self.fe_info['callback'](cb_data)
-                    '''
-                    ret_data = self.fe_info['callback'](ctx)
-                    self.check_encoding(ret_data)
-
-                    self.msg_out.Clear()
-                    msgnum = self.msg_out.__getattribute__('BE_MSG_RET')
-                    self.msg_out.type.append(msgnum)
-                    submsg = getattr(self.msg_out, 'be_msg_ret').add()
-                    submsg.status = VMI_SUCCESS
-                    submsg.value = str(ret_data)
-                    raw_out = self.msg_out.SerializeToString()
-
-                    self.tprint('debug', 'sending %dB sync to %s' % (len(raw_out), ident))
-                    self.dealer_be.send_multipart([ident, b'', raw_out])
-                    self.msgout += 1
-
-                elif len(pkt) == 2:  # ASYNC message from FE
-                    sync = ASYNC
-                    ident, raw_msg = pkt
-                    self.msg_in.ParseFromString(raw_msg)
-
-                    index = 0
-                    submsg_list = getattr(self.msg_in, 'be_msg')
-                    val = submsg_list[index].value
-                    '''
-                    cb_data = {'ident': ident.decode(),
-                               'sync': sync,
-                               'message': val}
-                    ret_data = self.fe_info['callback'](cb_data)
-                    '''
-                    ctx = self.Context(ident=ident.decode(), sync=sync, message=val)
-                    self.fe_info['callback'](ctx)
-
-            curtime = time.time()
-            for tk in self.timerlist:
-                tv = self.timerlist[tk]
-
-                if tv['status'] != ACTIVE:
-                    cleanup_tids.append(ek)
-                    continue
-
-                if tv['event_type'] == TIMER \
-                        and tv['last_called'] + tv['time_value'] < curtime:
-                    tv['last_called'] = curtime
-                    d = 'timer triggered'
-                    tv['callback'](d)
-
-            while len(cleanup_tids):
-                del self.timerlist[cleanup_tids.pop()]
-
-            self.tick += 1
+            if self.control_pending:
+                self.control()
+            pt = self.phases  # PhaseTimer or None, fixed for the iteration
+            if pt is not None:
+                pt.start()
+
+            if self.pool is not None:
+                self.pool_throttle()
+
+            socks = dict(self.poller.poll(self.next_timeout()))
+            if pt is not None:
+                pt.mark('poll')
+            self.step(socks, pt)
+
+
+    def step(self, socks, pt):
+        """
+        Internal use only.
+        One event loop iteration after the poll: serves this backend's ready sockets, then its due timers.
+        :param socks: Dict of ready sockets from Poller.poll.
+        :param pt: self.phases as of the start of the iteration.
+        :returns: Nothing.
+        """
+        dealer_ev = socks.get(self.dealer_be, 0)
+
+        # Room again on the dealer socket for queued outbound messages
+        if dealer_ev & zmq.POLLOUT:
+            self.flush_outq()
+
+        # Replies from the worker pool
+        if self.pool_wakeup is not None and self.pool_wakeup[0] in socks:
+            self.pool_flush()
+        if pt is not None:
+            pt.mark('send')
+
+        # Message from a Frontend
+        if dealer_ev & zmq.POLLIN and self.fe_info['event_type'] == FE_BATCH:
+            pkts = self.recv_batch()
+            if pt is not None:
+                pt.mark('recv')
+            self.dispatch_batch(pkts)
+
+        elif dealer_ev & zmq.POLLIN:
+            pkt = self.dealer_be.recv_multipart()
+            self.msgin += 1
+            t0 = self.fe_in(pkt)
+            if pt is not None:
+                pt.mark('recv')
+            self.dispatch_pkt(pkt, t0, pt)
+
+        self.run_timers()
+        if pt is not None:
+            pt.mark('timers')
+
+        self.tick += 1
+
+
+    def dispatch_pkt(self, pkt, t0, pt):
+        """
+        Internal use only.
+        Serves one packet from an app registered with FE: answers a SYNC packet, or hands it to the worker pool.
+        :param pkt: Raw multipart packet, ident first.
+        :param t0: Arrival time from fe_in.
+        :param pt: self.phases as of the start of the iteration.
+        :returns: Nothing.
+        """
+        if len(pkt) == 3 and self.pool is not None:  # SYNC message, answered when its worker finishes
+            ident, empty, raw_msg = pkt
+            future = self.pool_submit(ident, raw_msg)
+            future.t0 = t0
+            future.add_done_callback(lambda f, ident=ident: self.pool_complete(ident, f))
+            if pt is not None:
+                pt.mark('parse')
+
+        elif len(pkt) == 3:  # SYNC message, FE is blocked until our reply
+            ident, empty, raw_msg = pkt
+            self.msg_in.ParseFromString(raw_msg)
+            if pt is not None:
+                pt.mark('parse')
+            raw_out = self.dispatch_sync(ident.decode())
+            if pt is not None:
+                pt.mark('serialize')
+            self.send_sync(ident, raw_out, t0)
+            if pt is not None:
+                pt.mark('send')
+
+        elif len(pkt) == 2:  # ASYNC message from FE
+            ident, raw_msg = pkt
+            self.msg_in.ParseFromString(raw_msg)
+            if pt is not None:
+                pt.mark('parse')
+            self.dispatch_async(ident.decode())
+            if pt is not None:
+                pt.mark('callback')
+
+    #---------------------------------------------
+
+    def control_signal(self, signum, frame):
+        """
+        Internal use only.
+        SIGUSR1/SIGUSR2/SIGHUP handler.  Only records the request; the event loop acts on it in control.
+        :returns: Nothing.
+        """
+        if signum == signal.SIGUSR1:
+            self.profile_requested = True
+        elif signum == signal.SIGHUP:
+            self.reload_handover = True
+            self.reload_requested = True
+        else:
+            self.phase_report_requested = True
+        self.control_pending = True
+
+
+    def control(self):
+        """
+        Internal use only.
+        Runs at the top of a loop iteration when control_pending is set: serves signal and API requests and closes a
+        profiling window that has run its length.
+        :returns: Nothing.
+        """
+        self.control_pending = False
+        if self.reload_requested:
+            self.reload_requested = False
+            self.reload_tenant()
+
+        if self.profile_requested:
+            self.profile_requested = False
+            try:
+                self.profile()
+            except Exception as e:
+                self.tprint('warning', f'profile request ignored: {e}')
+
+        if self.phase_report_requested:
+            self.phase_report_requested = False
+            if self.phases is None:
+                self.phases = furnace_profile.PhaseTimer()
+                self.tprint('info', 'loop phase timing on')
+            else:
+                for line in self.phases.report():
+                    self.tprint('info', line)
+                self.phases.reset()
+
+        if self.profiler.due():
+            self.tprint('info', f'profile written to {self.profiler.stop()}')
+        if self.profiler.prof is not None:
+            self.control_pending = True  # keep checking the deadline
+
+
+    def reload_tenant(self):
+        """
+        Internal use only.
+        Re-imports the tenant's module and swaps in a newly constructed app.  Sockets, the FE registry, outbound queues,
+        the KV store and open streams are kept, so apps stay connected.  The old app's registrations are dropped
+        first; if the new app fails to load, they are restored and the old app keeps running.
+        :returns: True if the new app is running.
+        """
+        if self.tenant_spec is None:
+            self.tprint('warning', 'reload ignored: no tenant was loaded with load_tenant')
+            return False
+        component, module = self.tenant_spec
+        t0 = time.perf_counter()
+        old_app = self.app
+
+        state = None
+        if self.reload_handover and hasattr(old_app, 'handover'):
+            try:
+                state = old_app.handover()
+            except Exception:
+                self.tprint('error', f'reload aborted, handover failed:\n{traceback.format_exc()}')
+                return False
+
+        # in-flight SYNC messages finish on the old code
+        pool_args = self.pool_args if self.pool is not None else None
+        if self.pool is not None:
+            self.stop_pool()
+
+        saved = (self.timerlist, self.timerheap, self.fe_info, self.evict_info, self.streams)
+        self.timerlist, self.timerheap, self.fe_info, self.evict_info, self.streams = {}, [], None, None, None
+        comp = sys.modules[component]
+        comp_globals = dict(comp.__dict__)  # reload re-executes the module in place, under the old app's feet
+        try:
+            importlib.reload(comp)
+            self.load_tenant(component, module, {'handover': state})
+        except Exception:
+            self.tprint('error', f'reload of {component}.{module} failed, keeping the running tenant:\n'
+                                 f'{traceback.format_exc()}')
+            if self.pool is not None:
+                self.stop_pool()
+            comp.__dict__.clear()
+            comp.__dict__.update(comp_globals)
+            self.timerlist, self.timerheap, self.fe_info, self.evict_info, self.streams = saved
+            self.app = old_app
+            if pool_args is not None:
+                self.start_pool(*pool_args)
+            return False
+
+        old_streams = saved[4]
+        if old_streams is not None and old_streams.streams:
+            if self.streams is not None:  # open streams keep writing to the sinks the old app returned
+                self.streams.streams.update(old_streams.streams)
+            else:
+                old_streams.close_all()
+        try:
+            old_app.shutdown()
+        except Exception:
+            self.tprint('err', 'error during app shutdown after reload')
+        self.tprint('info', f'reloaded {component}.{module} in {(time.perf_counter() - t0) * 1000:.1f}ms')
+        return True
+
+
+    def next_timeout(self):
+        """
+        Internal use only.
+        :returns: Milliseconds until the earliest timer deadline, between 0 and TIMEOUT_BE.
+        """
+        if not self.timerheap:
+            return TIMEOUT_BE
+        wait = (self.timerheap[0][0] - time.monotonic()) * 1000
+        return min(TIMEOUT_BE, max(0, wait))
+
+
+    def run_timers(self):
+        """
+        Internal use only.
+        Pops and calls every timer whose deadline has passed, then reschedules periodic timers.
+        Cleared timers are dropped lazily, when they reach the top of the heap.
+        :returns: Nothing.
+        """
+        heap = self.timerheap
+        now = time.monotonic()
+        while heap and heap[0][0] <= now:
+            deadline, tid = heapq.heappop(heap)
+            tv = self.timerlist.get(tid)
+            if tv is None:
+                continue
+            if tv['status'] != ACTIVE:
+                del self.timerlist[tid]
+                continue
+
+            tv['last_called'] = now
+            if self.metrics is not None:
+                self.metrics.timer_lag.record(int((now - deadline) * 1e9))
+            tv['callback']('timer triggered')
+
+            if tv['oneshot'] or tv['status'] != ACTIVE:
+                self.timerlist.pop(tid, None)
+                continue
+
+            period = tv['time_value']
+            if tv['mode'] == TIMER_FIXED_DELAY:
+                next_deadline = time.monotonic() + period
+            else:  # TIMER_FIXED_RATE, skip any periods we fell behind on
+                next_deadline = deadline + period
+                if next_deadline <= now:
+                    next_deadline += period * ((now - next_deadline) // period + 1)
+            tv['deadline'] = next_deadline
+            heapq.heappush(heap, (next_deadline, tid))
+
+
+    def dispatch_sync(self, ident):
+        """
+        Internal use only.
+        Calls the FE callback once for every be_msg packed into self.msg_in.  Each return value becomes one be_msg_ret, in order, in a single reply.
+        Every ctx is built before the first callback runs and the reply only once the last one returns, so API calls
+        made from a callback (notify, broadcast, the msg_out helpers) cannot disturb the request or its reply.
+        :param ident: String ID of the sending app.
+        :returns: The serialized reply protobuf.
+        """
+        fac_out = self.facility_ops(ident, SYNC, self.msg_in)
+        callback = self.fe_info['callback']
+        ctx_list = [self.make_ctx(ident, SYNC, submsg) for submsg in self.app_msgs(ident, self.msg_in)]
+        ret_list = [callback(ctx) for ctx in ctx_list]
+        if self.phases is not None:
+            self.phases.mark('callback')
+        return fac_out + self.build_sync_reply(ret_list)
+
+
+    def app_msgs(self, ident, msg):
+        """
+        Internal use only.
+        Hands stream ops to the StreamManager and returns the remaining be_msgs for the tenant's FE callback.
+        Stream ops in a SYNC packet therefore get no be_msg_ret; apps should send them ASYNC.
+        :param ident: String ID of the sending app.
+        :param msg: A parsed inbound FacMessage.
+        :returns: Sequence of be_msg.
+        """
+        if self.streams is None:
+            return msg.be_msg
+        submsgs = []
+        for submsg in msg.be_msg:
+            if submsg.HasField('op'):
+                self.streams.handle(ident, submsg)
+            else:
+                submsgs.append(submsg)
+        return submsgs
+
+
+    def facility_ops(self, ident, sync, msg):
+        """
+        Internal use only.
+        Handles everything in one inbound packet besides its be_msgs: codec negotiation, then get and set entries.
+        :param ident: String ID of the sending app.
+        :param sync: SYNC or ASYNC.
+        :param msg: A parsed inbound FacMessage.
+        :returns: For SYNC, the serialized fields to prepend to the reply (b'' if there were none).  For ASYNC, b''.
+        """
+        return self.codec_ops(ident, sync, msg) + self.kv_ops(ident, sync, msg)
+
+
+    def codec_ops(self, ident, sync, msg):
+        """
+        Internal use only.
+        Picks the payload codec for an app that listed the codecs it can decode, and tells the app which one.
+        :param ident: String ID of the sending app.
+        :param sync: SYNC or ASYNC.
+        :param msg: A parsed inbound FacMessage.
+        :returns: For SYNC, the codecs field to prepend to the reply (b'' if the app offered none).
+            For ASYNC, b''; the answer is sent to the app as a message of its own.
+        """
+        if not msg.codecs:
+            return b''
+        feid = ident.encode()
+        rec = self.registry.fes.get(feid)
+        cid = furnace_compress.choose(msg.codecs)
+        if rec is not None:
+            rec.codec = cid
+        self.decoders.drop(ident)
+        self.tprint('debug', 'app %s offered codecs %s, using %d', ident, list(msg.codecs), cid)
+
+        raw_out = furnace_wire.codecs([cid])
+        if sync == SYNC:
+            return raw_out
+        self.send_fe(feid, [feid, raw_out], len(raw_out), reliable=True)
+        return b''
+
+
+    def kv_ops(self, ident, sync, msg):
+        """
+        Internal use only.
+        Serves the get and set entries of one inbound packet from the KV store, in the order given by msg.type, so a
+        packet may pipeline any mix of them.  Entries beyond those listed in msg.type run afterwards, sets first.
+        :param ident: String ID of the sending app.
+        :param sync: SYNC or ASYNC.
+        :param msg: A parsed inbound FacMessage.
+        :returns: For SYNC, the serialized get_ret/set_ret entries to prepend to the reply (b'' if there were none).
+            For ASYNC, b''; GET results are sent to the app as a message of their own and sets are not acknowledged.
+        """
+        if not msg.get and not msg.set:
+            return b''
+        kv = self.kv
+        gets = iter(msg.get)
+        sets = iter(msg.set)
+        rets = []
+        for t in msg.type:
+            if t == KV_GET:
+                sub = next(gets, None)
+            elif t == KV_SET:
+                sub = next(sets, None)
+            else:
+                continue
+            if sub is not None:
+                rets.append(self.kv_op(kv, t, sub))
+        rets.extend(self.kv_op(kv, KV_SET, sub) for sub in sets)
+        rets.extend(self.kv_op(kv, KV_GET, sub) for sub in gets)
+
+        if sync == SYNC:
+            return furnace_wire.kv_ret(rets)
+        rets = [r for r in rets if r[0] == 'GET_RET']
+        if rets:
+            raw_out = furnace_wire.kv_ret(rets)
+            feid = ident.encode()
+            self.send_fe(feid, [feid, raw_out], len(raw_out))
+        return b''
+
+
+    def kv_op(self, kv, t, sub):
+        """
+        Internal use only.
+        :returns: One (msgtype, key, value, result) entry for furnace_wire.kv_ret.
+        """
+        if t == KV_GET:
+            value = kv.get(sub.key)
+            return ('GET_RET', sub.key, value, VMI_SUCCESS if value is not None else VMI_FAILURE)
+        if not sub.HasField('value'):
+            return ('SET_RET', sub.key, None, VMI_FAILURE)
+        kv.set(sub.key, sub.value)
+        return ('SET_RET', sub.key, None, VMI_SUCCESS)
+
+
+    def make_ctx(self, ident, sync, submsg):
+        """
+        Internal use only.
+        :param ident: String ID of the sending app.
+        :param sync: SYNC or ASYNC.
+        :param submsg: An inbound be_msg.
+        :returns: A ctx namedtuple.  ctx.data is a memoryview over the binary payload, or None if the app sent none.
+            ctx.body decodes the payload with the registered payload codec when the tenant first reads it.
+        """
+        data = self.msg_data(ident, submsg)
+        if data is not None:
+            data = memoryview(data)
+        return self.Context(ident=ident, sync=sync, message=submsg.value, data=data,
+                            body=furnace_payload.body(self.payload_codec(), submsg.value, data))
+
+
+    def payload_codec(self):
+        """
+        Internal use only.
+        :returns: The payload codec of the FE or FE_BATCH registration, see furnace_payload.
+        """
+        if self.fe_info is None:
+            return furnace_payload.JSON
+        return self.fe_info['payload']
+
+
+    def msg_data(self, ident, submsg):
+        """
+        Internal use only.
+        Decompresses an inbound binary payload if the app compressed it.  Payloads must be decoded in arrival order.
+        :param ident: String ID of the sending app.
+        :param submsg: An inbound be_msg.
+        :returns: The payload bytes, or None if the app sent none or it could not be decoded.
+        """
+        if not submsg.HasField('data'):
+            return None
+        if not submsg.codec:
+            return submsg.data
+        try:
+            return self.decoders.decompress(ident, submsg.codec, submsg.data)
+        except Exception as e:
+            self.tprint('warning', 'discarding undecodable payload from %s: %r', ident, e)
+            return None
+
+
+    def compress(self, cid, data):
+        """
+        Internal use only.
+        :param cid: Codec negotiated with the receiver(s), or CODEC_NONE.
+        :param data: bytes payload.
+        :returns: Tuple of (payload, codec) for furnace_wire.be_msg.
+        """
+        payload, codec = furnace_compress.compress(cid, data, self.compress_min)
+        if codec is not None:
+            self.compress_saved += len(data) - len(payload)
+        return payload, codec
+
+
+    def app_codec(self, ident):
+        """
+        Internal use only.
+        :param ident: Raw ident frame of an app.
+        :returns: The codec negotiated with the app, or CODEC_NONE.
+        """
+        rec = self.registry.fes.get(ident)
+        return rec.codec if rec is not None else CODEC_NONE
+
+
+    def check_codec(self, cid):
+        """
+        Internal use only.
+        :param cid: A codec named by the tenant.
+        :returns: Nothing.
+        :raises: Exception if the codec is not available in this process.
+        """
+        if cid != CODEC_NONE and cid not in furnace_compress.CODECS:
+            raise Exception(f'codec {cid} not available')
+
+
+    def build_sync_reply(self, ret_list):
+        """
+        Internal use only.
+        Packs one be_msg_ret per tenant return value.
+        Strings go into the value field, bytes-like return values into the binary data field.  Other objects are
+        encoded with the registered payload codec.
+        :param ret_list: List of strings, bytes-like objects or payload objects returned by the FE callback.
+        :returns: The serialized reply protobuf.
+        :raises: TypeError if a return value is None.
+        """
+        codec = self.payload_codec()
+        return furnace_wire.be_msg_ret([self.sync_ret(codec, ret_data) for ret_data in ret_list])
+
+
+    def build_failure_reply(self, ret_list, count, error):
+        """
+        Internal use only.
+        Packs the reply to a SYNC packet whose callbacks failed part way, so the FE is never left blocked.
+        :param ret_list: Return values of the callbacks that completed, in order.  Any that cannot be encoded is
+            answered with VMI_FAILURE.
+        :param count: Number of be_msg in the packet.  Those without a return value are answered with VMI_FAILURE.
+        :param error: The exception that stopped the callbacks.
+        :returns: The serialized reply protobuf.
+        """
+        codec = self.payload_codec()
+        rets = []
+        for ret_data in ret_list[:count]:
+            try:
+                rets.append(self.sync_ret(codec, ret_data))
+            except Exception as e:
+                rets.append((VMI_FAILURE, str(e), None))
+        rets += [(VMI_FAILURE, str(error), None)] * (count - len(rets))
+        return furnace_wire.be_msg_ret(rets)
+
+
+    def sync_ret(self, codec, ret_data):
+        """
+        Internal use only.
+        :param codec: The registered payload codec.
+        :param ret_data: One FE callback return value.
+        :returns: (status, value, data) tuple for furnace_wire.be_msg_ret.
+        :raises: TypeError if ret_data is None.
+        """
+        if ret_data is not None:
+            ret_data = furnace_payload.encode(codec, ret_data)
+        if isinstance(ret_data, (bytes, bytearray)):
+            return (VMI_SUCCESS, None, ret_data)
+        elif isinstance(ret_data, memoryview):
+            return (VMI_SUCCESS, None, ret_data.tobytes())
+        self.check_encoding(ret_data)
+        return (VMI_SUCCESS, ret_data, None)
+
+
+    def dispatch_async(self, ident):
+        """
+        Internal use only.
+        Calls the FE callback once for every be_msg packed into self.msg_in.
+        :param ident: String ID of the sending app.
+        :returns: Nothing.
+        """
+        self.facility_ops(ident, ASYNC, self.msg_in)
+        callback = self.fe_info['callback']
+        for submsg in self.app_msgs(ident, self.msg_in):
+            callback(self.make_ctx(ident, ASYNC, submsg))
+
+
+    def recv_batch(self):
+        """
+        Internal use only.
+        Drains the dealer socket without blocking, stopping at the FE_BATCH registration's batch_count or batch_bytes limit.
+        :returns: List of raw multipart packets.
+        """
+        max_count = self.fe_info['batch_count']
+        max_bytes = self.fe_info['batch_bytes']
+        pkts = []
+        nbytes = 0
+        while len(pkts) < max_count and nbytes < max_bytes:
+            try:
+                pkt = self.dealer_be.recv_multipart(flags=zmq.NOBLOCK)
+            except zmq.Again:
+                break
+            pkts.append(pkt)
+            nbytes += len(pkt[-1])
+            self.fe_in(pkt)
+        self.msgin += len(pkts)
+        return pkts
+
+
+    def dispatch_batch(self, pkts):
+        """
+        Internal use only.
+        Calls the FE_BATCH callback once with a list of ctx for every be_msg in pkts, then replies to each SYNC packet.
+        The callback must return a list with one entry per ctx when the batch holds any SYNC ctx; entries for ASYNC ctx are ignored.
+        If the callback raises or its replies cannot be sent, the error is logged and every SYNC packet is answered
+        with VMI_FAILURE where it has no reply.
+        :param pkts: List of raw multipart packets, from recv_batch.
+        :returns: Nothing.
+        """
+        pt = self.phases
+        ctx_list, spans = self.batch_contexts(pkts)
+        if pt is not None:
+            pt.mark('parse')
+        ret_list = None
+        try:
+            ret_list = self.fe_info['callback'](ctx_list) if ctx_list else []
+            if pt is not None:
+                pt.mark('callback')
+            self.send_batch_replies(ctx_list, spans, ret_list)
+        except Exception as e:
+            self.tprint('error', 'FE_BATCH callback failed: %r', e)
+            self.send_batch_failures(spans, ret_list, e)
+        if pt is not None:
+            pt.mark('send')
+
+
+    def batch_contexts(self, pkts):
+        """
+        Internal use only.
+        Parses a list of raw multipart packets into one flat list of ctx.
+        :param pkts: List of raw multipart packets.
+        :returns: Tuple of (ctx list, spans), where spans holds (ident, sync, first ctx, last ctx + 1, facility reply)
+            per packet.
+        """
+        ctx_list = []
+        spans = []
+        for pkt in pkts:
+            if len(pkt) == 3:  # SYNC message, FE is blocked until our reply
+                ident, empty, raw_msg = pkt
+                sync = SYNC
+            elif len(pkt) == 2:  # ASYNC message from FE
+                ident, raw_msg = pkt
+                sync = ASYNC
+            else:
+                continue
+            self.msg_in.ParseFromString(raw_msg)
+            ident_str = ident.decode()
+            fac_out = self.facility_ops(ident_str, sync, self.msg_in)
+            first = len(ctx_list)
+            for submsg in self.app_msgs(ident_str, self.msg_in):
+                ctx_list.append(self.make_ctx(ident_str, sync, submsg))
+            spans.append((ident, sync, first, len(ctx_list), fac_out))
+        return ctx_list, spans
+
+
+    def send_batch_replies(self, ctx_list, spans, ret_list):
+        """
+        Internal use only.
+        Sends one batched reply to every SYNC packet in a FE_BATCH batch.
+        :param ctx_list: The ctx list passed to the callback.
+        :param spans: Packet spans, from batch_contexts.
+        :param ret_list: The callback's return value.
+        :returns: Nothing.
+        :raises: Exception if the callback's return value does not line up with the batch.
+        """
+        if not any(span[1] == SYNC for span in spans):
+            return
+        if not isinstance(ret_list, list) or len(ret_list) != len(ctx_list):
+            raise Exception('FE_BATCH callback must return one reply per ctx when the batch contains SYNC messages')
+
+        # every reply is encoded before the first is sent, so a failure sends none and can be answered with
+        # send_batch_failures
+        replies = [(ident, fac_out + self.build_sync_reply(ret_list[first:last]))
+                   for ident, sync, first, last, fac_out in spans if sync == SYNC]
+        for ident, raw_out in replies:
+            self.send_sync(ident, raw_out)
+
+
+    def send_batch_failures(self, spans, ret_list, error):
+        """
+        Internal use only.
+        Answers every SYNC packet of a FE_BATCH batch whose callback or replies failed.
+        :param spans: Packet spans, from batch_contexts.
+        :param ret_list: The callback's return value, or None if it raised.  Used only if it lines up with the batch.
+        :param error: The exception.
+        :returns: Nothing.
+        """
+        if not isinstance(ret_list, list) or not spans or len(ret_list) != spans[-1][3]:
+            ret_list = []
+        for ident, sync, first, last, fac_out in spans:
+            if sync == SYNC:
+                self.send_sync(ident, fac_out + self.build_failure_reply(ret_list[first:last], last - first, error))
+
+
+    def fe_in(self, pkt):
+        """
+        Internal use only.
+        Counts one inbound packet in the FE registry and, if enabled, the metrics.
+        :param pkt: Raw multipart packet, ident first.
+        :returns: perf_counter_ns() arrival time from Metrics.fe_in, or None if metrics are off.
+        """
+        nbytes = len(pkt[-1])
+        self.registry.touch(pkt[0], nbytes, time.monotonic())
+        if self.capture is not None and not self.capture.write(pkt):
+            self.tprint('warning', 'capture reached its size limit')
+            self.stop_capture()
+        if self.metrics is not None:
+            return self.metrics.fe_in(pkt[0], nbytes)
+        return None
+
+
+    def fe_out(self, ident, nbytes):
+        """
+        Internal use only.
+        Counts one outbound packet to a single app.
+        :returns: Nothing.
+        """
+        self.registry.sent(ident, nbytes)
+        if self.metrics is not None:
+            self.metrics.fe_out(ident, nbytes)
+
+
+    def try_send(self, sock, frames, copy=True):
+        """
+        Internal use only.
+        :param sock: Socket to send on.
+        :param frames: Multipart message.
+        :returns: True if ZMQ took the message, False if the socket is at its high-water mark.
+        """
+        try:
+            sock.send_multipart(frames, flags=zmq.NOBLOCK, copy=copy)
+        except zmq.Again:
+            return False
+        return True
+
+
+    def send_fe(self, ident, frames, nbytes, reliable=False, copy=True):
+        """
+        Internal use only.
+        Sends one message to a single app without ever blocking on a slow peer: when the dealer socket is full, or the
+        app already has a backlog (to keep its messages in order), the message joins the app's outbound queue.
+        A full queue drops the message under SEND_DROP, or waits up to SEND_TIMEOUT for room under SEND_BLOCK.
+        :param ident: Raw ident frame of the app.
+        :param frames: Multipart message, ident first.
+        :param nbytes: Size of the protobuf, for the counters.
+        :param reliable: Never drop, e.g. a SYNC reply the app is blocked on.
+        :returns: True if sent or queued, False if dropped.
+        """
+        q = self.outq.get(ident)
+        if q is None:
+            if self.try_send(self.dealer_be, frames, copy):
+                self.msgout += 1
+                self.fe_out(ident, nbytes)
+                return True
+            q = self.outq[ident] = collections.deque()
+            self.outq_order.append(ident)
+            self.dealer_poll()
+
+        if len(q) >= self.fe_queue_max and not reliable:
+            if self.send_policy == SEND_BLOCK:
+                deadline = time.monotonic() + SEND_TIMEOUT / 1000
+                while len(q) >= self.fe_queue_max:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0 or not self.dealer_sync.poll(int(remaining * 1000) + 1, zmq.POLLOUT):
+                        break
+                    self.flush_outq()
+                q = self.outq.get(ident)
+                if q is None:  # drained completely while we waited
+                    return self.send_fe(ident, frames, nbytes, reliable, copy)
+            if len(q) >= self.fe_queue_max:
+                self.drops += 1
+                rec = self.registry.fes.get(ident)
+                if rec is not None:
+                    rec.drops += 1
+                if self.drops & (self.drops - 1) == 0:  # 1, 2, 4, 8...
+                    self.tprint('warning', 'outbound queue to %s full, %d messages dropped so far', ident, self.drops)
+                return False
+
+        q.append(frames)
+        self.msgout += 1
+        self.fe_out(ident, nbytes)
+        return True
+
+
+    def flush_outq(self):
+        """
+        Internal use only.
+        Sends queued outbound messages, one app at a time round-robin, until the dealer socket fills up again.
+        :returns: Nothing.
+        """
+        order = self.outq_order
+        while order:
+            ident = order.popleft()
+            q = self.outq[ident]
+            if not self.try_send(self.dealer_be, q[0]):
+                order.appendleft(ident)
+                break
+            q.popleft()
+            if q:
+                order.append(ident)
+            else:
+                del self.outq[ident]
+        self.dealer_poll()
+
+
+    def dealer_poll(self):
+        """
+        Internal use only.
+        Registers dealer_be in the poller for reads unless paused by the pool, and for writes while messages are queued.
+        :returns: Nothing.
+        """
+        flags = (0 if self.dealer_paused else zmq.POLLIN) | (zmq.POLLOUT if self.outq else 0)
+        if flags != self.dealer_flags:
+            if flags:
+                self.poller.register(self.dealer_be, flags)
+            else:
+                self.poller.unregister(self.dealer_be)
+            self.dealer_flags = flags
+
+
+    def send_pub(self, raw_out):
+        """
+        Internal use only.
+        Sends one broadcast.  Under SEND_DROP, ZMQ drops it for any subscriber at its high-water mark, uncounted;
+        under SEND_BLOCK, waits up to SEND_TIMEOUT for every subscriber to have room, then drops and counts it.
+        :param raw_out: The serialized protobuf.
+        :returns: True if sent.
+        """
+        if self.send_policy == SEND_BLOCK:
+            deadline = time.monotonic() + SEND_TIMEOUT / 1000
+            while not self.try_send(self.pub_be, [raw_out]):
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    self.broadcast_drops += 1
+                    self.tprint('warning', 'broadcast dropped, %d so far', self.broadcast_drops)
+                    return False
+                time.sleep(min(remaining, 0.001))
+        else:
+            self.try_send(self.pub_be, [raw_out])
+        self.msgout += 1
+        if self.metrics is not None:
+            self.metrics.fe_out(b'*', len(raw_out))
+        return True
+
+
+    def send_sync(self, ident, raw_out, t0=None):
+        """
+        Internal use only.
+        Sends a reply to a FE that is blocked on a SYNC message.
+        :param ident: Raw ident frame of the app.
+        :param raw_out: The serialized reply protobuf.
+        :param t0: perf_counter_ns() when the request arrived, from Metrics.fe_in, or None.
+        :returns: Nothing.
+        """
+        self.tprint('debug', 'sending %dB sync to %s', len(raw_out), ident)
+        self.send_fe(ident, [ident, b'', raw_out], len(raw_out), reliable=True)
+        if t0 is not None:
+            self.metrics.sync_rtt.record(time.perf_counter_ns() - t0)
+
+    #---------------------------------------------
+
+    def start_pool(self, workers, worker_type, max_pending):
+        """
+        Internal use only.
+        Starts the worker pool that runs the FE callback for SYNC messages off the event loop.
+        Thread workers may call the send API (notify, notify_bytes, notify_many, broadcast, broadcast_bytes, publish)
+        and kv_set: since only the event loop thread touches the sockets and the KV store, those calls are queued and
+        run on the loop, see defer.  A process pool is forked, so each worker holds its own copy of the tenant's app
+        and cannot use the backend API.
+        :param workers: Number of worker threads or processes.
+        :param worker_type: WORKER_THREAD or WORKER_PROCESS.
+        :param max_pending: Stop reading from FEs while this many SYNC messages are in flight.
+        :returns: Nothing.
+        :raises: Exception for an unknown worker type.
+        """
+        if worker_type == WORKER_THREAD:
+            self.pool = concurrent.futures.ThreadPoolExecutor(max_workers=workers)
+            self.pool_fn = self.pool_call
+        elif worker_type == WORKER_PROCESS:
+            self.pool = concurrent.futures.ProcessPoolExecutor(max_workers=workers,
+                                                               mp_context=multiprocessing.get_context('fork'),
+                                                               initializer=_pool_init,
+                                                               initargs=(self.fe_info['callback'], self.Context,
+                                                                         self.payload_codec()))
+            self.pool_fn = _pool_call
+        else:
+            raise Exception('unknown worker_type')
+
+        self.pool_max_pending = max_pending
+        self.pool_args = (workers, worker_type, max_pending)
+        self.pool_wakeup = os.pipe()
+        os.set_blocking(self.pool_wakeup[0], False)
+        self.poller.register(self.pool_wakeup[0], zmq.POLLIN)
+        self.tprint('info', f'started {workers} pool workers, max_pending={max_pending}')
+
+
+    def stop_pool(self):
+        """
+        Internal use only.
+        Waits for the worker pool's in-flight SYNC messages, answers them, then shuts the pool down.
+        :returns: Nothing.
+        """
+        self.pool.shutdown(wait=True)
+        if self.pool_done or self.loop_calls:
+            self.pool_flush()
+        self.poller.unregister(self.pool_wakeup[0])
+        for fd in self.pool_wakeup:
+            os.close(fd)
+        self.pool = None
+        self.pool_fn = None
+        self.pool_wakeup = None
+        if self.dealer_paused:
+            self.dealer_paused = False
+            self.dealer_poll()
+
+
+    def pool_submit(self, ident, raw_msg):
+        """
+        Internal use only.
+        Hands every be_msg of one SYNC packet to the worker pool.
+        :param ident: Raw ident frame of the sending app.
+        :param raw_msg: The raw protobuf.
+        :returns: A concurrent.futures.Future resolving to the list of callback return values.  Its fac_out attribute
+            holds the packet's codec and KV reply, which are answered on the event loop, and its count attribute the
+            number of be_msg handed to the callback.
+        """
+        self.msg_in.ParseFromString(raw_msg)
+        ident_str = ident.decode()
+        fac_out = self.facility_ops(ident_str, SYNC, self.msg_in)
+        args = [(ident_str, SYNC, submsg.value, self.msg_data(ident_str, submsg))
+                for submsg in self.app_msgs(ident_str, self.msg_in)]
+        self.pool_pending += 1
+        future = self.pool.submit(self.pool_fn, args)
+        future.fac_out = fac_out
+        future.count = len(args)
+        return future
+
+
+    def pool_call(self, args):
+        """
+        Internal use only.
+        Runs in a pool thread.
+        :param args: List of (ident, sync, message, data) tuples.
+        :returns: List of callback return values.
+        """
+        callback = self.fe_info['callback']
+        codec = self.payload_codec()
+        return [callback(self.Context(*a, body=furnace_payload.body(codec, a[2], a[3]))) for a in args]
+
+
+    def pool_complete(self, ident, future):
+        """
+        Internal use only.
+        Future done callback, runs on a pool thread.  Queues the result and wakes the event loop.
+        :param ident: Raw ident frame of the app.
+        :param future: The finished future.
+        :returns: Nothing.
+        """
+        self.pool_done.append((ident, future))
+        os.write(self.pool_wakeup[1], b'\0')
+
+
+    def pool_flush(self):
+        """
+        Internal use only.
+        Runs the API calls pool threads queued, then sends a reply for every finished pool future.  A failed callback
+        is answered with VMI_FAILURE so the FE does not stay blocked.
+        :returns: Nothing.
+        """
+        try:
+            os.read(self.pool_wakeup[0], 4096)
+        except BlockingIOError:
+            pass
+        self.run_deferred()  # a callback's sends go out before its reply
+        while self.pool_done:
+            ident, future = self.pool_done.popleft()
+            self.pool_pending -= 1
+            self.send_sync(ident, self.pool_reply(ident, future), getattr(future, 't0', None))
+
+
+    def pool_reply(self, ident, future):
+        """
+        Internal use only.
+        :param ident: Raw ident frame of the app.
+        :param future: A finished pool future.
+        :returns: The serialized reply protobuf.  If the callbacks failed, or returned something that cannot be sent,
+            every be_msg without a reply gets VMI_FAILURE.
+        """
+        ret_list = []
+        try:
+            ret_list = future.result()
+            return future.fac_out + self.build_sync_reply(ret_list)
+        except Exception as e:
+            self.tprint('error', 'pool callback for %s failed: %r', ident, e)
+            return future.fac_out + self.build_failure_reply(ret_list, future.count, e)
+
+
+    def on_loop(self):
+        """
+        Internal use only.
+        :returns: True on the event loop thread, or before the event loop starts.
+        """
+        return self.loop_thread is None or threading.get_ident() == self.loop_thread
+
+
+    def defer(self, fn, *args):
+        """
+        Internal use only.
+        Queues an API call made from a worker pool thread to run on the event loop thread, which owns the sockets and
+        the KV store, and wakes the loop.
+        :param fn: Bound API method.
+        :param args: Its arguments.
+        :returns: Nothing.
+        :raises: Exception if no worker pool is running; other threads must not call the backend API.
+        """
+        if self.pool_wakeup is None:
+            raise Exception('backend API called outside the event loop thread')
+        self.loop_calls.append((fn, args))
+        os.write(self.pool_wakeup[1], b'\0')
+
+
+    def run_deferred(self):
+        """
+        Internal use only.
+        Runs the API calls queued by defer, in order.  A failing call is logged; the pool thread has moved on.
+        :returns: Nothing.
+        """
+        calls = self.loop_calls
+        while calls:
+            fn, args = calls.popleft()
+            try:
+                fn(*args)
+            except Exception as e:
+                self.tprint('error', '%s from a pool thread failed: %r', fn.__name__, e)
+
+
+    def pool_throttle(self):
+        """
+        Internal use only.
+        Backpressure: stops polling the dealer socket while the pool is saturated, and resumes once it drains.
+        :returns: Nothing.
+        """
+        if not self.dealer_paused and self.pool_pending >= self.pool_max_pending:
+            self.dealer_paused = True
+            self.dealer_poll()
+        elif self.dealer_paused and self.pool_pending < self.pool_max_pending:
+            self.dealer_paused = False
+            self.dealer_poll()
 
     #---------------------------------------------
 
@@ -261,10 +1507,9 @@ class BE(furnace_runtime.FurnaceRuntime):
         :returns: The submsg, ready to be populated.
         """
         self.msg_out.Clear()
-        msgnum = self.msg_out.__getattribute__(msgtype)
+        msgnum, field = MSG_FIELDS[msgtype]
         self.msg_out.type.append(msgnum)
-        submsg = getattr(self.msg_out, msgtype.lower()).add()
-        return submsg
+        return getattr(self.msg_out, field).add()
 
 
     def msg_helper(self, msgtype):
@@ -275,10 +1520,9 @@ class BE(furnace_runtime.FurnaceRuntime):
         :returns: The submsg, ready to be populated.
         """
         self.msg_out.Clear()
-        msgnum = self.msg_out.__getattribute__(msgtype)
+        msgnum, field = MSG_FIELDS[msgtype]
         self.msg_out.type.append(msgnum)
-        submsg = getattr(self.msg_out, msgtype.lower())
-        return submsg
+        return getattr(self.msg_out, field)
 
 
     def send_default_reply(self):
@@ -349,41 +1593,171 @@ class BE(furnace_runtime.FurnaceRuntime):
 
     #---------------------------------------------
 
-    def broadcast(self, msg):
+    def broadcast(self, msg, codec=CODEC_NONE):
         """
         Supported API call.
         Send an async message to all registered tenant apps.  Uses the ZMQ publisher channel.  Immediately returns regardless of delivery.
-        :param msg: String to send.
+        From a worker pool thread, the broadcast is queued for the event loop thread.
+        :param msg: String to send, or an object to encode with the registered payload codec.
+        :param codec: See broadcast_bytes; applies if msg is sent in the binary data field.
         :returns: Nothing.
         """
-        self.check_encoding(msg)
-        msgtype = 'BE_MSG'
-        submsg = self.mmsg_helper(msgtype)
-        submsg.status = VMI_SUCCESS
-        submsg.value = str(msg).encode()
-        self.pub_be.send(self.msg_out.SerializeToString())
-        self.msgout += 1
+        msg = furnace_payload.encode(self.payload_codec(), msg)
+        if not isinstance(msg, str):
+            return self.broadcast_bytes(msg, codec)
+        if not self.on_loop():
+            return self.defer(self.broadcast, msg)
+        self.send_pub(furnace_wire.be_msg(VMI_SUCCESS, msg))
         self.tprint('debug', 'sending broadcast')
 
 
     def notify(self, feid, msg):
         """
         Supported API call.
-        Send an async message to a single registered tenant app.  Immediately returns regardless of delivery.
+        Send an async message to a single registered tenant app.  Immediately returns regardless of delivery, unless
+        the backend runs with SEND_BLOCK and the app's outbound queue is full.
+        From a worker pool thread, the message is queued for the event loop thread and True is returned.
         :param feid: String matching desired app's ID.
-        :param msg: String to send.
+        :param msg: String to send, or an object to encode with the registered payload codec.
+        :returns: True if sent or queued, False if dropped by the send policy.
+        """
+        msg = furnace_payload.encode(self.payload_codec(), msg)
+        if not isinstance(msg, str):
+            return self.notify_bytes(feid, msg)
+        self.check_encoding(feid)
+        if not self.on_loop():
+            self.defer(self.notify, feid, msg)
+            return True
+        raw_out = furnace_wire.be_msg(VMI_SUCCESS, msg)
+        ident = feid.encode()
+        ok = self.send_fe(ident, [ident, raw_out], len(raw_out))
+        self.tprint('debug', 'sending %dB message to %s', len(raw_out), feid)
+        return ok
+
+
+    def broadcast_bytes(self, data, codec=CODEC_NONE):
+        """
+        Supported API call.
+        Like broadcast, but sends binary data in the be_msg data field, skipping any text encoding.
+        Broadcasts are sent uncompressed unless the tenant names a codec: the backend cannot tell which apps are
+        subscribed, so only the tenant knows that every one of them decodes it.
+        From a worker pool thread, the broadcast is queued for the event loop thread.
+        :param data: bytes-like object to send.
+        :param codec: CODEC_NONE (default), or a CODEC_ constant every subscriber decodes.  Payloads of at least
+            compress_min bytes are then compressed with it.
         :returns: Nothing.
+        :raises: Exception if codec is not available in this process.
+        """
+        data = bytes(data)
+        self.check_codec(codec)
+        if not self.on_loop():
+            return self.defer(self.broadcast_bytes, data, codec)
+        payload, codec = self.compress(codec, data)
+        self.send_pub(furnace_wire.be_msg(VMI_SUCCESS, data=payload, codec=codec))
+        self.tprint('debug', 'sending binary broadcast')
+
+
+    def notify_bytes(self, feid, data):
+        """
+        Supported API call.
+        Like notify, but sends binary data in the be_msg data field, skipping any text encoding.
+        Large payloads are compressed if the app negotiated a codec.
+        :param feid: String matching desired app's ID.
+        :param data: bytes-like object to send.
+        From a worker pool thread, the message is queued for the event loop thread and True is returned.
+        :returns: True if sent or queued, False if dropped by the send policy.
         """
-        self.check_encoding(msg)
         self.check_encoding(feid)
-        msgtype = 'BE_MSG'
-        submsg = self.mmsg_helper(msgtype)
-        submsg.status = VMI_SUCCESS
-        submsg.value = msg.encode()
-        raw_out = self.msg_out.SerializeToString()
-        self.dealer_be.send_multipart([feid.encode(), raw_out])
-        self.msgout += 1
-        self.tprint('debug', 'sending %dB message to %s' % (len(raw_out), feid))
+        if not self.on_loop():
+            self.defer(self.notify_bytes, feid, bytes(data))
+            return True
+        ident = feid.encode()
+        payload, codec = self.compress(self.app_codec(ident), bytes(data))
+        raw_out = furnace_wire.be_msg(VMI_SUCCESS, data=payload, codec=codec)
+        ok = self.send_fe(ident, [ident, raw_out], len(raw_out))
+        self.tprint('debug', 'sending %dB binary message to %s', len(raw_out), feid)
+        return ok
+
+
+    def notify_many(self, feids, msg):
+        """
+        Supported API call.
+        Send the same async message to several tenant apps.  The message is serialized once and the same buffer
+        is handed to ZMQ for every app.  Immediately returns regardless of delivery.
+        A large binary message is compressed once per codec in use among the apps.
+        :param feids: Iterable of strings matching the desired apps' IDs.
+        :param msg: String to send, a bytes-like object to send in the binary data field, or an object to encode
+            once with the registered payload codec.
+        :returns: Number of apps the message was sent or queued to; the rest were dropped by the send policy.  From a
+            worker pool thread, the sends are queued for the event loop thread and the number of apps is returned.
+        """
+        msg = furnace_payload.encode(self.payload_codec(), msg)
+        if not self.on_loop():
+            feids = list(feids)
+            self.defer(self.notify_many, feids, bytes(msg) if isinstance(msg, (bytearray, memoryview)) else msg)
+            return len(feids)
+        if isinstance(msg, (bytes, bytearray, memoryview)):
+            data = bytes(msg)
+            raw_outs = {}  # codec -> serialized message
+        else:
+            self.check_encoding(msg)
+            data = None
+            raw_out = furnace_wire.be_msg(VMI_SUCCESS, msg)
+        count = 0
+        for feid in feids:
+            self.check_encoding(feid)
+            ident = feid.encode()
+            if data is not None:
+                cid = self.app_codec(ident)
+                raw_out = raw_outs.get(cid)
+                if raw_out is None:
+                    payload, codec = self.compress(cid, data)
+                    raw_out = raw_outs[cid] = furnace_wire.be_msg(VMI_SUCCESS, data=payload, codec=codec)
+            count += self.send_fe(ident, [ident, raw_out], len(raw_out), copy=False)
+        self.tprint('debug', 'sending message to %d apps', count)
+        return count
+
+
+    def publish(self, topic, msg, codec=CODEC_NONE):
+        """
+        Supported API call.
+        Send an async message to every tenant app subscribed to topic.  Uses the ZMQ publisher channel, so filtering
+        happens in ZMQ and apps that did not subscribe never see the message.  Apps subscribe to
+        furnace_wire.topic_prefix(topic); apps subscribed to everything receive it as an ordinary broadcast.
+        Immediately returns regardless of delivery.  From a worker pool thread, the message is queued for the event loop thread.
+        :param topic: String naming the channel.
+        :param msg: String to send, a bytes-like object to send in the binary data field, or an object to encode
+            with the registered payload codec.
+        :param codec: See broadcast_bytes; applies if msg is sent in the binary data field.
+        :returns: Nothing.
+        :raises: Exception if codec is not available in this process.
+        """
+        self.check_encoding(topic)
+        self.check_codec(codec)
+        msg = furnace_payload.encode(self.payload_codec(), msg)
+        if not self.on_loop():
+            return self.defer(self.publish, topic, bytes(msg) if isinstance(msg, (bytearray, memoryview)) else msg,
+                              codec)
+        if isinstance(msg, (bytes, bytearray, memoryview)):
+            data = bytes(msg)
+            payload, codec = self.compress(codec, data)
+            raw_out = furnace_wire.be_msg_topic(topic, VMI_SUCCESS, data=payload, codec=codec)
+        else:
+            self.check_encoding(msg)
+            raw_out = furnace_wire.be_msg_topic(topic, VMI_SUCCESS, msg)
+        self.send_pub(raw_out)
+        self.tprint('debug', 'publishing %dB on topic %s', len(raw_out), topic)
+
+
+    def send_stream_ctl(self, feid, stream, op, offset, credit, value):
+        """
+        Internal use only.
+        Sends a stream control be_msg (credit grant or abort) to one app.
+        :returns: Nothing.
+        """
+        raw_out = furnace_wire.be_msg_stream(VMI_SUCCESS, stream, op, offset, credit, value)
+        ident = feid.encode()
+        self.send_fe(ident, [ident, raw_out], len(raw_out), reliable=True)  # a lost credit grant would stall the stream
 
 
     def event_register(self, edata):
@@ -393,32 +1767,100 @@ class BE(furnace_runtime.FurnaceRuntime):
         :param edata: A dict containing registration info, including the following key:value pairs.
             'event_type': Event type constant, see constants.py.
             'callback': Tenant function pointer to call when matching event arrives.
+            if event_type == FE, optionally include these key:value pairs to answer SYNC messages from a worker pool:
+                'workers': (int) number of pool workers.
+                'worker_type': WORKER_THREAD (default) or WORKER_PROCESS, see constants.py.
+                'max_pending': (int) in-flight SYNC messages before the backend stops reading (default: 4 * workers).
+            if event_type == FE or FE_BATCH, optionally include:
+                'payload': a furnace_payload codec (JsonCodec, MsgpackCodec, ProtobufCodec or StructCodec) for ctx.body
+                    and for the objects passed to notify, broadcast, notify_many and publish (default: JSON).
+            if event_type == STREAM, the callback receives a StreamCtx (ident stream name size) whenever an app opens a bulk
+                transfer stream, and returns a sink such as FileSink, or None to refuse it.  Optionally include:
+                'window': (int) per-stream credit window in bytes (default: STREAM_WINDOW).
             if event_type == TIMER, also include these key:value pairs:
                 'time_value': (float) call this callback every X seconds.
+                'oneshot': (bool) call this callback once, time_value seconds from now (default: False).
+                'mode': TIMER_FIXED_RATE (default) or TIMER_FIXED_DELAY, see constants.py.
+                'time_start': (float) seconds until the first call (default: 0.0, or time_value if oneshot).
+            if event_type == FE_BATCH, the callback receives a list of ctx instead of a single ctx, and may include:
+                'batch_count': (int) max packets drained per poll cycle (default: FE_BATCH_COUNT).
+                'batch_bytes': (int) max payload bytes drained per poll cycle (default: FE_BATCH_BYTES).
+            if event_type == FE_EVICT, the callback receives an FERecord each time an app is evicted from the FE registry
+                for going silent.  Any packet from an app counts as a heartbeat.  Optionally include:
+                'heartbeat': (float) seconds of silence before an app is marked FE_SUSPECT (default: FE_HEARTBEAT).
+                'idle_timeout': (float) seconds of silence before an app is evicted (default: FE_IDLE_TIMEOUT).
         :returns: event ID.  Can be later used to clear this event.
         :raises: Exception for unknown event type.
+        :raises: Exception for a malformed TIMER registration.
         :raises: Generic catchall failure (this should never occur).
         """
 
-        callback = edata.pop('callback')
         etype = edata.pop('event_type')
+        callback = self.wrap_callback(etype, edata.pop('callback'))
         candidate = {'event_type': etype,
                      'callback': callback,
                      'status': ACTIVE}
 
+        if etype in (FE, FE_BATCH):
+            candidate['payload'] = edata.pop('payload', furnace_payload.JSON)
+
         if etype == FE:
             tid = self.next_tid
             self.next_tid += 1
             self.timerlist[tid] = candidate
             self.fe_info = candidate
+            if 'workers' in edata:
+                workers = int(edata.pop('workers'))
+                self.start_pool(workers,
+                                edata.pop('worker_type', WORKER_THREAD),
+                                int(edata.pop('max_pending', 4 * workers)))
+            return tid
+
+        elif etype == FE_BATCH:
+            tid = self.next_tid
+            self.next_tid += 1
+            candidate['batch_count'] = int(edata.pop('batch_count', FE_BATCH_COUNT))
+            candidate['batch_bytes'] = int(edata.pop('batch_bytes', FE_BATCH_BYTES))
+            self.timerlist[tid] = candidate
+            self.fe_info = candidate
+            return tid
+
+        elif etype == STREAM:
+            if self.streams is not None:
+                raise Exception('Tenant backend cannot register more than one STREAM callback')
+            tid = self.next_tid
+            self.next_tid += 1
+            self.timerlist[tid] = candidate
+            self.streams = furnace_stream.StreamManager(callback, self.send_stream_ctl, self.tprint,
+                                                        window=int(edata.pop('window', STREAM_WINDOW)))
+            return tid
+
+        elif etype == FE_EVICT:
+            if self.evict_info is not None:
+                raise Exception('Tenant backend cannot register more than one FE_EVICT callback')
+            tid = self.next_tid
+            self.next_tid += 1
+            self.timerlist[tid] = candidate
+            self.evict_info = candidate
+            self.registry.configure(float(edata.pop('heartbeat', FE_HEARTBEAT)),
+                                    float(edata.pop('idle_timeout', FE_IDLE_TIMEOUT)))
             return tid
 
         elif etype == TIMER:
             tid = self.next_tid
             self.next_tid += 1
             candidate['time_value'] = float(edata.pop('time_value'))
+            candidate['oneshot'] = bool(edata.pop('oneshot', False))
+            candidate['mode'] = edata.pop('mode', TIMER_FIXED_RATE)
+            if candidate['mode'] not in (TIMER_FIXED_RATE, TIMER_FIXED_DELAY):
+                raise Exception('unknown timer mode')
+            if candidate['time_value'] <= 0.0 and not candidate['oneshot']:
+                raise Exception('periodic timer time_value must be > 0')
+            default_start = candidate['time_value'] if candidate['oneshot'] else 0.0
             candidate['last_called'] = 0.0
+            candidate['deadline'] = time.monotonic() + float(edata.pop('time_start', default_start))
             self.timerlist[tid] = candidate
+            heapq.heappush(self.timerheap, (candidate['deadline'], tid))
             return tid
 
         else:
@@ -427,6 +1869,127 @@ class BE(furnace_runtime.FurnaceRuntime):
         raise Exception('failed to register event')  # catchall
 
 
+    def wrap_callback(self, etype, callback):
+        """
+        Internal use only.
+        Instruments a tenant callback as it is registered.
+        :param etype: The registration's event type.
+        :param callback: Tenant function.
+        :returns: The function to store in the registration.
+        """
+        if self.metrics is None:
+            return callback
+        name = {FE: 'fe', FE_BATCH: 'fe_batch', STREAM: 'stream', TIMER: 'timer', FE_EVICT: 'fe_evict'}.get(etype, str(etype))
+        return self.metrics.timed(f'{name}:{getattr(callback, "__qualname__", repr(callback))}', callback)
+
+
+    def registry_tick(self, ctx):
+        """
+        Internal use only.
+        Periodic timer that advances the FE registry's wheel and reports evicted apps.
+        :returns: Nothing.
+        """
+        for rec in self.registry.expire(time.monotonic()):
+            self.tprint('info', 'evicting idle app %s after %d msgs', rec.ident, rec.msgs_in)
+            if self.streams is not None:
+                self.streams.drop(rec.ident)
+            self.decoders.drop(rec.ident)
+            if self.evict_info is not None:
+                self.evict_info['callback'](rec)
+
+
+    def kv_get(self, key):
+        """
+        Supported API call.
+        Reads from the same KV store apps reach with Get messages.
+        :param key: String key.
+        :returns: The string value, or None if unset.
+        """
+        return self.kv.get(key)
+
+
+    def kv_set(self, key, value):
+        """
+        Supported API call.
+        Writes to the same KV store apps reach with Set messages.  Persisted on the next flush if the store has a file.
+        From a worker pool thread, the write is queued for the event loop thread.
+        :param key: String key.
+        :param value: String value.
+        :returns: Nothing.
+        """
+        self.check_encoding(key)
+        self.check_encoding(value)
+        if not self.on_loop():
+            return self.defer(self.kv_set, key, value)
+        self.kv.set(key, value)
+
+
+    def send_stats(self):
+        """
+        Supported API call.
+        :returns: Dict of outbound counters: 'drops' (messages to single apps dropped by the send policy),
+            'broadcast_drops' (only counted under SEND_BLOCK), 'queued' (messages waiting for the dealer socket) and
+            'queued_apps' (apps with a backlog).  Per-app drops are in each FERecord.
+        """
+        return {'drops': self.drops,
+                'broadcast_drops': self.broadcast_drops,
+                'queued': sum(len(q) for q in self.outq.values()),
+                'queued_apps': len(self.outq)}
+
+
+    def profile(self, seconds=None, fmt=None):
+        """
+        Supported API call.
+        Profiles the event loop for a time window, e.g. when the tenant receives a control message from an app.  The
+        loop keeps running; the profile is written when the window closes.  Call from the event loop thread.
+        :param seconds: Length of the window, profile_seconds by default.
+        :param fmt: PROFILE_PSTATS (cProfile) or PROFILE_COLLAPSED (sampled stacks), profile_format by default.
+        :returns: Path the profile will be written to.
+        :raises: Exception if a profiling window is already open.
+        """
+        path = self.profiler.start(self.profile_seconds if seconds is None else seconds,
+                                   self.profile_format if fmt is None else fmt)
+        self.control_pending = True
+        self.tprint('info', f'profiling the event loop into {path}')
+        return path
+
+
+    def reload(self, handover=True):
+        """
+        Supported API call.
+        Reloads the tenant's code at the top of the next loop iteration, e.g. when the tenant receives a control message
+        from an app: the tenant's module is re-imported and its class constructed again, while app connections, the FE
+        registry, queued messages and the KV store are kept.  The old app's shutdown() runs once the new app is up.
+        :param handover: If True and the old app has a handover() method, its return value is passed to the new app's
+            constructor as ctx['handover'] (None otherwise).
+        :returns: Nothing.
+        """
+        self.reload_handover = handover
+        self.reload_requested = True
+        self.control_pending = True
+
+
+    def fe_lookup(self, feid):
+        """
+        Supported API call.
+        :param feid: String matching desired app's ID.
+        :returns: The app's FERecord (ident first_seen last_seen msgs_in bytes_in msgs_out bytes_out drops codec state),
+            or None if the app is not registered.  Times are time.monotonic() values.
+        """
+        return self.registry.fes.get(feid.encode())
+
+
+    def fe_list(self, state=None):
+        """
+        Supported API call.
+        :param state: If set, only return apps in this state (FE_ALIVE or FE_SUSPECT).
+        :returns: List of FERecords for the apps currently in the FE registry.
+        """
+        if state is None:
+            return list(self.registry.fes.values())
+        return [rec for rec in self.registry.fes.values() if rec.state == state]
+
+
     def event_clear(self, unsafe_tid):
         """
         Supported API call.
@@ -446,17 +2009,27 @@ class BE(furnace_runtime.FurnaceRuntime):
             self.timerlist[tid]['status'] = INACTIVE
             return True
 
-        elif e['event_type'] == FE:
+        elif e['event_type'] in (FE, FE_BATCH):
             raise Exception('cannot unregister from FE event source')
 
+        elif e['event_type'] == STREAM:
+            raise Exception('cannot unregister from STREAM event source')
+
+        elif e['event_type'] == FE_EVICT:
+            del self.timerlist[tid]
+            self.evict_info = None
+            return True
+
 
-    def log(self, data):
+    def log(self, data, *args):
         """
         Supported API call.
         :param data: Write this data to the backend's logging mechanism.
+        :param args: Optional printf-style arguments for data, e.g. log('got %s from %s', n, ident).  Formatting only
+            happens if the message will actually be written.
         :returns: Nothing.
         """
-        self.tprint('info', str(data))
+        self.tprint('info', data, *args)
 
 
     def set_name(self, name):
@@ -470,7 +2043,7 @@ class BE(furnace_runtime.FurnaceRuntime):
         if 0 < len(name) < 17 \
                 and re.match('^[\w-]+$', name):
             self.name = name
-            self.tprint('debug', 'setting app name to %s' % (name,))
+            self.tprint('debug', 'setting app name to %s', name)
             return
 
         raise Exception('could not set app name, must be alphanum,-,_ and 0 < len(name) < 17')
@@ -499,12 +2072,64 @@ class BE(furnace_runtime.FurnaceRuntime):
         self.already_shutdown = True
         self.tprint('warn', 'shutting down')
         try:
-            self.app.shutdown()
+            if self.app is not None:
+                self.app.shutdown()
         except:
             self.tprint('err', 'error during app shutdown')
             pass
-        self.poller.unregister(self.dealer_be)
+        if self.streams is not None:
+            self.streams.close_all()
+        self.kv.close()
+        if self.capture is not None:
+            self.stop_capture()
+        if self.profiler.prof is not None:
+            self.tprint('info', f'profile written to {self.profiler.stop()}')
+        if self.metrics is not None:
+            self.metrics.shutdown()
+        if self.pool is not None:
+            self.pool.shutdown(wait=False, cancel_futures=True)
+            for fd in self.pool_wakeup:
+                os.close(fd)
+        if self.dealer_flags:
+            self.poller.unregister(self.dealer_be)
         self.pub_be.close()
         self.dealer_be.close()
-        self.context.destroy()
+        if self.auth is not None:
+            self.auth.stop()
+        if self.host is None:  # the host owns a shared context
+            self.context.destroy()
         super(BE, self).shutdown()
+
+
+def load_certificate(path):
+    """
+    Internal use only.
+    zmq.auth.load_certificate, cached per path so a fork server can load the keys once for all of its children.
+    :param path: Key file.
+    :returns: Tuple of (public key, secret key).
+    """
+    keys = _certificates.get(path)
+    if keys is None:
+        keys = _certificates[path] = zmq.auth.load_certificate(path)
+    return keys
+
+
+def _pool_init(callback, context_class, payload):
+    """
+    Internal use only.
+    ProcessPoolExecutor initializer, runs once in each forked worker.
+    """
+    global _pool_callback, _pool_context, _pool_payload
+    _pool_callback = callback
+    _pool_context = context_class
+    _pool_payload = payload
+
+
+def _pool_call(args):
+    """
+    Internal use only.
+    Runs in a pool process.
+    :param args: List of (ident, sync, message, data) tuples.
+    :returns: List of callback return values.
+    """
+    return [_pool_callback(_pool_context(*a, body=furnace_payload.body(_pool_payload, a[2], a[3]))) for a in args]
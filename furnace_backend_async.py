@@ -0,0 +1,400 @@
+#-------------------------
+# Furnace (c) 2017-2018 Micah Bushouse
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#-------------------------
+"""
+asyncio flavor of the Furnace backend.  FE and TIMER callbacks may be coroutine functions.
+"""
+
+import asyncio
+import inspect
+import threading
+
+# 3p
+import zmq
+import zmq.asyncio
+
+# internal
+from constants import *
+import furnace_backend
+import facilities_pb2
+
+
+class AsyncBE(furnace_backend.BE):
+    """
+    Furnace backend driven by an asyncio event loop instead of a zmq.Poller.
+    Plain callbacks run inline, exactly as in BE.  Coroutine callbacks run as tasks, so a slow handler
+    does not hold up other frontends; SYNC replies are sent whenever the coroutine completes.
+    Note that bei.context is a zmq.asyncio.Context in this mode.
+    """
+
+    def __init__(self, kp, **kwargs):
+        """
+        Constructor, ZMQ connections are built by BE and then shadowed by asyncio sockets.
+        :param kp: The keypair to use, in the form {'be_key': '[path]', 'app_key': '[path]'}
+        :param kwargs: Passed to BE.
+        """
+        super(AsyncBE, self).__init__(kp, **kwargs)
+
+        # the authenticator thread keeps using the original context, everything else goes through asyncio
+        self.sync_context = self.context
+        self.sync_dealer_be = self.dealer_be
+        self.sync_pub_be = self.pub_be
+        self.context = zmq.asyncio.Context.shadow(self.sync_context.underlying)
+        self.dealer_be = zmq.asyncio.Socket.from_socket(self.sync_dealer_be)
+        self.pub_be = zmq.asyncio.Socket.from_socket(self.sync_pub_be)
+        self.dealer_sync = self.sync_dealer_be
+
+        self.tasks = set()
+        self.outq_task = None
+        self.pool_tasks = set()
+        self.fe_tasks = set()  # coroutine FE/FE_BATCH dispatches in flight
+        self.fe_max_pending = ASYNC_MAX_PENDING
+        self.timer_wakeup = None
+        self.aio_loop = None  # the running asyncio loop, see defer
+
+
+    def event_register(self, edata):
+        """
+        Supported API call.
+        Same as BE.event_register.  A coroutine TIMER callback is started as a task each time the timer fires.
+        A coroutine FE or FE_BATCH callback runs as one task per packet; a registration without 'workers' may include
+        'max_pending': (int) packets in flight before the backend stops reading from FEs (default: ASYNC_MAX_PENDING).
+        """
+        if edata.get('event_type') in (FE, FE_BATCH) and 'workers' not in edata:
+            self.fe_max_pending = int(edata.pop('max_pending', ASYNC_MAX_PENDING))
+        tid = super(AsyncBE, self).event_register(edata)
+        if self.timer_wakeup is not None:
+            self.timer_wakeup.set()
+        return tid
+
+
+    def wrap_callback(self, etype, callback):
+        """
+        Internal use only.
+        Coroutine TIMER callbacks are wrapped to start a task, since run_timers calls them synchronously.
+        """
+        callback = super(AsyncBE, self).wrap_callback(etype, callback)
+        if etype == TIMER and inspect.iscoroutinefunction(callback):
+            return lambda d: self.spawn(callback(d))
+        return callback
+
+
+    def loop(self):
+        """
+        Internal use only.
+        Runs aloop until the process exits.
+        :returns: Nothing.
+        """
+        asyncio.run(self.aloop())
+
+
+    async def aloop(self):
+        """
+        Internal use only.
+        Main event loop.  Awaits data from tenant apps while the timer task runs alongside.
+        With phase timing on, the poll phase holds the recv and any other task that ran while it was awaited, except
+        timers.
+        Coroutine callbacks are not split into phases.
+        :returns: Nothing.
+        """
+        self.timer_wakeup = asyncio.Event()
+        self.aio_loop = asyncio.get_running_loop()
+        self.loop_thread = threading.get_ident()
+        self.spawn(self.atimers())
+        fe_info = None
+
+        while True:
+            if self.pool_tasks and self.pool_pending >= self.pool_max_pending:  # backpressure
+                await asyncio.wait(self.pool_tasks, return_when=asyncio.FIRST_COMPLETED)
+            while len(self.fe_tasks) >= self.fe_max_pending:  # same for coroutine callbacks
+                await asyncio.wait(self.fe_tasks, return_when=asyncio.FIRST_COMPLETED)
+
+            pt = self.phases
+            if pt is not None:
+                pt.start()
+            pkt = await self.dealer_be.recv_multipart()
+            if pt is not None:
+                pt.mark('poll')
+            self.msgin += 1
+            t0 = self.fe_in(pkt)
+            if self.fe_info is not fe_info:  # first packet, or the tenant was reloaded while we waited
+                fe_info = self.fe_info
+                fe_coro = inspect.iscoroutinefunction(fe_info['callback'])
+                fe_batch = fe_info['event_type'] == FE_BATCH
+
+            if fe_batch:
+                pkts = [pkt] + self.recv_batch_nowait(self.fe_info['batch_count'] - 1)
+                ctx_list, spans = self.batch_contexts(pkts)
+                if not ctx_list:
+                    self.send_batch_replies(ctx_list, spans, [])
+                elif fe_coro:
+                    self.spawn_fe(self.adispatch_batch(ctx_list, spans))
+                else:
+                    ret_list = None
+                    try:
+                        ret_list = self.fe_info['callback'](ctx_list)
+                        self.send_batch_replies(ctx_list, spans, ret_list)
+                    except Exception as e:
+                        self.tprint('error', 'FE_BATCH callback failed: %r', e)
+                        self.send_batch_failures(spans, ret_list, e)
+
+            elif len(pkt) == 3:  # SYNC message, FE is blocked until our reply
+                ident, empty, raw_msg = pkt
+                if fe_coro:
+                    self.spawn_fe(self.adispatch(ident, SYNC, raw_msg, t0))
+                elif self.pool is not None:
+                    task = self.spawn(self.apool(ident, raw_msg, t0))
+                    self.pool_tasks.add(task)
+                    task.add_done_callback(self.pool_tasks.discard)
+                else:
+                    self.msg_in.ParseFromString(raw_msg)
+                    if pt is not None:
+                        pt.mark('parse')
+                    raw_out = self.dispatch_sync(ident.decode())
+                    if pt is not None:
+                        pt.mark('serialize')
+                    self.send_sync(ident, raw_out, t0)
+                    if pt is not None:
+                        pt.mark('send')
+
+            elif len(pkt) == 2:  # ASYNC message from FE
+                ident, raw_msg = pkt
+                if fe_coro:
+                    self.spawn_fe(self.adispatch(ident, ASYNC, raw_msg))
+                else:
+                    self.msg_in.ParseFromString(raw_msg)
+                    if pt is not None:
+                        pt.mark('parse')
+                    self.dispatch_async(ident.decode())
+                    if pt is not None:
+                        pt.mark('callback')
+
+            self.tick += 1
+
+
+    async def atimers(self):
+        """
+        Internal use only.
+        Fires timers from the shared heap, sleeping until the next deadline or a new registration.
+        :returns: Nothing.
+        """
+        while True:
+            self.timer_wakeup.clear()
+            try:
+                await asyncio.wait_for(self.timer_wakeup.wait(), self.next_timeout() / 1000)
+            except asyncio.TimeoutError:
+                pass
+            if self.control_pending:
+                self.control()
+            pt = self.phases
+            if pt is not None:
+                pt.start()
+            self.run_timers()
+            if pt is not None:
+                pt.mark('timers')
+
+
+    async def adispatch(self, ident, sync, raw_msg, t0=None):
+        """
+        Internal use only.
+        Awaits the coroutine FE callback for every be_msg in one packet, then replies if the FE is blocked.  If a
+        callback raises or returns something that cannot be sent, the be_msgs left without a reply get VMI_FAILURE.
+        :param ident: Raw ident frame of the sending app.
+        :param sync: SYNC or ASYNC.
+        :param raw_msg: The raw protobuf.
+        :param t0: Arrival time for the SYNC round trip metric, or None.
+        :returns: Nothing.
+        """
+        msg_in = facilities_pb2.FacMessage()  # private copy, self.msg_in is reused while we are suspended
+        msg_in.ParseFromString(raw_msg)
+        ident_str = ident.decode()
+        fac_out = self.facility_ops(ident_str, sync, msg_in)
+        callback = self.fe_info['callback']
+
+        # built before the first await, so payloads are decompressed in arrival order
+        ctx_list = [self.make_ctx(ident_str, sync, submsg) for submsg in self.app_msgs(ident_str, msg_in)]
+        ret_list = []
+        try:
+            for ctx in ctx_list:
+                ret_list.append(await callback(ctx))
+            if sync == SYNC:
+                raw_out = fac_out + self.build_sync_reply(ret_list)
+        except Exception as e:
+            if sync != SYNC:
+                raise  # reported by task_done
+            self.tprint('error', 'FE callback for %s failed: %r', ident_str, e)
+            raw_out = fac_out + self.build_failure_reply(ret_list, len(ctx_list), e)
+
+        if sync == SYNC:
+            self.send_sync(ident, raw_out, t0)
+
+
+    async def apool(self, ident, raw_msg, t0=None):
+        """
+        Internal use only.
+        Runs the FE callback for one SYNC packet on the worker pool and replies when it finishes.
+        :param ident: Raw ident frame of the sending app.
+        :param raw_msg: The raw protobuf.
+        :param t0: Arrival time for the SYNC round trip metric, or None.
+        :returns: Nothing.
+        """
+        future = self.pool_submit(ident, raw_msg)
+        try:
+            await asyncio.wrap_future(future)
+        except Exception:
+            pass  # reported by pool_reply
+        finally:
+            self.pool_pending -= 1
+        self.send_sync(ident, self.pool_reply(ident, future), t0)
+
+
+    async def adispatch_batch(self, ctx_list, spans):
+        """
+        Internal use only.
+        Awaits the coroutine FE_BATCH callback, then replies to each SYNC packet in the batch.  If the callback
+        raises or its replies cannot be sent, every SYNC packet is answered with VMI_FAILURE where it has no reply.
+        :param ctx_list: List of ctx, from batch_contexts.
+        :param spans: Packet spans, from batch_contexts.
+        :returns: Nothing.
+        """
+        ret_list = None
+        try:
+            ret_list = await self.fe_info['callback'](ctx_list)
+            self.send_batch_replies(ctx_list, spans, ret_list)
+        except Exception as e:
+            self.tprint('error', 'FE_BATCH callback failed: %r', e)
+            self.send_batch_failures(spans, ret_list, e)
+
+
+    def defer(self, fn, *args):
+        """
+        Internal use only.
+        Same as BE.defer, but wakes the asyncio loop instead of the pool's wakeup pipe.
+        """
+        self.loop_calls.append((fn, args))
+        self.aio_loop.call_soon_threadsafe(self.run_deferred)
+
+
+    def recv_batch_nowait(self, max_count):
+        """
+        Internal use only.
+        Drains up to max_count further packets without awaiting, honoring the FE_BATCH byte budget.
+        :param max_count: Max number of packets to return.
+        :returns: List of raw multipart packets.
+        """
+        max_bytes = self.fe_info['batch_bytes']
+        pkts = []
+        nbytes = 0
+        while len(pkts) < max_count and nbytes < max_bytes:
+            try:
+                # NOBLOCK calls on an asyncio socket complete immediately
+                pkt = self.dealer_be.recv_multipart(flags=zmq.NOBLOCK).result()
+            except zmq.Again:
+                break
+            pkts.append(pkt)
+            nbytes += len(pkt[-1])
+            self.fe_in(pkt)
+        self.msgin += len(pkts)
+        return pkts
+
+
+    def try_send(self, sock, frames, copy=True):
+        """
+        Internal use only.
+        Same as BE.try_send.  Non-blocking sends on an asyncio socket complete immediately, so their future is already done.
+        """
+        if not isinstance(sock, zmq.asyncio.Socket):
+            return super(AsyncBE, self).try_send(sock, frames, copy)
+        exc = sock.send_multipart(frames, flags=zmq.NOBLOCK, copy=copy).exception()
+        if isinstance(exc, zmq.Again):
+            return False
+        if exc is not None:
+            raise exc
+        return True
+
+
+    def dealer_poll(self):
+        """
+        Internal use only.
+        Starts the flush task while messages are queued, in place of BE's poller registration.
+        :returns: Nothing.
+        """
+        if self.outq and self.outq_task is None:
+            self.outq_task = self.spawn(self.aflush())
+
+
+    async def aflush(self):
+        """
+        Internal use only.
+        Flushes the outbound queues whenever the dealer socket has room, until they are empty.
+        :returns: Nothing.
+        """
+        try:
+            while self.outq:
+                await self.dealer_be.poll(flags=zmq.POLLOUT)
+                self.flush_outq()
+        finally:
+            self.outq_task = None
+
+
+    def spawn(self, coro):
+        """
+        Internal use only.
+        Starts coro as a task, holding a reference until it finishes and logging any exception it raises.
+        :param coro: Coroutine to run.
+        :returns: The task.
+        """
+        task = asyncio.ensure_future(coro)
+        self.tasks.add(task)
+        task.add_done_callback(self.task_done)
+        return task
+
+
+    def spawn_fe(self, coro):
+        """
+        Internal use only.
+        Starts a coroutine FE or FE_BATCH dispatch, counted against fe_max_pending.
+        :param coro: Coroutine to run.
+        :returns: The task.
+        """
+        task = self.spawn(coro)
+        self.fe_tasks.add(task)
+        task.add_done_callback(self.fe_tasks.discard)
+        return task
+
+
+    def task_done(self, task):
+        """
+        Internal use only.
+        Done callback for tasks started by spawn.
+        :param task: The finished task.
+        :returns: Nothing.
+        """
+        self.tasks.discard(task)
+        if not task.cancelled() and task.exception() is not None:
+            self.tprint('error', 'callback task failed: %r', task.exception())
+
+
+    def shutdown(self):
+        """
+        Supported API call.
+        Exit cleanly.  Hands the original sockets and context back to BE.shutdown for teardown.
+        :returns: Nothing.
+        """
+        self.context = getattr(self, 'sync_context', self.context)
+        self.dealer_be = getattr(self, 'sync_dealer_be', self.dealer_be)
+        self.pub_be = getattr(self, 'sync_pub_be', self.pub_be)
+        super(AsyncBE, self).shutdown()
@@ -0,0 +1,206 @@
+#-------------------------
+# Furnace (c) 2017-2018 Micah Bushouse
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#-------------------------
+"""
+Capture log of the packets apps send to a backend, for replay with furnace_replay.
+
+Layout: a header, then one record per packet, then an index and a trailer once the capture is closed.
+    header   HEADER: magic, version, wall clock time the capture started
+    record   RECORD: wall clock time, flags (CAPTURE_SYNC), ident length, protobuf length; then the ident, then the
+             raw protobuf exactly as received
+    index    INDEX_ENTRY every CAPTURE_INDEX_EVERY records: record number, file offset, time
+    trailer  TRAILER: index offset, record count, magic
+A capture cut short (crash, kill -9) has no trailer; the reader then scans the records and drops a torn last one.
+The writer flushes at most every CAPTURE_FLUSH_INTERVAL, when a packet arrives.
+"""
+
+import bisect
+import struct
+import time
+
+# internal
+from constants import *
+
+MAGIC = b'FCAP'
+INDEX_MAGIC = b'FIDX'
+VERSION = 1
+HEADER = struct.Struct('<4sHd')
+RECORD = struct.Struct('<dBHI')
+INDEX_ENTRY = struct.Struct('<QQd')
+TRAILER = struct.Struct('<QQ4s')
+
+CAPTURE_SYNC = 0x01  # record flag, the packet was SYNC (ident, empty frame, protobuf)
+
+
+class CaptureWriter(object):
+    """
+    Appends packets to a capture file.  Only used by the event loop.
+    """
+
+    def __init__(self, path, max_bytes=CAPTURE_MAX_BYTES):
+        """
+        :param path: Capture file, truncated if it exists.
+        :param max_bytes: Stop accepting packets once the file would grow past this.
+        """
+        self.path = path
+        self.max_bytes = max_bytes
+        self.f = open(path, 'wb', buffering=CAPTURE_BUFFER)
+        self.f.write(HEADER.pack(MAGIC, VERSION, time.time()))
+        self.f.flush()  # an empty capture is still a valid one
+        self.offset = HEADER.size
+        self.count = 0
+        self.flushed = time.time()
+        self.index = []  # (record number, offset, time) every CAPTURE_INDEX_EVERY records
+
+
+    def write(self, pkt, ts=None):
+        """
+        :param pkt: Raw multipart packet as received from the dealer socket, ident first.
+        :param ts: time.time() of arrival, now by default.
+        :returns: True if written, False if the capture is full.
+        """
+        ident = pkt[0]
+        raw = pkt[-1]
+        size = RECORD.size + len(ident) + len(raw)
+        if self.offset + size > self.max_bytes:
+            return False
+        if ts is None:
+            ts = time.time()
+        if not self.count % CAPTURE_INDEX_EVERY:
+            self.index.append((self.count, self.offset, ts))
+        self.f.writelines((RECORD.pack(ts, CAPTURE_SYNC if len(pkt) == 3 else 0, len(ident), len(raw)), ident, raw))
+        self.offset += size
+        self.count += 1
+        if ts - self.flushed >= CAPTURE_FLUSH_INTERVAL:
+            self.f.flush()
+            self.flushed = ts
+        return True
+
+
+    def close(self):
+        """
+        Writes the index and trailer.
+        :returns: Nothing.
+        """
+        if self.f.closed:
+            return
+        self.f.writelines(INDEX_ENTRY.pack(*entry) for entry in self.index)
+        self.f.write(TRAILER.pack(self.offset, self.count, INDEX_MAGIC))
+        self.f.close()
+
+
+class CaptureReader(object):
+    """
+    Reads a capture file back in order, or from any record or time.
+    """
+
+    def __init__(self, path):
+        """
+        :param path: Capture file.
+        :raises: Exception if path is not a capture.
+        """
+        self.path = path
+        self.f = open(path, 'rb', buffering=CAPTURE_BUFFER)
+        magic, version, self.start_time = HEADER.unpack(self.f.read(HEADER.size))
+        if magic != MAGIC or version != VERSION:
+            raise Exception(f'{path} is not a version {VERSION} capture')
+        self.f.seek(0, 2)
+        size = self.f.tell()
+        self.end = size  # offset past the last record
+        self.count = None
+        self.index = []
+        if size >= HEADER.size + TRAILER.size:
+            self.f.seek(size - TRAILER.size)
+            index_offset, count, magic = TRAILER.unpack(self.f.read(TRAILER.size))
+            if magic == INDEX_MAGIC:
+                self.end = index_offset
+                self.count = count
+                self.f.seek(index_offset)
+                raw = self.f.read(size - TRAILER.size - index_offset)
+                self.index = list(INDEX_ENTRY.iter_unpack(raw))
+        if self.count is None:
+            self.scan()
+
+
+    def scan(self):
+        """
+        Internal use only.
+        Rebuilds the count and index of a capture without a trailer, stopping at a torn record.
+        :returns: Nothing.
+        """
+        self.f.seek(HEADER.size)
+        offset = HEADER.size
+        count = 0
+        while True:
+            head = self.f.read(RECORD.size)
+            if len(head) < RECORD.size:
+                break
+            ts, flags, ident_len, raw_len = RECORD.unpack(head)
+            size = RECORD.size + ident_len + raw_len
+            if offset + size > self.end:
+                break
+            if not count % CAPTURE_INDEX_EVERY:
+                self.index.append((count, offset, ts))
+            self.f.seek(ident_len + raw_len, 1)
+            offset += size
+            count += 1
+        self.end = offset
+        self.count = count
+
+
+    def __len__(self):
+        return self.count
+
+
+    def find(self, ts):
+        """
+        :param ts: time.time() value.
+        :returns: Number of the first record at or after ts, or len(self) if there is none.
+        """
+        i = bisect.bisect_right([entry[2] for entry in self.index], ts) - 1
+        start = self.index[i][0] if i >= 0 else 0
+        for n, (rec_ts, pkt) in enumerate(self.records(start), start):
+            if rec_ts >= ts:
+                return n
+        return self.count
+
+
+    def records(self, start=0):
+        """
+        :param start: Number of the first record to read.
+        :returns: Generator of (time.time() of arrival, packet), where packet is the multipart packet as the dealer
+            socket delivered it: [ident, b'', raw] for SYNC, [ident, raw] for ASYNC.
+        """
+        if start >= self.count:
+            return
+        entry = self.index[min(start // CAPTURE_INDEX_EVERY, len(self.index) - 1)]
+        n, offset = entry[0], entry[1]
+        f = self.f
+        f.seek(offset)
+        while offset < self.end:
+            ts, flags, ident_len, raw_len = RECORD.unpack(f.read(RECORD.size))
+            offset += RECORD.size + ident_len + raw_len
+            if n < start:
+                f.seek(ident_len + raw_len, 1)
+            else:
+                ident = f.read(ident_len)
+                raw = f.read(raw_len)
+                yield ts, [ident, b'', raw] if flags & CAPTURE_SYNC else [ident, raw]
+            n += 1
+
+
+    def close(self):
+        self.f.close()
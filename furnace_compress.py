@@ -0,0 +1,168 @@
+#-------------------------
+# Furnace (c) 2017-2018 Micah Bushouse
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#-------------------------
+"""
+Compression of be_msg binary payloads, negotiated per app.
+zlib is always available; lz4 and zstd are offered when the lz4 or zstandard package is installed.
+
+An app lists the codecs it can decode in FacMessage.codecs, preferred first, and the backend answers with the first
+one it also has.  After that, either side may compress the data field of a be_msg and mark it with Be_msg.codec.
+The backend compresses each outbound payload as a self-contained frame, so dropped messages and broadcasts never
+break decoding.  Inbound payloads go through one decompressor per app, so an app may either send self-contained
+frames or one long compressed stream flushed at message boundaries (e.g. zlib Z_SYNC_FLUSH).
+"""
+
+import zlib
+
+try:
+    import lz4.frame
+except ImportError:
+    lz4 = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# internal
+from constants import *
+
+
+class Codec(object):
+    """
+    One compression library.
+    """
+
+    def __init__(self, cid, name, compress, decompressor):
+        """
+        :param cid: Wire ID, one of the CODEC_ constants.
+        :param name: Library name, for logs.
+        :param compress: Function of bytes returning one self-contained compressed frame.
+        :param decompressor: Function returning a streaming decompressor with decompress(data, max_length) and eof.
+        """
+        self.cid = cid
+        self.name = name
+        self.compress = compress
+        self.decompressor = decompressor
+
+
+class _ZstdDecompressor(object):
+    """
+    Internal use only.
+    Gives zstandard's decompressobj the zlib-style interface.  zstd has no output cap, Decoders checks the size after.
+    """
+
+    def __init__(self):
+        self.dobj = zstandard.ZstdDecompressor().decompressobj()
+
+    def decompress(self, data, max_length):
+        return self.dobj.decompress(data)
+
+    @property
+    def eof(self):
+        return getattr(self.dobj, 'eof', False)
+
+
+# codecs available in this process, by wire ID
+CODECS = {CODEC_ZLIB: Codec(CODEC_ZLIB, 'zlib', lambda data: zlib.compress(data, 1), zlib.decompressobj)}
+if lz4 is not None:
+    CODECS[CODEC_LZ4] = Codec(CODEC_LZ4, 'lz4', lz4.frame.compress, lz4.frame.LZ4FrameDecompressor)
+if zstandard is not None:
+    CODECS[CODEC_ZSTD] = Codec(CODEC_ZSTD, 'zstd', zstandard.ZstdCompressor().compress, _ZstdDecompressor)
+
+
+def choose(offered):
+    """
+    :param offered: Codec IDs an app can decode, preferred first.
+    :returns: The first offered codec available here, or CODEC_NONE.
+    """
+    for cid in offered:
+        if cid in CODECS:
+            return cid
+    return CODEC_NONE
+
+
+def compress(cid, data, min_bytes=COMPRESS_MIN_BYTES):
+    """
+    :param cid: The codec negotiated with the receiver, or CODEC_NONE.
+    :param data: bytes payload.
+    :param min_bytes: Payloads below this size are not worth compressing.
+    :returns: Tuple of (payload, codec), where codec is None if payload is data unchanged.  Payloads that do not
+        shrink are sent unchanged.
+    """
+    if cid == CODEC_NONE or len(data) < min_bytes:
+        return data, None
+    out = CODECS[cid].compress(data)
+    if len(out) >= len(data):
+        return data, None
+    return out, cid
+
+
+class Decoders(object):
+    """
+    One inbound decompression context per app.  Only used by the event loop.
+    """
+
+    def __init__(self, max_raw=COMPRESS_MAX_RAW):
+        """
+        :param max_raw: Largest decompressed payload accepted, so a small packet cannot balloon in memory.
+        """
+        self.max_raw = max_raw
+        self.streams = {}  # app ID -> (codec ID, decompressor)
+
+
+    def decompress(self, ident, cid, data):
+        """
+        Decompresses one payload, continuing the app's stream if it has one open.  A stream that reached its end
+        (every self-contained frame does) is replaced on the next payload, and a payload that does not continue the
+        open stream is retried as the start of a new one.
+        :param ident: String ID of the sending app.
+        :param cid: Be_msg.codec of the payload.
+        :param data: Compressed bytes.
+        :returns: The decompressed bytes.
+        :raises: Exception for an unknown codec, a corrupt payload, or one larger than max_raw once decompressed.
+        """
+        codec = CODECS.get(cid)
+        if codec is None:
+            raise Exception(f'codec {cid} not available')
+        entry = self.streams.get(ident)
+        if entry is not None and entry[0] == cid and not entry[1].eof:
+            try:
+                out = entry[1].decompress(data, self.max_raw + 1)
+            except Exception:
+                entry = None
+        else:
+            entry = None
+        if entry is None:
+            entry = self.streams[ident] = (cid, codec.decompressor())
+            try:
+                out = entry[1].decompress(data, self.max_raw + 1)
+            except Exception:
+                del self.streams[ident]
+                raise
+        if len(out) > self.max_raw:
+            del self.streams[ident]
+            raise Exception(f'{codec.name} payload expands beyond {self.max_raw}B')
+        return out
+
+
+    def drop(self, ident):
+        """
+        Forgets an app's decompression context.
+        :param ident: String ID of the app.
+        :returns: Nothing.
+        """
+        self.streams.pop(ident, None)
@@ -0,0 +1,219 @@
+#-------------------------
+# Furnace (c) 2017-2018 Micah Bushouse
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#-------------------------
+"""
+Fork server.  One process imports the backend's dependencies and loads its CURVE keys once, then keeps warm children
+forked and waiting.  A start request hands a bemain command line to a waiting child, which only has to bind its ports
+and import the tenant.
+
+Requests and replies are one JSON line each over a Unix socket: {"argv": [...], "cwd": "..."} is answered with
+{"pid": N} or {"error": "..."}.  No ZMQ context or thread may exist in the server, since neither survives a fork.
+"""
+
+import json
+import os
+import select
+import socket
+import sys
+import time
+import traceback
+
+# internal
+from constants import *
+import furnace_backend
+import furnace_profile
+import facilities_pb2
+
+
+class ForkServer(object):
+    """
+    Accepts start requests and keeps warm children ready.
+    """
+
+    def __init__(self, path, start, warm=FORK_WARM):
+        """
+        :param path: Unix socket to listen on.  A stale socket file is replaced.
+        :param start: Function (argv, StartupTimer) that a child runs to become a backend, e.g. bemain.main.
+        :param warm: Number of idle children kept forked, at least 1.
+        """
+        self.path = path
+        self.start = start
+        self.warm = max(1, warm)
+        self.idle = []  # (pid, write end of the child's request pipe)
+        self.listener = None
+
+
+    def preload(self, key_paths):
+        """
+        Does the work every backend would otherwise repeat before its tenant runs.  Modules were already imported
+        with this one.
+        :param key_paths: CURVE key files to load into furnace_backend's certificate cache.  Missing files are skipped.
+        :returns: Nothing.
+        """
+        for path in key_paths:
+            if path and os.path.isfile(path):
+                furnace_backend.load_certificate(path)
+        # first use of the protobuf runtime builds the message classes
+        msg = facilities_pb2.FacMessage()
+        msg.ParseFromString(msg.SerializeToString())
+
+
+    def fork_child(self):
+        """
+        Internal use only.
+        Forks one warm child, which blocks until it is handed a request.
+        :returns: Nothing.
+        """
+        r, w = os.pipe()
+        sys.stdout.flush()  # or the child repeats buffered output
+        sys.stderr.flush()
+        pid = os.fork()
+        if pid == 0:
+            os.close(w)
+            self.listener.close()
+            for _, fd in self.idle:  # siblings' pipes, so each child sees EOF when the server exits
+                os.close(fd)
+            self.run_child(r)
+            sys.exit(0)  # runs atexit handlers, e.g. BE.shutdown
+        os.close(r)
+        self.idle.append((pid, w))
+
+
+    def run_child(self, r):
+        """
+        Internal use only.
+        Body of a warm child: waits for a request, then becomes a backend.  Never returns into the server loop.
+        :param r: Read end of the request pipe.
+        :returns: Only when the backend exits.
+        """
+        with os.fdopen(r) as f:
+            line = f.readline()
+        if not line:  # the server went away
+            os._exit(0)
+        req = json.loads(line)
+        startup = furnace_profile.StartupTimer(req['t0'])
+        startup.mark('handoff')
+        try:
+            os.setsid()  # outlives the server and its process group
+            os.chdir(req.get('cwd') or '.')
+            self.start(req['argv'], startup)
+        except SystemExit:
+            raise
+        except BaseException:
+            traceback.print_exc()
+            sys.exit(1)
+
+
+    def reap(self):
+        """
+        Internal use only.
+        Collects exited children, and drops warm ones that died before being used.
+        :returns: Nothing.
+        """
+        while True:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                return
+            if pid == 0:
+                return
+            for entry in self.idle:
+                if entry[0] == pid:
+                    self.idle.remove(entry)
+                    os.close(entry[1])
+                    print(f'forkserver: warm child {pid} exited early')
+                    break
+
+
+    def handle(self, conn):
+        """
+        Internal use only.
+        Serves one start request.  A client that does not send its request within FORK_READ_TIMEOUT is dropped, so
+        it cannot hold up the requests behind it.
+        :param conn: Accepted client socket.
+        :returns: Nothing.
+        """
+        t0 = time.monotonic()
+        conn.settimeout(FORK_READ_TIMEOUT)
+        with conn, conn.makefile('rwb') as f:
+            try:
+                line = f.readline(FORK_MAX_REQUEST)
+            except OSError as e:  # includes socket.timeout
+                print(f'forkserver: dropping client: {e!r}')
+                return
+            try:
+                req = json.loads(line)
+                argv = [str(arg) for arg in req['argv']]
+            except Exception as e:
+                f.write(json.dumps({'error': f'bad request: {e}'}).encode() + b'\n')
+                return
+            if not self.idle:  # refilled before each accept, so only if a warm child just died
+                f.write(json.dumps({'error': 'no warm child ready, retry'}).encode() + b'\n')
+                return
+            pid, w = self.idle.pop(0)
+            os.write(w, json.dumps({'argv': argv, 'cwd': req.get('cwd'), 't0': t0}).encode() + b'\n')
+            os.close(w)
+            print(f'forkserver: started {pid}: {" ".join(argv)}')
+            f.write(json.dumps({'pid': pid}).encode() + b'\n')
+
+
+    def serve(self):
+        """
+        Listens for start requests forever, refilling the warm children after each one.
+        :returns: Nothing.
+        """
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+        self.listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        umask = os.umask(0o177)  # the socket is created 0600, never briefly open to others
+        try:
+            self.listener.bind(self.path)
+        finally:
+            os.umask(umask)
+        self.listener.listen(64)
+        print(f'forkserver: listening on {self.path}, {self.warm} warm children')
+        while True:
+            self.reap()
+            while len(self.idle) < self.warm:
+                self.fork_child()
+            ready, _, _ = select.select([self.listener], [], [], 1.0)
+            if ready:
+                conn, _ = self.listener.accept()
+                try:
+                    self.handle(conn)
+                except OSError as e:  # the client went away before its reply
+                    print(f'forkserver: client error: {e!r}')
+
+
+def spawn(path, argv, timeout=FORK_TIMEOUT):
+    """
+    Asks a fork server to start a backend.
+    :param path: The server's Unix socket.
+    :param argv: bemain command line, without the program name.
+    :param timeout: Seconds to wait for the server.
+    :returns: pid of the new backend.
+    :raises: Exception if the server refused the request.
+    """
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.settimeout(timeout)
+        sock.connect(path)
+        with sock.makefile('rwb') as f:
+            f.write(json.dumps({'argv': list(argv), 'cwd': os.getcwd()}).encode() + b'\n')
+            f.flush()
+            reply = json.loads(f.readline())
+    if 'error' in reply:
+        raise Exception(f'fork server: {reply["error"]}')
+    return reply['pid']
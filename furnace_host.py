@@ -0,0 +1,238 @@
+#-------------------------
+# Furnace (c) 2017-2018 Micah Bushouse
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#-------------------------
+"""
+Multi-tenant host.  Runs many tenant backends in one process, sharing a ZMQ context, CURVE authenticator thread,
+poller, logger and event loop.  Each tenant keeps its own ports, API handle, registry, queues and KV store.
+"""
+
+import json
+import os
+import signal
+import threading
+
+# 3p
+import zmq
+import zmq.auth
+from zmq.auth.thread import ThreadAuthenticator
+
+# internal
+from constants import *
+import furnace_backend
+import furnace_runtime
+
+# host config key -> BE constructor argument
+TENANT_KEYS = {'ep': 'be_ip', 'et': 'be_base_port', 'ipc': 'ipc_dir'}
+
+
+class Host(furnace_runtime.FurnaceRuntime):
+    """
+    Owns the shared resources and runs one event loop over every tenant's sockets.
+    Before running a tenant's events, the host points the furnace_backend module API (be.notify, be.log, ...) at that
+    tenant, so single-tenant backends run unchanged.  Code running outside the event loop thread, e.g. on a worker
+    pool, must use the tenant's own handle, ctx['be'] in its constructor.
+    """
+
+    def __init__(self, debug=False, log_file=None, profile_dir=None, hot_reload=False):
+        """
+        :param profile_dir: If set, SIGUSR1 profiles the shared event loop (through the first tenant's profiler) and
+            SIGUSR2 logs and resets every tenant's phase timings.  See BE.
+        :param hot_reload: If True, SIGHUP reloads every tenant.  A single tenant can still reload itself with reload().
+        """
+        super(Host, self).__init__(debug=debug, log_file=log_file)
+        self.name = 'host'
+        self.already_shutdown = False
+        self.context = zmq.Context(io_threads=2)
+        self.poller = zmq.Poller()
+        self.auth = None  # started with the first CURVE tenant
+        self.tenants = {}  # name -> BE
+        self.current = None  # tenant the module API points at
+
+        signals = [signal.SIGUSR1, signal.SIGUSR2] if profile_dir is not None else []
+        if hot_reload:
+            signals.append(signal.SIGHUP)
+        if signals:
+            if threading.current_thread() is threading.main_thread():
+                for signum in signals:
+                    signal.signal(signum, self.control_signal)
+            else:
+                self.tprint('warning', 'profiling signals can only be installed from the main thread')
+
+
+    def start_auth(self):
+        """
+        Internal use only.
+        Starts the CURVE authenticator on first use.  One ZAP handler serves every tenant's sockets in the context.
+        :returns: Nothing.
+        """
+        if self.auth is None:
+            self.auth = ThreadAuthenticator(self.context)
+            self.auth.start()
+            self.auth.configure_curve(domain='*', location=zmq.auth.CURVE_ALLOW_ANY)
+
+
+    def add(self, kp, name, **be_kwargs):
+        """
+        Builds one tenant's backend on the shared resources.
+        :param kp: The tenant's keypair, see BE.  Unused with ipc_dir.
+        :param name: Unique tenant name, used as its log prefix.
+        :param be_kwargs: Passed to BE (be_ip, be_base_port or ipc_dir, sndhwm, ...).
+        :returns: The tenant's BE, not yet running a tenant.
+        :raises: Exception if name is already in use.
+        """
+        if name in self.tenants:
+            raise Exception(f'duplicate tenant name {name}')
+        bei = self.tenants[name] = furnace_backend.BE(kp, host=self, tenant_name=name, **be_kwargs)
+        return bei
+
+
+    def activate(self, bei):
+        """
+        Internal use only.
+        Points the furnace_backend module API at bei.
+        :returns: Nothing.
+        """
+        if self.current is not bei:
+            bei.module_register()
+            self.current = bei
+
+
+    def control_signal(self, signum, frame):
+        """
+        Internal use only.
+        SIGUSR1/SIGUSR2/SIGHUP handler.  The loop is shared, so one tenant's profiler covers all of them.
+        :returns: Nothing.
+        """
+        targets = list(self.tenants.values())
+        for bei in targets[:1] if signum == signal.SIGUSR1 else targets:
+            bei.control_signal(signum, frame)
+
+
+    def loop(self):
+        """
+        Internal use only.
+        Shared event loop.  Polls every tenant's sockets at once, with the earliest of their timer deadlines as the
+        timeout, then steps each tenant in turn.
+        :returns: Nothing.
+        """
+        tenants = list(self.tenants.values())
+        if not tenants:
+            raise Exception('host has no tenants')
+        self.tprint('info', f'hosting {len(tenants)} tenants')
+        self.current = None  # tenants re-registered the module API while loading
+        for bei in tenants:
+            bei.loop_thread = threading.get_ident()
+        while True:
+            for bei in tenants:
+                if bei.control_pending:
+                    self.activate(bei)
+                    bei.control()
+                if bei.pool is not None:
+                    bei.pool_throttle()
+
+            socks = dict(self.poller.poll(min(bei.next_timeout() for bei in tenants)))
+
+            for bei in tenants:
+                self.activate(bei)
+                pt = bei.phases
+                if pt is not None:
+                    pt.start()
+                bei.step(socks, pt)
+
+            self.tick += 1
+
+
+    def shutdown(self):
+        """
+        Shuts down every tenant, then the shared resources.
+        :returns: Nothing.
+        """
+        if self.already_shutdown:
+            return
+        self.already_shutdown = True
+        for bei in self.tenants.values():
+            if not bei.already_shutdown:
+                bei.shutdown()
+        if self.auth is not None:
+            self.auth.stop()
+        self.context.destroy()
+        super(Host, self).shutdown()
+
+
+def read_config(path):
+    """
+    Reads a host config: a JSON object whose "tenants" list holds one object per tenant with "name", "component",
+    "module", and either "ipc" or "ep", "et", "ak" and "bk" (the bemain options of the same names).  Optional keys are
+    "kv_store", "metrics_port" and "capture".
+    :param path: JSON file.
+    :returns: List of tenant dicts with keys name, component, module, kp, kv_path, metrics_port, capture_path and
+        be_kwargs.
+    :raises: Exception on a malformed config or missing key file.
+    """
+    with open(path) as f:
+        config = json.load(f)
+    tenants = []
+    for entry in config.get('tenants', []):
+        missing = [key for key in ('name', 'component', 'module') if key not in entry]
+        if 'ipc' not in entry:
+            missing += [key for key in ('ep', 'et', 'ak', 'bk') if key not in entry]
+        if missing:
+            raise Exception(f'host config: tenant {entry.get("name")} is missing {", ".join(missing)}')
+
+        kp = None
+        if 'ipc' not in entry:
+            for key in ('ak', 'bk'):
+                if not os.path.isfile(entry[key]):
+                    raise Exception(f'host config: tenant {entry["name"]}: {entry[key]} is missing')
+            kp = {'be_key': entry['bk'], 'app_key': entry['ak']}
+
+        tenants.append({'name': entry['name'],
+                        'component': entry['component'],
+                        'module': entry['module'],
+                        'kp': kp,
+                        'kv_path': entry.get('kv_store'),
+                        'metrics_port': entry.get('metrics_port'),
+                        'capture_path': entry.get('capture'),
+                        'be_kwargs': {arg: entry[key] for key, arg in TENANT_KEYS.items() if key in entry}})
+    if not tenants:
+        raise Exception('host config lists no tenants')
+    return tenants
+
+
+def run_host(load_tenant, tenants, log_file=None, kv_cache_bytes=KV_CACHE_BYTES, capture_max_bytes=CAPTURE_MAX_BYTES,
+             **be_kwargs):
+    """
+    Builds a host, loads every tenant into it, then runs the shared event loop in the caller.
+    :param load_tenant: Function taking a BE instance and a tenant dict; constructs the tenant without running a loop.
+    :param tenants: List of tenant dicts, from read_config.
+    :param log_file: If set, the host and all of its tenants log to this file.
+    :param kv_cache_bytes: KV cache budget of each tenant with a kv_store.
+    :param capture_max_bytes: Size limit of each tenant's capture.
+    :param be_kwargs: Passed to every tenant's BE (debug, sndhwm, ...), under its own per-tenant settings.
+    :returns: Nothing.
+    """
+    host = Host(debug=be_kwargs.get('debug', False), log_file=log_file, profile_dir=be_kwargs.get('profile_dir'),
+                hot_reload=be_kwargs.get('hot_reload', False))
+    for tenant in tenants:
+        bei = host.add(tenant['kp'], tenant['name'], **dict(be_kwargs, **tenant['be_kwargs']))
+        if tenant['metrics_port'] is not None:
+            bei.start_metrics(tenant['metrics_port'])
+        if tenant['kv_path'] is not None:
+            bei.start_kv(tenant['kv_path'], max_bytes=kv_cache_bytes)
+        if tenant['capture_path'] is not None:
+            bei.start_capture(tenant['capture_path'], max_bytes=capture_max_bytes)
+        load_tenant(bei, tenant)
+    host.loop()
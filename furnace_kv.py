@@ -0,0 +1,151 @@
+#-------------------------
+# Furnace (c) 2017-2018 Micah Bushouse
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#-------------------------
+"""
+Key-value facility backing the Get/Set messages in facilities.proto.
+An in-memory LRU cache in front of an optional SQLite file, written behind in batches.
+"""
+
+import collections
+import sqlite3
+
+# internal
+from constants import *
+
+
+class KVStore(object):
+    """
+    String key -> string value store.  Not thread-safe; only the event loop touches it.
+    Without a path, entries evicted from the cache are gone.  With a path, every set is persisted on the next flush().
+    """
+
+    def __init__(self, path=None, max_bytes=KV_CACHE_BYTES, max_dirty=KV_DIRTY_MAX, log=None):
+        """
+        :param path: SQLite file to persist to, or None for a memory-only store.
+        :param max_bytes: Cache budget, counted as the length of keys plus values.
+        :param max_dirty: Flush as soon as this many keys are waiting to be written.
+        :param log: tprint-style function for flush failures, or None.
+        """
+        self.path = path
+        self.log = log
+        self.flush_failures = 0
+        self.max_bytes = max_bytes
+        self.max_dirty = max_dirty
+        self.cache = collections.OrderedDict()  # key -> value, least recently used first
+        self.cache_bytes = 0
+        self.dirty = {}  # key -> value, set but not yet written
+        self.hits = 0
+        self.misses = 0
+        self.db = None
+        if path is not None:
+            # opened before the loop thread starts, but still only used by one thread at a time
+            self.db = sqlite3.connect(path, isolation_level=None, check_same_thread=False)
+            self.db.execute('PRAGMA journal_mode=WAL')
+            self.db.execute('PRAGMA synchronous=NORMAL')
+            self.db.execute('CREATE TABLE IF NOT EXISTS kv (key TEXT PRIMARY KEY, value TEXT NOT NULL)')
+
+
+    def get(self, key):
+        """
+        :param key: String key.
+        :returns: The value, or None if the key was never set (or was evicted from a memory-only store).
+        """
+        cache = self.cache
+        value = cache.get(key)
+        if value is not None:
+            cache.move_to_end(key)
+            self.hits += 1
+            return value
+        self.misses += 1
+        value = self.dirty.get(key)
+        if value is None and self.db is not None:
+            row = self.db.execute('SELECT value FROM kv WHERE key = ?', (key,)).fetchone()
+            value = row[0] if row is not None else None
+        if value is not None:
+            self.cache_put(key, value)
+        return value
+
+
+    def set(self, key, value):
+        """
+        :param key: String key.
+        :param value: String value.
+        :returns: Nothing.
+        """
+        self.cache_put(key, value)
+        if self.db is not None:
+            self.dirty[key] = value
+            if len(self.dirty) >= self.max_dirty:
+                self.try_flush()
+
+
+    def cache_put(self, key, value):
+        """
+        Internal use only.
+        Inserts or refreshes key as most recently used, then evicts from the cold end until under budget.
+        """
+        cache = self.cache
+        old = cache.pop(key, None)
+        if old is not None:
+            self.cache_bytes -= len(key) + len(old)
+        cache[key] = value
+        self.cache_bytes += len(key) + len(value)
+        while self.cache_bytes > self.max_bytes and len(cache) > 1:
+            k, v = cache.popitem(last=False)
+            self.cache_bytes -= len(k) + len(v)
+
+
+    def flush(self):
+        """
+        Writes every pending set to SQLite in one transaction.  The sets stay pending until it commits, so a failed
+        write is retried by the next flush.
+        :returns: Number of keys written.
+        """
+        if not self.dirty:
+            return 0
+        rows = list(self.dirty.items())
+        with self.db:
+            self.db.execute('BEGIN')
+            self.db.executemany('INSERT OR REPLACE INTO kv (key, value) VALUES (?, ?)', rows)
+        self.dirty = {}
+        return len(rows)
+
+
+    def try_flush(self):
+        """
+        Same as flush, but an SQLite error (disk full, locked file) is logged instead of raised, so it cannot take down
+        the event loop.  The sets stay pending for the next flush.
+        :returns: Number of keys written, 0 if the write failed.
+        """
+        try:
+            return self.flush()
+        except sqlite3.Error as e:
+            self.flush_failures += 1
+            if self.log is not None and self.flush_failures & (self.flush_failures - 1) == 0:  # 1, 2, 4, 8...
+                self.log('error', 'KV flush of %d keys to %s failed, %d failures so far: %r',
+                         len(self.dirty), self.path, self.flush_failures, e)
+            return 0
+
+
+    def close(self):
+        """
+        Flushes and closes the SQLite file, if any.
+        :returns: Nothing.
+        """
+        if self.db is not None:
+            self.flush()
+            self.db.close()
+            self.db = None
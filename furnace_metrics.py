@@ -0,0 +1,274 @@
+#-------------------------
+# Furnace (c) 2017-2018 Micah Bushouse
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#-------------------------
+"""
+Live backend metrics, served in the Prometheus text format over HTTP on localhost.
+"""
+
+import bisect
+import functools
+import http.server
+import inspect
+import threading
+import time
+
+MAX_FE_LABELS = 1024  # apps beyond this are folded into ident="other"
+
+
+def _bounds(lo_exp=10, hi_exp=37, sub=4):
+    """
+    Internal use only.
+    Log-linear bucket bounds in ns (HDR-style): each power of two split into sub linear steps, ~1us to ~137s.
+    """
+    return [(1 << e) + k * (1 << e) // sub for e in range(lo_exp, hi_exp) for k in range(sub)]
+
+BOUNDS_NS = _bounds()
+
+
+def _label(val):
+    """
+    Internal use only.
+    Escapes a Prometheus label value.
+    """
+    return str(val).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+class Histogram(object):
+    """
+    Fixed-bucket latency histogram.  record() is a bisect and two adds.
+    """
+
+    __slots__ = ('counts', 'count', 'total')
+
+    def __init__(self):
+        self.counts = [0] * (len(BOUNDS_NS) + 1)  # last bucket is +Inf
+        self.count = 0
+        self.total = 0
+
+
+    def record(self, ns):
+        """
+        :param ns: Observed latency in nanoseconds.
+        :returns: Nothing.
+        """
+        self.counts[bisect.bisect_left(BOUNDS_NS, ns)] += 1
+        self.count += 1
+        self.total += ns
+
+
+    def percentile(self, q):
+        """
+        :param q: Quantile, 0.0 - 1.0.
+        :returns: Upper bound in ns of the bucket holding the q-th observation, or 0 if empty.
+        """
+        if not self.count:
+            return 0
+        rank = q * self.count
+        seen = 0
+        for i, n in enumerate(self.counts):
+            seen += n
+            if seen >= rank and n:
+                return BOUNDS_NS[i] if i < len(BOUNDS_NS) else BOUNDS_NS[-1]
+        return BOUNDS_NS[-1]
+
+
+    def render(self, name, labels):
+        """
+        :param name: Metric name, without suffix.
+        :param labels: Preformatted label string, e.g. 'cb="fe"', or ''.
+        :returns: List of exposition lines.
+        """
+        sep = ',' if labels else ''
+        out = []
+        seen = 0
+        for bound, n in zip(BOUNDS_NS, self.counts):
+            seen += n
+            out.append(f'{name}_bucket{{{labels}{sep}le="{bound / 1e9:.9g}"}} {seen}')
+        out.append(f'{name}_bucket{{{labels}{sep}le="+Inf"}} {self.count}')
+        braced = f'{{{labels}}}' if labels else ''
+        out.append(f'{name}_sum{braced} {self.total / 1e9:.9g}')
+        out.append(f'{name}_count{braced} {self.count}')
+        return out
+
+
+def latency(hist):
+    """
+    Summary of a Histogram for JSON reports, such as the benchmark's and replay's.
+    :returns: Dict of latency percentiles in microseconds.  Percentiles are bucket upper bounds, within ~19%.
+    """
+    return {'count': hist.count,
+            'mean': round(hist.total / hist.count / 1000, 1) if hist.count else 0,
+            'p50': hist.percentile(0.50) / 1000,
+            'p99': hist.percentile(0.99) / 1000,
+            'p999': hist.percentile(0.999) / 1000}
+
+
+class Metrics(object):
+    """
+    Per-app counters, per-callback and SYNC latency histograms, timer lag, and gauges sampled at scrape time.
+    Updated only from the event loop thread; the HTTP thread only reads.
+    """
+
+    def __init__(self, runtime):
+        """
+        :param runtime: The FurnaceRuntime being measured, for its msgin/msgout/tick counters.
+        """
+        self.runtime = runtime
+        self.fe = {}  # raw ident -> [msgs in, bytes in, msgs out, bytes out]
+        self.callbacks = {}  # callback name -> Histogram
+        self.sync_rtt = Histogram()
+        self.timer_lag = Histogram()
+        self.gauges = {}  # name -> function returning a number
+        self.server = None
+
+
+    def fe_counters(self, ident):
+        """
+        Internal use only.
+        :param ident: Raw ident frame of an app.
+        :returns: The counter list for ident, creating it if there is room.
+        """
+        try:
+            return self.fe[ident]
+        except KeyError:
+            if len(self.fe) >= MAX_FE_LABELS:
+                ident = b'other'
+            return self.fe.setdefault(ident, [0, 0, 0, 0])
+
+
+    def fe_in(self, ident, nbytes):
+        """
+        Counts one inbound packet.
+        :param ident: Raw ident frame of the sending app.
+        :param nbytes: Size of the packet's protobuf.
+        :returns: perf_counter_ns() at the time of the call, to start a SYNC round trip measurement.
+        """
+        c = self.fe_counters(ident)
+        c[0] += 1
+        c[1] += nbytes
+        return time.perf_counter_ns()
+
+
+    def fe_out(self, ident, nbytes):
+        """
+        Counts one outbound packet.
+        :param ident: Raw ident frame of the app, or b'*' for broadcasts.
+        :param nbytes: Size of the packet's protobuf.
+        :returns: Nothing.
+        """
+        c = self.fe_counters(ident)
+        c[2] += 1
+        c[3] += nbytes
+
+
+    def timed(self, name, callback):
+        """
+        Wraps a tenant callback so each call is recorded in the callbacks[name] histogram.
+        Coroutine functions stay coroutine functions.
+        :param name: Label for the histogram.
+        :param callback: Tenant function.
+        :returns: The wrapped function.
+        """
+        hist = self.callbacks.setdefault(name, Histogram())
+        clock = time.perf_counter_ns
+
+        if inspect.iscoroutinefunction(callback):
+            @functools.wraps(callback)
+            async def wrapper(*args):
+                t0 = clock()
+                try:
+                    return await callback(*args)
+                finally:
+                    hist.record(clock() - t0)
+        else:
+            @functools.wraps(callback)
+            def wrapper(*args):
+                t0 = clock()
+                try:
+                    return callback(*args)
+                finally:
+                    hist.record(clock() - t0)
+        return wrapper
+
+
+    def render(self):
+        """
+        :returns: The current metrics in the Prometheus text exposition format.
+        """
+        rt = self.runtime
+        out = ['# TYPE furnace_msgs_in_total counter', f'furnace_msgs_in_total {rt.msgin}',
+               '# TYPE furnace_msgs_out_total counter', f'furnace_msgs_out_total {rt.msgout}',
+               '# TYPE furnace_loop_ticks_total counter', f'furnace_loop_ticks_total {rt.tick}']
+
+        fe = list(self.fe.items())
+        for i, metric in enumerate(('furnace_fe_msgs_in_total', 'furnace_fe_bytes_in_total',
+                                    'furnace_fe_msgs_out_total', 'furnace_fe_bytes_out_total')):
+            out.append(f'# TYPE {metric} counter')
+            out.extend(f'{metric}{{ident="{_label(ident.decode(errors="replace"))}"}} {c[i]}' for ident, c in fe)
+
+        out.append('# TYPE furnace_callback_seconds histogram')
+        for name, hist in list(self.callbacks.items()):
+            out.extend(hist.render('furnace_callback_seconds', f'cb="{_label(name)}"'))
+        out.append('# TYPE furnace_sync_rtt_seconds histogram')
+        out.extend(self.sync_rtt.render('furnace_sync_rtt_seconds', ''))
+        out.append('# TYPE furnace_timer_lag_seconds histogram')
+        out.extend(self.timer_lag.render('furnace_timer_lag_seconds', ''))
+        phases = getattr(rt, 'phases', None)  # furnace_profile.PhaseTimer, while phase timing is on
+        if phases is not None:
+            out.append('# TYPE furnace_loop_phase_seconds histogram')
+            for phase, hist in list(phases.hists.items()):
+                out.extend(hist.render('furnace_loop_phase_seconds', f'phase="{phase}"'))
+
+        for name, fn in list(self.gauges.items()):
+            out.append(f'# TYPE {name} gauge')
+            out.append(f'{name} {fn()}')
+        return '\n'.join(out) + '\n'
+
+
+    def serve(self, port, host='127.0.0.1'):
+        """
+        Starts a daemon thread answering HTTP GETs with render().
+        :param port: TCP port to listen on.
+        :param host: Address to listen on, localhost by default.
+        :returns: Nothing.
+        """
+        metrics = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            def do_GET(self):
+                body = metrics.render().encode()
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = http.server.HTTPServer((host, port), Handler)
+        threading.Thread(target=self.server.serve_forever, name='furnace-metrics', daemon=True).start()
+
+
+    def shutdown(self):
+        """
+        Stops the HTTP thread, if any.
+        :returns: Nothing.
+        """
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
@@ -0,0 +1,246 @@
+#-------------------------
+# Furnace (c) 2017-2018 Micah Bushouse
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#-------------------------
+"""
+Codecs for the tenant's own payloads, the messages its apps and callbacks exchange.
+A tenant registers one codec with its FE callback.  ctx.body then decodes the inbound payload the first time the
+tenant reads it, and notify/broadcast/notify_many/publish and SYNC return values accept objects encoded with it.
+
+JSON in the be_msg value string is the default.  Binary codecs use the be_msg data field, and a message that only
+carries a value string (an app that still speaks JSON) is decoded as JSON, so apps can move to a binary codec one
+at a time.
+"""
+
+import functools
+import json
+import re
+import struct
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+# internal
+from constants import *
+
+
+class JsonCodec(object):
+    """
+    JSON text in the be_msg value string.
+    """
+
+    binary = False
+
+    def __init__(self):
+        self.decode = json.JSONDecoder().decode
+        self.encode = json.JSONEncoder(separators=(',', ':')).encode
+
+
+class MsgpackCodec(object):
+    """
+    msgpack in the be_msg data field.  Needs the msgpack package.
+    """
+
+    binary = True
+
+    def __init__(self):
+        """
+        :raises: Exception if msgpack is not installed.
+        """
+        if msgpack is None:
+            raise Exception('MsgpackCodec needs the msgpack package')
+        self.decode = functools.partial(msgpack.unpackb, raw=False)
+        self.encode = functools.partial(msgpack.packb, use_bin_type=True)
+
+
+class ProtobufCodec(object):
+    """
+    One registered protobuf message type in the be_msg data field.
+    """
+
+    binary = True
+
+    def __init__(self, message_class):
+        """
+        :param message_class: Generated protobuf message class, e.g. my_pb2.Sample.
+        """
+        self.message_class = message_class
+
+
+    def decode(self, raw):
+        msg = self.message_class()
+        msg.ParseFromString(raw)
+        return msg
+
+
+    def encode(self, obj):
+        """
+        :param obj: A message_class instance, or a dict of its fields.
+        :returns: The serialized message.
+        """
+        if isinstance(obj, dict):
+            obj = self.message_class(**obj)
+        return obj.SerializeToString()
+
+
+class StructCodec(object):
+    """
+    Fixed binary layout packed with the struct module, e.g. StructCodec('<IQQ', ('pid', 'addr', 'size')).
+    Each field is one format item ('16s' is one field, '3I' is not).  Field offsets are computed once, so reading one
+    field of a record unpacks only that field.
+    """
+
+    binary = True
+
+    def __init__(self, fmt, fields):
+        """
+        :param fmt: struct format string, with an optional byte order prefix.
+        :param fields: Field names, one per format item other than padding ('x').
+        :raises: Exception if fields do not line up with fmt.
+        """
+        self.struct = struct.Struct(fmt)
+        self.fields = tuple(fields)
+        order = fmt[0] if fmt[:1] in ('@', '=', '<', '>', '!') else '@'
+        self.offsets = {}  # field -> (Struct of the field alone, offset)
+        names = iter(self.fields)
+        prefix = order
+        for count, code in re.findall(r'(\d*)([xcbB?hHiIlLqQnNefdspP])', fmt.lstrip('@=<>!')):
+            item = count + code
+            if code != 'x':
+                if count and code not in 'sp':
+                    raise Exception(f'StructCodec needs one format item per field, not {item}')
+                one = struct.Struct(order + item)
+                name = next(names, None)
+                if name is None:
+                    raise Exception('StructCodec has more format items than fields')
+                self.offsets[name] = (one, struct.calcsize(prefix + item) - one.size)
+            prefix += item
+        if len(self.offsets) != len(self.fields):
+            raise Exception('StructCodec has more fields than format items')
+
+
+    def decode(self, raw):
+        return dict(zip(self.fields, self.struct.unpack_from(raw)))
+
+
+    def field(self, raw, name):
+        """
+        :param raw: Packed record.
+        :param name: Field to read.
+        :returns: The field's value.
+        :raises: KeyError for an unknown field.
+        """
+        one, offset = self.offsets[name]
+        return one.unpack_from(raw, offset)[0]
+
+
+    def encode(self, obj):
+        """
+        :param obj: Dict keyed by field name, or a sequence in field order.
+        :returns: The packed record.
+        """
+        if isinstance(obj, dict):
+            return self.struct.pack(*[obj[name] for name in self.fields])
+        return self.struct.pack(*obj)
+
+
+JSON = JsonCodec()
+
+_UNSET = object()
+
+
+class Body(object):
+    """
+    A payload decoded on first use.  body[key], body.get(key) and attribute access read one field; with a
+    StructCodec only that field is unpacked, other codecs decode the whole payload once and cache it.
+    body.obj is the decoded object itself.
+    """
+
+    __slots__ = ('codec', 'raw', '_obj')
+
+    def __init__(self, codec, raw):
+        self.codec = codec
+        self.raw = raw
+        self._obj = _UNSET
+
+
+    @property
+    def obj(self):
+        if self._obj is _UNSET:
+            self._obj = self.codec.decode(self.raw)
+        return self._obj
+
+
+    def __getitem__(self, key):
+        if self._obj is _UNSET and isinstance(self.codec, StructCodec):
+            return self.codec.field(self.raw, key)
+        return self.obj[key]
+
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except (KeyError, IndexError, TypeError):
+            return default
+
+
+    def __getattr__(self, name):  # only called for names that are not slots
+        if isinstance(self.codec, StructCodec):
+            try:
+                return self.codec.field(self.raw, name)
+            except KeyError:
+                raise AttributeError(name)
+        return getattr(self.obj, name)
+
+
+    def __contains__(self, key):
+        return key in self.obj
+
+
+    def __iter__(self):
+        return iter(self.obj)
+
+
+    def __len__(self):
+        return len(self.obj)
+
+
+    def __repr__(self):  # does not decode, so logging a ctx never fails on a malformed payload
+        return f'<Body {type(self.codec).__name__} {len(self.raw)}B>'
+
+
+def body(codec, message, data):
+    """
+    :param codec: The tenant's registered codec.
+    :param message: be_msg value string.
+    :param data: be_msg data payload, or None.
+    :returns: A Body over data for a binary codec, or over message when the codec is JSON or the app sent no data.
+    """
+    if codec.binary and data is not None:
+        return Body(codec, data)
+    return Body(JSON, message)
+
+
+def encode(codec, obj):
+    """
+    :param codec: The tenant's registered codec.
+    :param obj: Object to send.  Strings and bytes-like objects pass through unchanged.
+    :returns: str for the value field, or bytes for the data field.
+    """
+    if isinstance(obj, (str, bytes, bytearray, memoryview)):
+        return obj
+    return codec.encode(obj)
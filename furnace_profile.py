@@ -0,0 +1,246 @@
+#-------------------------
+# Furnace (c) 2017-2018 Micah Bushouse
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#-------------------------
+"""
+Event loop instrumentation: per-phase timing, and a profiler that runs for a time window on request.
+"""
+
+import collections
+import cProfile
+import os
+import sys
+import threading
+import time
+
+# internal
+from constants import *
+from furnace_metrics import Histogram
+
+# event loop phases, in the order an iteration passes through them
+PHASES = ('poll', 'recv', 'parse', 'callback', 'serialize', 'send', 'timers')
+
+PROFILE_SUFFIX = {PROFILE_PSTATS: 'pstats', PROFILE_COLLAPSED: 'collapsed'}
+
+
+class PhaseTimer(object):
+    """
+    Splits event loop time into PHASES.  The loop calls start() at the top of each iteration and mark(phase) at the
+    end of each phase, so every nanosecond between marks lands in exactly one histogram.
+    Updated only from the event loop thread.
+    """
+
+    def __init__(self):
+        self.hists = {phase: Histogram() for phase in PHASES}
+        self.last = time.perf_counter_ns()
+        self.since = time.monotonic()
+
+
+    def start(self):
+        """
+        :returns: Nothing.
+        """
+        self.last = time.perf_counter_ns()
+
+
+    def mark(self, phase):
+        """
+        Charges the time since the previous mark to phase.
+        :param phase: One of PHASES.
+        :returns: Nothing.
+        """
+        now = time.perf_counter_ns()
+        self.hists[phase].record(now - self.last)
+        self.last = now
+
+
+    def report(self):
+        """
+        :returns: List of log lines, one per phase that ran, with its share of the measured time.
+        """
+        elapsed = time.monotonic() - self.since
+        measured = sum(hist.total for hist in self.hists.values()) or 1
+        out = [f'loop phases over {elapsed:.1f}s:']
+        for phase, hist in self.hists.items():
+            if not hist.count:
+                continue
+            out.append(f'  {phase:<9} {hist.total / 1e9:9.3f}s {100 * hist.total / measured:5.1f}%  '
+                       f'n={hist.count} p50={hist.percentile(0.5) / 1e3:.0f}us p99={hist.percentile(0.99) / 1e3:.0f}us')
+        return out
+
+
+    def reset(self):
+        """
+        :returns: Nothing.
+        """
+        self.hists = {phase: Histogram() for phase in PHASES}
+        self.since = time.monotonic()
+
+
+class StartupTimer(object):
+    """
+    Wall-clock breakdown of backend startup.  Uses time.monotonic(), which is shared by every process on the host, so
+    a fork server can start the clock when a request arrives and its child can keep it running.
+    """
+
+    def __init__(self, t0=None):
+        """
+        :param t0: time.monotonic() when startup began, now by default.
+        """
+        self.t0 = time.monotonic() if t0 is None else t0
+        self.last = self.t0
+        self.phases = {}  # phase -> seconds, in order
+
+
+    def mark(self, phase):
+        """
+        Charges the time since the previous mark to phase.
+        :param phase: Phase name, e.g. 'imports'.
+        :returns: Nothing.
+        """
+        now = time.monotonic()
+        self.phases[phase] = self.phases.get(phase, 0.0) + now - self.last
+        self.last = now
+
+
+    def total(self):
+        """
+        :returns: Seconds from t0 to the last mark.
+        """
+        return self.last - self.t0
+
+
+    def report(self):
+        """
+        :returns: One log line, e.g. 'startup 95.2ms: imports 80.1ms, keys 0.4ms, ...'.
+        """
+        parts = ', '.join(f'{phase} {secs * 1000:.1f}ms' for phase, secs in self.phases.items())
+        return f'startup {self.total() * 1000:.1f}ms: {parts}'
+
+
+class StackSampler(threading.Thread):
+    """
+    Statistical profiler.  Samples one thread's Python stack every interval and counts identical stacks, which keeps
+    the cost on the sampled thread near zero regardless of call rate.
+    """
+
+    def __init__(self, thread_id, interval=PROFILE_SAMPLE_INTERVAL):
+        """
+        :param thread_id: threading.get_ident() of the thread to sample.
+        :param interval: Seconds between samples.
+        """
+        super(StackSampler, self).__init__(name='furnace-sampler', daemon=True)
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stacks = collections.Counter()
+        self.stopped = threading.Event()
+
+
+    def run(self):
+        labels = {}  # code object -> frame label
+        while not self.stopped.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                label = labels.get(code)
+                if label is None:
+                    name = getattr(code, 'co_qualname', code.co_name)
+                    label = labels[code] = f'{name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})'
+                stack.append(label)
+                frame = frame.f_back
+            if stack:
+                self.stacks[';'.join(reversed(stack))] += 1
+
+
+    def dump(self, path):
+        """
+        Writes the samples in collapsed-stack format (one 'outer;...;inner count' line per stack), the input of
+        flamegraph.pl and speedscope.
+        :param path: Output file.
+        :returns: Nothing.
+        """
+        with open(path, 'w') as f:
+            for stack, n in self.stacks.most_common():
+                f.write(f'{stack} {n}\n')
+
+
+class Profiler(object):
+    """
+    One profiling window at a time over the event loop thread.  start() and stop() must be called from that thread.
+    """
+
+    def __init__(self, directory):
+        """
+        :param directory: Where profiles are written, created if missing.
+        """
+        self.directory = directory
+        self.fmt = None
+        self.path = None
+        self.deadline = 0
+        self.windows = 0  # numbers the output files
+        self.prof = None  # cProfile.Profile or StackSampler, while a window is open
+
+
+    def start(self, seconds, fmt):
+        """
+        :param seconds: Length of the window.
+        :param fmt: PROFILE_PSTATS (cProfile, deterministic) or PROFILE_COLLAPSED (StackSampler, statistical).
+        :returns: Path the profile will be written to when the window closes.
+        :raises: Exception if a window is already open or fmt is unknown.
+        """
+        if self.prof is not None:
+            raise Exception(f'already profiling into {self.path}')
+        if fmt not in PROFILE_SUFFIX:
+            raise Exception('unknown profile format')
+        os.makedirs(self.directory, exist_ok=True)
+        stamp = time.strftime('%Y%m%d-%H%M%S')
+        self.windows += 1
+        self.path = os.path.join(self.directory,
+                                 f'furnace-{os.getpid()}-{stamp}-{self.windows}.{PROFILE_SUFFIX[fmt]}')
+        self.fmt = fmt
+        self.deadline = time.monotonic() + seconds
+        if fmt == PROFILE_PSTATS:
+            self.prof = cProfile.Profile()
+            self.prof.enable()
+        else:
+            self.prof = StackSampler(threading.get_ident())
+            self.prof.start()
+        return self.path
+
+
+    def due(self):
+        """
+        :returns: True if a window is open and has run its length.
+        """
+        return self.prof is not None and time.monotonic() >= self.deadline
+
+
+    def stop(self):
+        """
+        Closes the window and writes the profile.
+        :returns: Path of the written profile, or None if no window was open.
+        """
+        if self.prof is None:
+            return None
+        prof, self.prof = self.prof, None
+        if self.fmt == PROFILE_PSTATS:
+            prof.disable()
+            prof.dump_stats(self.path)
+        else:
+            prof.stopped.set()
+            prof.join()
+            prof.dump(self.path)
+        return self.path
@@ -0,0 +1,175 @@
+#-------------------------
+# Furnace (c) 2017-2018 Micah Bushouse
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#-------------------------
+"""
+Backend-maintained registry of the apps (FEs) that have contacted this backend, with idle expiry on a timer wheel.
+"""
+
+import math
+import time
+
+# internal
+from constants import *
+
+
+class FERecord(object):
+    """
+    What the backend knows about one app.  Times are time.monotonic() values.
+    """
+
+    __slots__ = ('ident', 'first_seen', 'last_seen', 'msgs_in', 'bytes_in', 'msgs_out', 'bytes_out', 'drops', 'codec',
+                 'state', 'deadline')
+
+    def __init__(self, ident, now):
+        self.ident = ident  # string ID of the app
+        self.first_seen = now
+        self.last_seen = now
+        self.msgs_in = 0
+        self.bytes_in = 0
+        self.msgs_out = 0
+        self.bytes_out = 0
+        self.drops = 0  # outbound messages dropped by the send policy
+        self.codec = CODEC_NONE  # payload codec negotiated with the app, see furnace_compress.py
+        self.state = FE_ALIVE
+        self.deadline = 0.0  # next liveness check, internal
+
+    def __repr__(self):
+        return (f'FERecord({self.ident!r}, state={self.state}, msgs_in={self.msgs_in}, msgs_out={self.msgs_out}, '
+                f'idle={time.monotonic() - self.last_seen:.1f}s)')
+
+
+class Registry(object):
+    """
+    Every live app, keyed by raw ident.  Any inbound packet counts as a heartbeat.
+    An app silent for heartbeat seconds turns FE_SUSPECT; silent for idle_timeout seconds, it is evicted.
+
+    Deadlines live on a hashed timer wheel of tick-second slots.  touch() only updates counters and last_seen;
+    records are rechecked when their slot comes up and moved forward if they were heard from in the meantime,
+    so both a packet and an expiry are O(1) regardless of how many apps are registered.
+    """
+
+    def __init__(self, heartbeat=FE_HEARTBEAT, idle_timeout=FE_IDLE_TIMEOUT, tick=FE_WHEEL_TICK):
+        """
+        :param heartbeat: Seconds of silence before an app is FE_SUSPECT.
+        :param idle_timeout: Seconds of silence before an app is evicted.
+        :param tick: Wheel resolution in seconds, capped at half the heartbeat; state changes happen up to one tick late.
+        """
+        self.fes = {}  # raw ident -> FERecord
+        self.configure(heartbeat, idle_timeout, tick)
+
+
+    def configure(self, heartbeat, idle_timeout, tick=FE_WHEEL_TICK):
+        """
+        Changes the timeouts and rebuilds the wheel around the current records.
+        :returns: Nothing.
+        :raises: Exception if heartbeat is not below idle_timeout.
+        """
+        if not 0 < heartbeat < idle_timeout:
+            raise Exception('FE registry heartbeat must be > 0 and below idle_timeout')
+        self.heartbeat = heartbeat
+        self.idle_timeout = idle_timeout
+        self.tick = min(tick, heartbeat / 2)
+        self.wheel = [[] for _ in range(math.ceil(idle_timeout / self.tick) + 1)]
+        self.cursor = 0
+        self.wheel_time = time.monotonic()  # start time of the slot at cursor
+        for rec in self.fes.values():
+            rec.deadline = rec.last_seen + (heartbeat if rec.state == FE_ALIVE else idle_timeout)
+            self.schedule(rec)
+
+
+    def schedule(self, rec):
+        """
+        Internal use only.
+        Files rec in the wheel slot covering rec.deadline.
+        """
+        ahead = max(0, int((rec.deadline - self.wheel_time) // self.tick))
+        self.wheel[(self.cursor + min(ahead, len(self.wheel) - 1)) % len(self.wheel)].append(rec)
+
+
+    def touch(self, ident, nbytes, now):
+        """
+        Counts one inbound packet, registering the app on first contact.
+        :param ident: Raw ident frame of the app.
+        :param nbytes: Size of the packet's protobuf.
+        :param now: time.monotonic().
+        :returns: The app's FERecord.
+        """
+        rec = self.fes.get(ident)
+        if rec is None:
+            rec = self.fes[ident] = FERecord(ident.decode(), now)
+            rec.deadline = now + self.heartbeat
+            self.schedule(rec)
+        rec.last_seen = now
+        rec.state = FE_ALIVE
+        rec.msgs_in += 1
+        rec.bytes_in += nbytes
+        return rec
+
+
+    def sent(self, ident, nbytes):
+        """
+        Counts one outbound packet to a registered app.  Unknown idents are ignored.
+        :param ident: Raw ident frame of the app.
+        :param nbytes: Size of the packet's protobuf.
+        :returns: Nothing.
+        """
+        rec = self.fes.get(ident)
+        if rec is not None:
+            rec.msgs_out += 1
+            rec.bytes_out += nbytes
+
+
+    def expire(self, now):
+        """
+        Advances the wheel to now, marking silent apps FE_SUSPECT and removing those past idle_timeout.
+        :param now: time.monotonic().
+        :returns: List of evicted FERecords, with state FE_EVICTED.
+        """
+        evicted = []
+        slots = len(self.wheel)
+        while self.wheel_time + self.tick <= now:
+            bucket = self.wheel[self.cursor]
+            self.wheel[self.cursor] = []
+            self.cursor = (self.cursor + 1) % slots
+            self.wheel_time += self.tick
+            for rec in bucket:
+                if rec.state == FE_EVICTED:
+                    continue  # removed by drop()
+                silent = now - rec.last_seen
+                if silent >= self.idle_timeout:
+                    rec.state = FE_EVICTED
+                    del self.fes[rec.ident.encode()]
+                    evicted.append(rec)
+                    continue
+                if silent >= self.heartbeat:
+                    rec.state = FE_SUSPECT
+                    rec.deadline = rec.last_seen + self.idle_timeout
+                else:
+                    rec.deadline = rec.last_seen + self.heartbeat
+                self.schedule(rec)
+        return evicted
+
+
+    def drop(self, ident):
+        """
+        Removes an app immediately.  Its wheel entry is discarded lazily.
+        :param ident: Raw ident frame of the app.
+        :returns: The removed FERecord, or None if unknown.
+        """
+        rec = self.fes.pop(ident, None)
+        if rec is not None:
+            rec.state = FE_EVICTED
+        return rec
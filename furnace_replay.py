@@ -0,0 +1,236 @@
+#-------------------------
+# Furnace (c) 2017-2018 Micah Bushouse
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#-------------------------
+"""
+Replays a capture from furnace_capture into a tenant, without sockets or apps, to load test it offline.
+The tenant runs on a ReplayBE exactly as on a BE: FE, FE_BATCH, worker pools, timers, the KV facility and streams all
+work, and whatever it sends is counted instead of delivered.
+"""
+
+import threading
+import time
+
+# 3p
+import zmq
+
+# internal
+from constants import *
+import furnace_backend
+import furnace_capture
+from furnace_metrics import Histogram, latency
+
+
+class NullSocket(object):
+    """
+    Stands in for the FE-facing sockets.  Takes every message and counts it.
+    """
+
+    def __init__(self):
+        self.msgs = 0
+        self.nbytes = 0
+
+    def send_multipart(self, frames, flags=0, copy=True):
+        self.msgs += 1
+        self.nbytes += len(frames[-1])
+
+    def poll(self, timeout=None, flags=zmq.POLLIN):
+        return flags
+
+    def close(self, linger=None):
+        pass
+
+
+class ReplayBE(furnace_backend.BE):
+    """
+    Backend fed from a capture instead of the dealer socket.
+    """
+
+    def __init__(self, kp=None, **kwargs):
+        """
+        :param kp: Unused, there are no CURVE sockets.
+        :param kwargs: Passed to BE.
+        """
+        super(ReplayBE, self).__init__(kp, **kwargs)
+        self.name = 'replay'
+
+
+    def open_sockets(self):
+        """
+        Internal use only.
+        :returns: Nothing.
+        """
+        self.dealer_be = NullSocket()
+        self.pub_be = NullSocket()
+        self.startup.mark('bind')
+
+
+    def dealer_poll(self):
+        """
+        Internal use only.
+        The NullSocket never fills up and has nothing to read, so it stays out of the poller.
+        :returns: Nothing.
+        """
+
+
+    def idle(self, until):
+        """
+        Internal use only.
+        Runs timers and collects pool replies until a deadline.
+        :param until: time.monotonic() deadline, or None to return after one poll.
+        :returns: Nothing.
+        """
+        while True:
+            if self.control_pending:
+                self.control()
+            timeout = self.next_timeout()
+            if until is not None:
+                timeout = min(timeout, max(0, int((until - time.monotonic()) * 1000)))
+            socks = dict(self.poller.poll(timeout))
+            if self.pool_wakeup is not None and self.pool_wakeup[0] in socks:
+                self.pool_flush()
+            self.run_timers()
+            self.tick += 1
+            if until is None or time.monotonic() >= until:
+                return
+
+
+    def replay(self, reader, speed=1.0, start=0, limit=None):
+        """
+        Feeds captured packets to the tenant in order.
+        :param reader: furnace_capture.CaptureReader.
+        :param speed: Replay rate relative to the capture, e.g. 1.0 for real time or 10.0 for ten times faster.  0 sends
+            every packet as soon as the tenant is done with the previous one.
+        :param start: Number of the first record to replay.
+        :param limit: Replay at most this many records.
+        :returns: Dict of results: packets, seconds, throughput, per-packet dispatch time and schedule lag
+            percentiles in microseconds, and the messages and bytes the tenant sent back.
+        """
+        self.loop_thread = threading.get_ident()
+        batch = self.fe_info['event_type'] == FE_BATCH
+        dispatch = Histogram()
+        lag = Histogram()
+        pkts = []
+        count = 0
+        nbytes = 0
+        base = None
+        t_start = time.monotonic()
+        for ts, pkt in reader.records(start):
+            if limit is not None and count >= limit:
+                break
+            if base is None:
+                base = ts
+            if speed:
+                due = t_start + (ts - base) / speed
+                now = time.monotonic()
+                if now < due:
+                    if pkts:
+                        self.replay_batch(pkts, dispatch)
+                        pkts = []
+                    self.idle(due)
+                    now = time.monotonic()
+                lag.record(max(0, int((now - due) * 1e9)))
+            while self.pool is not None and self.pool_pending >= self.pool_max_pending:
+                self.idle(None)
+
+            count += 1
+            nbytes += len(pkt[-1])
+            if batch:
+                pkts.append(pkt)
+                if len(pkts) >= self.fe_info['batch_count']:
+                    self.replay_batch(pkts, dispatch)
+                    pkts = []
+                continue
+            t0 = time.perf_counter_ns()
+            self.msgin += 1
+            self.dispatch_pkt(pkt, self.fe_in(pkt), None)
+            dispatch.record(time.perf_counter_ns() - t0)
+            self.service()
+        if pkts:
+            self.replay_batch(pkts, dispatch)
+        if self.pool is not None:
+            self.stop_pool()  # joins the workers and answers what they have left
+        elapsed = time.monotonic() - t_start
+        return {'capture': reader.path,
+                'speed': speed,
+                'packets': count,
+                'seconds': round(elapsed, 3),
+                'packets_per_s': round(count / elapsed, 1) if elapsed else None,
+                'mb_per_s': round(nbytes / elapsed / 1e6, 2) if elapsed else None,
+                'dispatch_us': latency(dispatch),
+                'lag_us': latency(lag),
+                'sent': {'messages': self.dealer_be.msgs, 'bytes': self.dealer_be.nbytes},
+                'broadcast': {'messages': self.pub_be.msgs, 'bytes': self.pub_be.nbytes}}
+
+
+    def replay_batch(self, pkts, dispatch):
+        """
+        Internal use only.
+        Hands packets to a FE_BATCH tenant as one batch, as recv_batch would.
+        :param pkts: Raw multipart packets.
+        :param dispatch: Histogram of dispatch times; the batch's time is recorded once per packet.
+        :returns: Nothing.
+        """
+        t0 = time.perf_counter_ns()
+        for pkt in pkts:
+            self.fe_in(pkt)
+        self.msgin += len(pkts)
+        self.dispatch_batch(pkts)
+        per_pkt = (time.perf_counter_ns() - t0) // len(pkts)
+        for _ in pkts:
+            dispatch.record(per_pkt)
+        self.service()
+
+
+    def service(self):
+        """
+        Internal use only.
+        What the event loop does between packets: control requests, finished pool replies and due timers.
+        :returns: Nothing.
+        """
+        if self.control_pending:
+            self.control()
+        if self.pool_done or self.loop_calls:
+            self.pool_flush()
+        self.run_timers()
+
+
+def run_replay(load_tenant, path, speed=1.0, start_time=None, limit=None, metrics_port=None, kv_path=None,
+               kv_cache_bytes=KV_CACHE_BYTES, **be_kwargs):
+    """
+    Loads the tenant into a ReplayBE, replays a capture into it and shuts it down.
+    :param load_tenant: Function taking a BE instance; loads the tenant without running the loop.
+    :param path: Capture file.
+    :param speed: See ReplayBE.replay.
+    :param start_time: If set, skip the records captured before this time.time() value.
+    :param limit: See ReplayBE.replay.
+    :param be_kwargs: Passed to the ReplayBE constructor.
+    :returns: The result dict of ReplayBE.replay.
+    """
+    reader = furnace_capture.CaptureReader(path)
+    bei = ReplayBE(**be_kwargs)
+    if metrics_port is not None:
+        bei.start_metrics(metrics_port)
+    if kv_path is not None:
+        bei.start_kv(kv_path, max_bytes=kv_cache_bytes)
+    load_tenant(bei)
+    start = reader.find(start_time) if start_time is not None else 0
+    bei.tprint('info', f'replaying {len(reader) - start} packets from {path} at '
+                       f'{"max speed" if not speed else f"{speed}x"}')
+    try:
+        return bei.replay(reader, speed=speed, start=start, limit=limit)
+    finally:
+        reader.close()
+        bei.shutdown()
@@ -22,13 +22,42 @@ import time
 import logging
 import logging.handlers
 import os
+import queue
 import sys
 
 MAXLINE = 400  # number of chars to print on log msgs
 
+LOG_LEVELS = {'debug': logging.DEBUG,
+              'info': logging.INFO,
+              'notice': logging.INFO,
+              'warning': logging.WARNING,
+              'warn': logging.WARNING,
+              'error': logging.ERROR,
+              'err': logging.ERROR,
+              'crit': logging.CRITICAL,
+              'critical': logging.CRITICAL}
+
+
+class LoopQueueHandler(logging.handlers.QueueHandler):
+    """
+    Hands records to the logging thread.  Skips QueueHandler's full format() and record copy in the caller,
+    since tprint already built the message.
+    """
+
+    def prepare(self, record):
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+
 class FurnaceRuntime(object):
 
-    def __init__(self, debug=False):
+    def __init__(self, debug=False, log_file=None, logger=None, log_prefix=''):
+        """
+        :param logger: If set, log through this already configured logger (e.g. a host's) instead of starting one.
+        :param log_prefix: Prepended to every log entry, after the tick.
+        """
 
         atexit.register(self.shutdown)
         self._time_start = time.time()
@@ -38,8 +67,14 @@ class FurnaceRuntime(object):
         self.msgout = 0
         self.name = 'unk'
         self.print_debug = debug
+        self.log_file = log_file
+        self.log_listener = None
+        self.log_prefix = log_prefix
 
-        self.start_logs()
+        if logger is None:
+            self.start_logs()
+        else:
+            self.logger = logger
 
         #signal.signal(signal.SIGINT, self.signal_handler)
         #signal.signal(signal.SIGTERM, self.signal_handler)
@@ -51,37 +86,44 @@ class FurnaceRuntime(object):
     def start_logs(self):
 
         self.logger = logging.getLogger(str(self._pid))  # Catch furnace messages
-        self.logger.setLevel(logging.DEBUG)
+        # the logger level is the fast-path check in tprint, so it must match the most verbose handler
+        self.logger.setLevel(logging.DEBUG) if self.print_debug else self.logger.setLevel(logging.INFO)
+        self.logger.propagate = False
         formatter = logging.Formatter('%(asctime)s %(levelname)s %(message)s')  # Set format.
+        handlers = []
 
         # Log file handler and formatting.
-        #fh = logging.handlers.RotatingFileHandler('%s.log' % (self.name,), backupCount=10, maxBytes=33554432)  # 2^25 B
-        #fh.setFormatter(formatter)
-        #fh.setLevel(logging.INFO)
-        #self.logger.addHandler(fh)  # Assign file handler to loggers.
+        if self.log_file:
+            fh = logging.handlers.RotatingFileHandler(self.log_file, backupCount=10, maxBytes=33554432)  # 2^25 B
+            fh.setFormatter(formatter)
+            fh.setLevel(logging.INFO)
+            handlers.append(fh)
 
         # Console handler.
         ch = logging.StreamHandler()
         ch.setFormatter(formatter)
         print(f'setting debug logging to {self.print_debug}')
         ch.setLevel(logging.DEBUG) if self.print_debug else ch.setLevel(logging.INFO)
-        self.logger.addHandler(ch)  # Assign console handler to loggers.
+        handlers.append(ch)
+
+        # Handlers run on a background thread, so the event loop never blocks on console or disk I/O.
+        log_queue = queue.SimpleQueue()
+        self.logger.addHandler(LoopQueueHandler(log_queue))
+        self.log_listener = logging.handlers.QueueListener(log_queue, *handlers, respect_handler_level=True)
+        self.log_listener.start()
 
 
-    def tprint(self, log_type, entry):
-        output = '%s: %s' % (self.tick, entry)
-        if log_type == 'debug':
-            self.logger.debug(output[:MAXLINE])
-        elif log_type == 'info':
-            self.logger.info(output[:MAXLINE])
-        elif log_type == 'notice':
-            self.logger.info(output[:MAXLINE])
-        elif log_type in ['warning', 'warn']:
-            self.logger.warning(output[:MAXLINE])
-        elif log_type in ['error', 'err']:
-            self.logger.error(output[:MAXLINE])
-        elif log_type in ['crit', 'critical']:
-            self.logger.critical(output[:MAXLINE])
+    def tprint(self, log_type, entry, *args):
+        """
+        Logs entry at the level named by log_type.  Formatting is deferred until after the level check:
+        pass printf-style args (tprint('debug', 'sent %dB', n)) instead of preformatting on hot paths.
+        """
+        level = LOG_LEVELS.get(log_type)
+        if level is None or not self.logger.isEnabledFor(level):
+            return
+        if args:
+            entry = entry % args
+        self.logger.log(level, ('%s: %s%s' % (self.tick, self.log_prefix, entry))[:MAXLINE])
 
 
     def signal_handler(self, rcv_signal, frame):
@@ -96,3 +138,6 @@ class FurnaceRuntime(object):
         endtime = time.time()
         self.tprint('info', 'shutting down after %s ticks (%s sec), %s inbound and %s outbound messages' % (self.tick, round(endtime - self._time_start, 3), self.msgin, self.msgout))
         self.tprint('info', '%s msgs per second' % (round((self.msgin + self.msgout) / (endtime - self._time_start), 3)))
+        if self.log_listener is not None:
+            self.log_listener.stop()  # flushes queued records
+            self.log_listener = None
@@ -0,0 +1,354 @@
+#-------------------------
+# Furnace (c) 2017-2018 Micah Bushouse
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#-------------------------
+"""
+Sharded Furnace backend.  A front process owns the FE-facing sockets and routes each FE ident to one of N worker processes.
+"""
+
+import collections
+import multiprocessing
+import os
+import signal
+import sys
+import tempfile
+import time
+import zlib
+
+# 3p
+import zmq
+
+# internal
+from constants import *
+import furnace_backend
+import furnace_backend_async
+import furnace_wire
+
+
+def shard_endpoints(ipc_dir, shards):
+    """
+    Internal use only.
+    :param ipc_dir: Directory holding the front<->worker IPC sockets.
+    :param shards: Number of workers.
+    :returns: Tuple of (list of per-worker dealer endpoints, broadcast endpoint).
+    """
+    dealers = [f'ipc://{ipc_dir}/shard-{i}' for i in range(shards)]
+    return dealers, f'ipc://{ipc_dir}/broadcast'
+
+
+def shard_of(ident, shards):
+    """
+    Internal use only.
+    Stable across processes and restarts, unlike hash().
+    :param ident: Raw ident frame of an app.
+    :param shards: Number of workers.
+    :returns: Index of the worker that owns this ident.
+    """
+    return zlib.crc32(ident) % shards
+
+
+class ShardBE(furnace_backend.BE):
+    """
+    Worker half of a sharded backend.  Runs the tenant exactly like BE, but talks to the front process over IPC instead of to FEs.
+    """
+
+    def __init__(self, kp, dealer_ep=None, broadcast_ep=None, **kwargs):
+        """
+        :param dealer_ep: This worker's dealer endpoint, from shard_endpoints.
+        :param broadcast_ep: The shared broadcast endpoint, from shard_endpoints.
+        :param kwargs: Passed to BE.
+        """
+        self.dealer_ep = dealer_ep
+        self.broadcast_ep = broadcast_ep
+        super(ShardBE, self).__init__(kp, **kwargs)
+
+
+    def open_sockets(self):
+        """
+        Internal use only.
+        The front process owns CURVE, so workers connect in plaintext over IPC.
+        broadcast() pushes to the front, which republishes on its PUB socket.
+        :returns: Nothing.
+        """
+        self.dealer_be = self.context.socket(zmq.DEALER)
+        self.configure_socket(self.dealer_be)
+        self.tprint('info', f'SHARD: Connecting as Dealer to {self.dealer_ep}')
+        self.dealer_be.connect(self.dealer_ep)
+
+        self.pub_be = self.context.socket(zmq.PUSH)
+        self.configure_socket(self.pub_be)
+        self.tprint('info', f'SHARD: Connecting as Pusher to {self.broadcast_ep}')
+        self.pub_be.connect(self.broadcast_ep)
+        self.startup.mark('bind')
+
+
+class ShardAsyncBE(ShardBE, furnace_backend_async.AsyncBE):
+    """
+    Worker half of a sharded backend, running the asyncio event loop.
+    """
+
+
+class ShardFront(furnace_backend.BE):
+    """
+    Front half of a sharded backend.  Binds the usual FE-facing sockets and forwards raw packets; never runs tenant code.
+    """
+
+    def __init__(self, kp, dealer_eps=None, broadcast_ep=None, procs=(), **kwargs):
+        """
+        :param dealer_eps: List of worker dealer endpoints, from shard_endpoints.
+        :param broadcast_ep: The shared broadcast endpoint, from shard_endpoints.
+        :param procs: The worker processes, in dealer_eps order.  The front exits if one dies, forwards SIGHUP to
+            them, and stops them on shutdown.
+        :param kwargs: Passed to BE.
+        """
+        super(ShardFront, self).__init__(kp, **kwargs)
+        self.name = 'shard_front'
+        self.procs = list(procs)
+
+        self.workers = []
+        self.worker_q = []  # per worker, packets waiting for room on its socket
+        self.worker_flags = []  # events each worker socket is registered for in the poller
+        self.worker_drops = 0  # packets to workers dropped by the send policy
+        for ep in dealer_eps:
+            sock = self.context.socket(zmq.DEALER)
+            sock.setsockopt(zmq.SNDHWM, self.sndhwm)
+            sock.bind(ep)
+            self.poller.register(sock, zmq.POLLIN)
+            self.workers.append(sock)
+            self.worker_q.append(collections.deque())
+            self.worker_flags.append(zmq.POLLIN)
+
+        self.pull_be = self.context.socket(zmq.PULL)
+        self.pull_be.bind(broadcast_ep)
+        self.poller.register(self.pull_be, zmq.POLLIN)
+
+        self.sentinels = {p.sentinel: i for i, p in enumerate(self.procs)}  # readable once the worker exits
+        for fd in self.sentinels:
+            self.poller.register(fd, zmq.POLLIN)
+
+
+    def loop(self):
+        """
+        Internal use only.
+        Routes FE packets to the worker owning their ident, worker packets back out to FEs, and worker broadcasts to the PUB socket.
+        No send blocks on a slow peer: FEs get send_fe's queueing and send policy, and so does each worker.
+        :returns: Nothing.
+        :raises: Exception when a worker process exits, so the front does not keep routing apps to it.
+        """
+        shards = len(self.workers)
+        while True:
+            if self.control_pending:
+                self.control()
+            socks = dict(self.poller.poll(TIMEOUT_BE))
+
+            for fd, i in self.sentinels.items():
+                if fd in socks:
+                    proc = self.procs[i]
+                    proc.join()
+                    raise Exception(f'shard worker {i} (pid {proc.pid}) exited with {proc.exitcode}')
+
+            dealer_ev = socks.get(self.dealer_be, 0)
+            if dealer_ev & zmq.POLLOUT:
+                self.flush_outq()
+
+            if dealer_ev & zmq.POLLIN:
+                pkt = self.dealer_be.recv_multipart()
+                self.msgin += 1
+                self.forward(shard_of(pkt[0], shards), pkt)
+
+            for i, sock in enumerate(self.workers):
+                ev = socks.get(sock, 0)
+                if ev & zmq.POLLOUT:
+                    self.flush_worker(i)
+                if ev & zmq.POLLIN:
+                    pkt = sock.recv_multipart()
+                    self.send_fe(pkt[0], pkt, len(pkt[-1]), reliable=len(pkt) == 3)  # SYNC replies are never dropped
+
+            if self.pull_be in socks:
+                self.send_pub(self.pull_be.recv())
+
+            self.tick += 1
+
+
+    def forward(self, i, pkt):
+        """
+        Internal use only.
+        Hands one FE packet to worker i without blocking, like send_fe: when the worker's socket is full, the packet
+        waits in the worker's queue of fe_queue_max packets.  A full queue drops it under SEND_DROP, or waits up to
+        SEND_TIMEOUT for room under SEND_BLOCK.  A dropped SYNC packet is answered with VMI_FAILURE.
+        :param i: Worker index, from shard_of.
+        :param pkt: Raw multipart packet, ident first.
+        :returns: True if sent or queued, False if dropped.
+        """
+        sock = self.workers[i]
+        q = self.worker_q[i]
+        if not q and self.try_send(sock, pkt):
+            return True
+        if len(q) >= self.fe_queue_max and self.send_policy == SEND_BLOCK:
+            deadline = time.monotonic() + SEND_TIMEOUT / 1000
+            while len(q) >= self.fe_queue_max:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0 or not sock.poll(int(remaining * 1000) + 1, zmq.POLLOUT):
+                    break
+                self.flush_worker(i)
+        if len(q) >= self.fe_queue_max:
+            self.worker_drops += 1
+            if self.worker_drops & (self.worker_drops - 1) == 0:  # 1, 2, 4, 8...
+                self.tprint('warning', 'queue to shard worker %d full, %d packets dropped so far', i,
+                            self.worker_drops)
+            if len(pkt) == 3:  # the FE is blocked on a reply
+                self.msg_in.ParseFromString(pkt[2])
+                raw_out = furnace_wire.be_msg_ret([(VMI_FAILURE, 'shard worker busy', None)] * len(self.msg_in.be_msg))
+                self.send_fe(pkt[0], [pkt[0], b'', raw_out], len(raw_out), reliable=True)
+            return False
+        q.append(pkt)
+        self.worker_poll(i)
+        return True
+
+
+    def flush_worker(self, i):
+        """
+        Internal use only.
+        Sends worker i's queued packets until its socket fills up again.
+        :returns: Nothing.
+        """
+        q = self.worker_q[i]
+        while q and self.try_send(self.workers[i], q[0]):
+            q.popleft()
+        self.worker_poll(i)
+
+
+    def worker_poll(self, i):
+        """
+        Internal use only.
+        Registers worker i's socket for writes while it has queued packets.
+        :returns: Nothing.
+        """
+        flags = zmq.POLLIN | (zmq.POLLOUT if self.worker_q[i] else 0)
+        if flags != self.worker_flags[i]:
+            self.poller.register(self.workers[i], flags)
+            self.worker_flags[i] = flags
+
+
+    def control_signal(self, signum, frame):
+        """
+        Internal use only.
+        The tenant runs in the workers, so SIGHUP (hot reload) goes to them.  Other signals profile the front.
+        :returns: Nothing.
+        """
+        if signum == signal.SIGHUP:
+            for proc in self.procs:
+                if proc.is_alive():
+                    os.kill(proc.pid, signum)
+            return
+        super(ShardFront, self).control_signal(signum, frame)
+
+
+    def shutdown(self):
+        """
+        Supported API call.
+        Exit cleanly, stopping the worker processes.
+        :returns: Nothing.
+        """
+        if not self.already_shutdown:
+            for fd in getattr(self, 'sentinels', {}):
+                self.poller.unregister(fd)
+            for proc in getattr(self, 'procs', []):
+                if proc.is_alive():
+                    proc.terminate()
+            for proc in getattr(self, 'procs', []):
+                proc.join(SHARD_STOP_TIMEOUT)
+                if proc.is_alive():
+                    proc.kill()
+            for sock in getattr(self, 'workers', []):
+                self.poller.unregister(sock)
+                sock.close(linger=0)
+            if hasattr(self, 'pull_be'):
+                self.poller.unregister(self.pull_be)
+                self.pull_be.close()
+        super(ShardFront, self).shutdown()
+
+
+def shard_worker(start_tenant, kp, dealer_ep, broadcast_ep, use_asyncio, metrics_port, kv_path, kv_cache_bytes,
+                 capture_path, capture_max_bytes, be_kwargs):
+    """
+    Internal use only.
+    Entry point of each forked worker process.
+    :param start_tenant: Function taking a BE instance; loads the tenant and runs the loop.
+    :param be_kwargs: Passed to the BE constructor.
+    :returns: Nothing.
+    """
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))  # the front stopping us, see ShardFront.shutdown
+    be_class = ShardAsyncBE if use_asyncio else ShardBE
+    bei = be_class(kp, dealer_ep=dealer_ep, broadcast_ep=broadcast_ep, **be_kwargs)
+    if metrics_port is not None:
+        bei.start_metrics(metrics_port)
+    if kv_path is not None:
+        bei.start_kv(kv_path, max_bytes=kv_cache_bytes)
+    if capture_path is not None:
+        bei.start_capture(capture_path, max_bytes=capture_max_bytes)
+    try:
+        start_tenant(bei)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        if not bei.already_shutdown:
+            bei.shutdown()  # flushes the KV store and capture
+
+
+def run_sharded(start_tenant, shards, kp, be_base_port=5561, use_asyncio=False, metrics_port=None, log_file=None,
+                kv_path=None, kv_cache_bytes=KV_CACHE_BYTES, capture_path=None, capture_max_bytes=CAPTURE_MAX_BYTES,
+                **be_kwargs):
+    """
+    Starts shards worker processes, then runs the front process in the caller.
+    Workers are forked before the front creates its ZMQ context.  If any worker exits, the front stops the others and
+    raises, rather than keep routing that worker's apps to nobody; restarting is left to the service manager.
+    :param start_tenant: Function taking a BE instance; loads the tenant and runs the loop.
+    :param shards: Number of worker processes.
+    :param metrics_port: If set, the front serves metrics on this port and worker i on metrics_port+1+i.
+    :param log_file: If set, the front logs to this file and worker i to log_file.i.
+    :param kv_path: If set, worker i persists its KV store to kv_path.i.  Each worker serves the apps routed to it,
+        so apps on different workers do not share keys.
+    :param capture_path: If set, worker i captures the packets routed to it to capture_path.i.
+    :param be_kwargs: Passed to the BE constructor of the front and every worker (debug, be_ip, sndhwm, ...).  With
+        ipc_dir, the front binds its FE-facing sockets there without CURVE.
+    :returns: Nothing.
+    """
+    shard_dir = tempfile.mkdtemp(prefix=f'furnace-{be_base_port}-')
+    dealer_eps, broadcast_ep = shard_endpoints(shard_dir, shards)
+
+    mp = multiprocessing.get_context('fork')
+    procs = []
+    for i, ep in enumerate(dealer_eps):
+        worker_metrics = metrics_port + 1 + i if metrics_port is not None else None
+        worker_kv = f'{kv_path}.{i}' if kv_path else None
+        worker_capture = f'{capture_path}.{i}' if capture_path else None
+        worker_kwargs = dict(be_kwargs, be_base_port=be_base_port, log_file=f'{log_file}.{i}' if log_file else None)
+        p = mp.Process(target=shard_worker, daemon=True,
+                       args=(start_tenant, kp, ep, broadcast_ep, use_asyncio, worker_metrics, worker_kv, kv_cache_bytes,
+                             worker_capture, capture_max_bytes, worker_kwargs))
+        p.start()
+        procs.append(p)
+
+    front = ShardFront(kp, dealer_eps=dealer_eps, broadcast_ep=broadcast_ep, procs=procs, be_base_port=be_base_port,
+                       log_file=log_file, **be_kwargs)
+    if metrics_port is not None:
+        front.start_metrics(metrics_port)
+        front.metrics.gauges['furnace_shard_drops'] = lambda: front.worker_drops
+    front.tprint('info', f'started {shards} shard workers: {[p.pid for p in procs]}')
+    try:
+        front.loop()
+    finally:
+        front.shutdown()
@@ -0,0 +1,353 @@
+#-------------------------
+# Furnace (c) 2017-2018 Micah Bushouse
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#-------------------------
+"""
+Credit-based bulk transfer streams from apps to the backend.
+
+Protocol, carried in be_msg stream/op/offset/credit fields (ASYNC only):
+    app -> BE  STREAM_OPEN   stream, value=name, offset=total size (0 if unknown)
+    BE -> app  STREAM_CREDIT stream, offset=bytes received in order, credit=bytes the app may send past offset
+    app -> BE  STREAM_DATA   stream, offset, data (never compressed, see StreamManager.handle)
+    app -> BE  STREAM_CLOSE  stream, offset=total bytes sent
+    BE -> app  STREAM_ABORT  stream, value=reason
+The first CREDIT after an OPEN carries the resume offset; apps start sending from there.
+"""
+
+import collections
+import mmap
+import os
+import re
+
+# internal
+from constants import *
+
+StreamCtx = collections.namedtuple('StreamCtx', 'ident stream name size')
+
+
+class FileSink(object):
+    """
+    Stream sink that writes chunks straight to a file at their offsets.
+    The number of bytes received in order is checkpointed to [path].offset, since the file's length says nothing
+    about it once the file is preallocated.
+    """
+
+    def __init__(self, path, size=0, resume=False):
+        """
+        :param path: Output file.
+        :param size: If nonzero and not resuming, the file is truncated to this size up front (sparse).
+        :param resume: If True and the file exists, keep its contents and resume from its last checkpoint.  Without
+            one the transfer starts over from 0.
+        """
+        self.path = path
+        self.offset_path = path + '.offset'
+        self.offset = 0
+        if resume and os.path.exists(path):
+            self.fd = os.open(path, os.O_WRONLY)
+            try:
+                with open(self.offset_path) as f:
+                    self.offset = int(f.read())
+            except (OSError, ValueError):
+                self.offset = 0
+        else:
+            self.fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+            if size:
+                os.ftruncate(self.fd, size)
+        self.checkpointed = self.offset
+        self.checkpoint()
+
+
+    def write(self, offset, data):
+        """
+        :param offset: Byte offset of data within the stream.  The StreamManager writes in order.
+        :param data: bytes-like chunk.
+        :returns: Nothing.
+        """
+        os.pwrite(self.fd, data, offset)
+        self.offset = offset + len(data)
+        if self.offset - self.checkpointed >= STREAM_CHECKPOINT:
+            self.checkpoint()
+
+
+    def checkpoint(self):
+        """
+        Internal use only.
+        Records self.offset in the offset file, after the data it covers was written.
+        :returns: Nothing.
+        """
+        tmp = self.offset_path + '.tmp'
+        with open(tmp, 'w') as f:
+            f.write(str(self.offset))
+        os.replace(tmp, self.offset_path)
+        self.checkpointed = self.offset
+
+
+    def close(self, complete):
+        """
+        :param complete: True if every byte up to the app's declared total arrived.
+        :returns: Nothing.
+        """
+        self.checkpoint()
+        os.close(self.fd)
+
+
+class MmapSink(object):
+    """
+    Stream sink backed by a sparse, memory-mapped file, e.g. a guest memory image.
+    Chunks are copied into the mapping at their offsets; view() lets analysis code read the image without another copy.
+    """
+
+    def __init__(self, path, size=0):
+        """
+        :param path: Output file.
+        :param size: Expected size.  The file is preallocated (sparse) to this size and grows by doubling if exceeded.
+        """
+        self.path = path
+        self.offset = 0
+        self.length = 0  # highest byte written, plus one
+        self.declared = size
+        self.size = max(size, mmap.PAGESIZE)
+        self.fd = os.open(path, os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0o600)
+        os.ftruncate(self.fd, self.size)
+        self.mm = mmap.mmap(self.fd, self.size)
+
+
+    @classmethod
+    def for_ident(cls, directory, ident, size=0):
+        """
+        :param directory: Directory to hold the image.
+        :param ident: String ID of the app; sanitized into the file name.
+        :param size: Expected size, see __init__.
+        :returns: A MmapSink writing to [directory]/[ident].img
+        """
+        name = re.sub(r'[^\w.-]', '_', ident)
+        return cls(os.path.join(directory, f'{name}.img'), size=size)
+
+
+    def write(self, offset, data):
+        """
+        :param offset: Byte offset of data within the image.
+        :param data: bytes-like chunk.
+        :returns: Nothing.
+        """
+        end = offset + len(data)
+        if end > self.size:
+            self.size = max(end, self.size * 2)
+            self.mm.resize(self.size)
+        self.mm[offset:end] = data
+        if end > self.length:
+            self.length = end
+
+
+    def view(self):
+        """
+        :returns: A memoryview over the bytes written so far.  Release it before calling close.
+        """
+        return memoryview(self.mm)[:self.length]
+
+
+    def close(self, complete=True):
+        """
+        Unmaps the image and trims any growth slack from the file.
+        :param complete: Unused, part of the sink interface.
+        :returns: Nothing.
+        """
+        self.mm.close()
+        os.ftruncate(self.fd, max(self.length, self.declared))
+        os.close(self.fd)
+
+
+class Stream(object):
+    """
+    Receive-side state of one stream.
+    """
+
+    __slots__ = ('ident', 'stream', 'sink', 'acked', 'granted', 'total', 'pending', 'pending_bytes')
+
+    def __init__(self, ident, stream, sink, acked):
+        self.ident = ident
+        self.stream = stream
+        self.sink = sink
+        self.acked = acked  # every byte below this offset was handed to the sink, in order
+        self.granted = acked  # offset we last granted credit from
+        self.total = None  # set by STREAM_CLOSE
+        self.pending = {}  # offset -> out of order chunk, bounded by the window
+        self.pending_bytes = 0
+
+
+class StreamManager(object):
+    """
+    Tracks every open stream, reassembles chunks in order, and grants credit as the sink drains.
+    """
+
+    def __init__(self, callback, send, log, window=STREAM_WINDOW):
+        """
+        :param callback: Tenant function, called with a StreamCtx on STREAM_OPEN.  Returns a sink (an object with
+            write(offset, data) and close(complete), and optionally an 'offset' attribute to resume from) or None to refuse.
+        :param send: Function (ident, stream, op, offset, credit, value) that sends a control be_msg to an app.
+        :param log: Function (log_type, entry, *args), i.e. tprint.
+        :param window: Max bytes an app may have in flight per stream.
+        """
+        self.callback = callback
+        self.send = send
+        self.log = log
+        self.window = window
+        self.streams = {}  # (ident, stream) -> Stream
+        self.bytes_in = 0
+
+
+    def handle(self, ident, submsg):
+        """
+        Handles one stream-op be_msg.  Offsets and credit count the bytes written to the sink, and chunks may arrive
+        out of order, so they cannot go through the app's streaming decompressor: a compressed chunk aborts its stream.
+        :param ident: String ID of the sending app.
+        :param submsg: The inbound be_msg.
+        :returns: Nothing.
+        """
+        op = submsg.op
+        key = (ident, submsg.stream)
+        if op == STREAM_DATA:
+            st = self.streams.get(key)
+            if st is None:
+                self.send(ident, submsg.stream, STREAM_ABORT, 0, 0, 'unknown stream')
+                return
+            if submsg.codec:
+                self.log('warn', 'stream %s/%s sent compressed data, aborting', ident, submsg.stream)
+                del self.streams[key]
+                st.sink.close(False)
+                self.send(ident, submsg.stream, STREAM_ABORT, 0, 0, 'compressed stream data is not supported')
+                return
+            self.on_data(st, submsg.offset, submsg.data)
+        elif op == STREAM_OPEN:
+            self.on_open(key, submsg)
+        elif op == STREAM_CLOSE:
+            st = self.streams.get(key)
+            if st is not None:
+                st.total = submsg.offset
+                self.maybe_finish(st)
+        else:
+            self.log('error', 'unknown stream op %s from %s', op, ident)
+
+
+    def on_open(self, key, submsg):
+        """
+        Internal use only.
+        Asks the tenant for a sink, then grants the first window from the sink's resume offset.
+        """
+        ident, stream = key
+        old = self.streams.pop(key, None)
+        if old is not None:
+            old.sink.close(False)
+
+        sink = self.callback(StreamCtx(ident=ident, stream=stream, name=submsg.value, size=submsg.offset))
+        if sink is None:
+            self.send(ident, stream, STREAM_ABORT, 0, 0, 'refused')
+            return
+
+        st = Stream(ident, stream, sink, getattr(sink, 'offset', 0))
+        self.streams[key] = st
+        self.log('debug', 'stream %s open, resuming at %d', key, st.acked)
+        self.send(ident, stream, STREAM_CREDIT, st.acked, self.window, '')
+
+
+    def on_data(self, st, offset, data):
+        """
+        Internal use only.
+        Writes in-order chunks, parks out-of-order chunks until the gap fills, and drops anything outside the window.
+        """
+        size = len(data)
+        if offset + size <= st.acked:
+            return  # duplicate, e.g. retransmitted after a resume
+        if offset + size > st.granted + self.window:
+            self.log('warn', 'stream %s/%s sent past its credit, dropping %dB at %d', st.ident, st.stream, size, offset)
+            return
+
+        self.bytes_in += size
+        if offset > st.acked:
+            parked = st.pending.get(offset)
+            if parked is None or len(parked) < size:  # keep the longer of two retransmits at one offset
+                st.pending[offset] = data
+                st.pending_bytes += size - (len(parked) if parked is not None else 0)
+            return
+
+        if offset < st.acked:  # overlaps what we already have
+            data = memoryview(data)[st.acked - offset:]
+            offset = st.acked
+        st.sink.write(offset, data)
+        st.acked = offset + len(data)
+        if st.pending:
+            self.drain(st)
+
+        if self.maybe_finish(st):
+            return
+
+        if st.acked - st.granted >= self.window // 2:
+            st.granted = st.acked
+            self.send(st.ident, st.stream, STREAM_CREDIT, st.acked, self.window, '')
+
+
+    def drain(self, st):
+        """
+        Internal use only.
+        Writes the parked chunks the in-order data now reaches.  Retransmits after a resume or a new grant may be cut
+        at other boundaries, so a chunk starting inside the acknowledged bytes is trimmed, and one they fully cover
+        is discarded.
+        :returns: Nothing.
+        """
+        while st.pending:
+            reached = sorted(o for o in st.pending if o <= st.acked)
+            if not reached:
+                return
+            for offset in reached:
+                chunk = st.pending.pop(offset)
+                st.pending_bytes -= len(chunk)
+                end = offset + len(chunk)
+                if end > st.acked:
+                    st.sink.write(st.acked, memoryview(chunk)[st.acked - offset:])
+                    st.acked = end
+
+
+    def maybe_finish(self, st):
+        """
+        Internal use only.
+        Closes the sink once STREAM_CLOSE arrived and every byte up to its total is written.
+        :returns: True if the stream finished.
+        """
+        if st.total is None or st.acked < st.total:
+            return False
+        del self.streams[(st.ident, st.stream)]
+        st.sink.close(True)
+        self.send(st.ident, st.stream, STREAM_CREDIT, st.acked, 0, '')
+        self.log('debug', 'stream %s/%s complete, %dB', st.ident, st.stream, st.acked)
+        return True
+
+
+    def drop(self, ident):
+        """
+        Closes every stream belonging to an app, leaving the sinks incomplete.
+        :param ident: String ID of the app.
+        :returns: Nothing.
+        """
+        for key in [k for k in self.streams if k[0] == ident]:
+            self.streams.pop(key).sink.close(False)
+
+
+    def close_all(self):
+        """
+        Closes every open stream, leaving the sinks incomplete.
+        :returns: Nothing.
+        """
+        while self.streams:
+            self.streams.popitem()[1].sink.close(False)
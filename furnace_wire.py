@@ -0,0 +1,181 @@
+#-------------------------
+# Furnace (c) 2017-2018 Micah Bushouse
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#-------------------------
+"""
+Direct wire encoding of the backend's outbound BE_MSG, BE_MSG_RET, GET_RET and SET_RET envelopes.
+The output is byte-for-byte what FacMessage.SerializeToString() produces for the same content,
+without building a message object per send.  Must be kept in step with facilities.proto.
+"""
+
+# internal
+import facilities_pb2
+
+# FacMessage.Type values, resolved once from the descriptor
+MSG_TYPES = {name: facilities_pb2.FacMessage.Type.Value(name) for name in facilities_pb2.FacMessage.Type.keys()}
+
+# FacMessage header: field 1 (type, varint), one entry per submessage
+_TYPE_BE_MSG = bytes((0x08, MSG_TYPES['BE_MSG']))
+_TYPE_BE_MSG_RET = bytes((0x08, MSG_TYPES['BE_MSG_RET']))
+
+# length-delimited tags of FacMessage.be_msg (4), FacMessage.be_msg_ret (7) and FacMessage.topic (8)
+_TAG_BE_MSG = b'\x22'
+_TAG_BE_MSG_RET = b'\x3a'
+_TAG_TOPIC = b'\x42'
+
+# FacMessage.codecs (9), repeated varint
+_TAG_CODECS = b'\x48'
+
+# length-delimited tags of FacMessage.get_ret (5) and FacMessage.set_ret (6), and their fields
+_TYPE_KV = {'GET_RET': bytes((0x08, MSG_TYPES['GET_RET'])), 'SET_RET': bytes((0x08, MSG_TYPES['SET_RET']))}
+_TAG_GET_RET = b'\x2a'
+_TAG_SET_RET = b'\x32'
+_TAG_KEY = b'\x0a'
+_TAG_GET_RESULT = b'\x18'
+_TAG_SET_RESULT = b'\x10'
+
+# Be_msg / Be_msg_ret field tags
+_TAG_STATUS = b'\x08'
+_TAG_VALUE = b'\x12'
+_TAG_DATA = b'\x1a'
+_TAG_STREAM = b'\x20'
+_TAG_OP = b'\x28'
+_TAG_OFFSET = b'\x30'
+_TAG_CREDIT = b'\x38'
+_TAG_CODEC = b'\x40'
+
+_SMALL = [bytes((i,)) for i in range(0x80)]
+
+
+def varint(n):
+    """
+    :param n: Non-negative integer.
+    :returns: n encoded as a protobuf varint.
+    """
+    if n < 0x80:
+        return _SMALL[n]
+    out = bytearray()
+    while n >= 0x80:
+        out.append((n & 0x7f) | 0x80)
+        n >>= 7
+    out.append(n)
+    return bytes(out)
+
+
+def _sub(status, value, data):
+    """
+    Internal use only.
+    :returns: List of byte strings making up one Be_msg/Be_msg_ret body.
+    """
+    parts = [_TAG_STATUS, varint(status)]
+    if value is not None:
+        raw = value.encode() if isinstance(value, str) else value
+        parts += (_TAG_VALUE, varint(len(raw)), raw)
+    if data is not None:
+        parts += (_TAG_DATA, varint(len(data)), data)
+    return parts
+
+
+def be_msg(status, value=None, data=None, codec=None):
+    """
+    :param status: VMI_SUCCESS or VMI_FAILURE.
+    :param value: str (or UTF-8 bytes) for the value field, or None to leave it unset.
+    :param data: bytes or bytearray payload for the data field, or None to leave it unset.
+    :param codec: The codec data was compressed with, or None to leave the codec field unset.
+    :returns: A serialized FacMessage holding a single BE_MSG.
+    """
+    parts = _sub(status, value, data)
+    if codec is not None:
+        parts += (_TAG_CODEC, varint(codec))
+    body = b''.join(parts)
+    return b''.join((_TYPE_BE_MSG, _TAG_BE_MSG, varint(len(body)), body))
+
+
+def topic_prefix(topic):
+    """
+    Topic broadcasts lead with the FacMessage.topic field, so an app's SUB socket filters on this prefix.
+    The length is part of the prefix, so subscribing to 'vm1' does not also match 'vm10'.
+    :param topic: Topic name.
+    :returns: The subscription prefix, for setsockopt(zmq.SUBSCRIBE, ...).
+    """
+    raw = topic.encode()
+    return b''.join((_TAG_TOPIC, varint(len(raw)), raw))
+
+
+def be_msg_topic(topic, status, value=None, data=None, codec=None):
+    """
+    Same as be_msg, with FacMessage.topic leading.  Apps that subscribe to everything still parse it as a plain BE_MSG.
+    :param topic: Topic name.
+    :returns: A serialized FacMessage holding a single BE_MSG.
+    """
+    return topic_prefix(topic) + be_msg(status, value, data, codec)
+
+
+def codecs(ids):
+    """
+    :param ids: List of codec IDs.
+    :returns: A serialized FacMessage holding only the codecs field.  Concatenate it with another serialized
+        FacMessage to add the field to that message.
+    """
+    return b''.join(_TAG_CODECS + varint(i) for i in ids)
+
+
+def be_msg_stream(status, stream, op, offset, credit, value):
+    """
+    :returns: A serialized FacMessage holding a single stream control BE_MSG, see furnace_stream.py.
+    """
+    parts = _sub(status, value, None)
+    parts += (_TAG_STREAM, varint(stream), _TAG_OP, varint(op), _TAG_OFFSET, varint(offset),
+              _TAG_CREDIT, varint(credit))
+    body = b''.join(parts)
+    return b''.join((_TYPE_BE_MSG, _TAG_BE_MSG, varint(len(body)), body))
+
+
+def be_msg_ret(rets):
+    """
+    :param rets: List of (status, value, data) tuples, one per BE_MSG_RET; value and data may be None.
+    :returns: A serialized FacMessage holding one BE_MSG_RET per entry.
+    """
+    parts = [_TYPE_BE_MSG_RET * len(rets)]
+    for status, value, data in rets:
+        body = b''.join(_sub(status, value, data))
+        parts += (_TAG_BE_MSG_RET, varint(len(body)), body)
+    return b''.join(parts)
+
+
+def kv_ret(rets):
+    """
+    :param rets: List of (msgtype, key, value, result), msgtype being 'GET_RET' or 'SET_RET', in request order.
+        value is the found string for a GET_RET, or None; it is ignored for SET_RET.
+    :returns: A serialized FacMessage holding the get_ret and set_ret entries.
+    """
+    types = []
+    gets = []
+    sets = []
+    for msgtype, key, value, result in rets:
+        raw = key.encode()
+        types.append(_TYPE_KV[msgtype])
+        if msgtype == 'GET_RET':
+            parts = [_TAG_KEY, varint(len(raw)), raw]
+            if value is not None:
+                val = value.encode()
+                parts += (_TAG_VALUE, varint(len(val)), val)
+            parts += (_TAG_GET_RESULT, varint(result))
+            body = b''.join(parts)
+            gets += (_TAG_GET_RET, varint(len(body)), body)
+        else:
+            body = b''.join((_TAG_KEY, varint(len(raw)), raw, _TAG_SET_RESULT, varint(result)))
+            sets += (_TAG_SET_RET, varint(len(body)), body)
+    return b''.join(types + gets + sets)
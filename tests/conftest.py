@@ -0,0 +1,37 @@
+#-------------------------
+# Furnace (c) 2017-2018 Micah Bushouse
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#-------------------------
+"""
+Shared pytest setup.  The backend's modules live flat in the repository root, and facilities_pb2 is generated from
+facilities.proto at install time (see README); if it has not been, it is generated for the test session.
+"""
+
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+try:
+    import facilities_pb2
+except ImportError:
+    if shutil.which('protoc'):
+        out = tempfile.mkdtemp(prefix='furnace_pb2')
+        subprocess.run(['protoc', f'--proto_path={ROOT}', f'--python_out={out}', 'facilities.proto'], check=True)
+        sys.path.insert(0, out)
@@ -0,0 +1,104 @@
+#-------------------------
+# Furnace (c) 2017-2018 Micah Bushouse
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#-------------------------
+"""
+Tests for FE_BATCH dispatch in furnace_backend.BE: one reply per SYNC packet, and VMI_FAILURE when the callback fails.
+"""
+
+import pytest
+
+facilities_pb2 = pytest.importorskip('facilities_pb2')
+
+from constants import *
+import furnace_backend
+
+
+def packet(ident, sync, *values):
+    msg = facilities_pb2.FacMessage()
+    for value in values:
+        msg.type.append(msg.BE_MSG)
+        msg.be_msg.add(status=VMI_SUCCESS, value=value)
+    raw = msg.SerializeToString()
+    return [ident, b'', raw] if sync else [ident, raw]
+
+
+@pytest.fixture
+def bei(tmp_path):
+    bei = furnace_backend.BE({}, ipc_dir=str(tmp_path / 'ipc'))
+    bei.replies = []
+
+    def send_sync(ident, raw_out, t0=None):
+        msg = facilities_pb2.FacMessage()
+        msg.ParseFromString(raw_out)
+        bei.replies.append((ident, [(r.status, r.value) for r in msg.be_msg_ret]))
+
+    bei.send_sync = send_sync
+    yield bei
+    bei.shutdown()
+
+
+def register(bei, callback):
+    bei.event_register({'event_type': FE_BATCH, 'callback': callback})
+
+
+PKTS = [packet(b'a', True, 'x', 'y'), packet(b'b', False, 'z'), packet(b'c', True, 'w')]
+
+
+def test_replies_per_sync_packet(bei):
+    seen = []
+
+    def cb(ctx_list):
+        seen.extend((c.ident, c.sync, c.message) for c in ctx_list)
+        return ['r:' + c.message for c in ctx_list]
+
+    register(bei, cb)
+    bei.dispatch_batch(PKTS)
+    assert seen == [('a', SYNC, 'x'), ('a', SYNC, 'y'), ('b', ASYNC, 'z'), ('c', SYNC, 'w')]
+    assert bei.replies == [(b'a', [(VMI_SUCCESS, 'r:x'), (VMI_SUCCESS, 'r:y')]), (b'c', [(VMI_SUCCESS, 'r:w')])]
+
+
+def test_raising_callback_fails_every_sync_packet(bei):
+    def cb(ctx_list):
+        raise ValueError('boom')
+
+    register(bei, cb)
+    bei.dispatch_batch(PKTS)
+    assert bei.replies == [(b'a', [(VMI_FAILURE, 'boom')] * 2), (b'c', [(VMI_FAILURE, 'boom')])]
+
+
+def test_short_return_list_fails_every_sync_packet(bei):
+    register(bei, lambda ctx_list: ['only one'])
+    bei.dispatch_batch(PKTS)
+    assert [ident for ident, rets in bei.replies] == [b'a', b'c']
+    assert all(status == VMI_FAILURE for ident, rets in bei.replies for status, value in rets)
+    assert [len(rets) for ident, rets in bei.replies] == [2, 1]
+
+
+def test_unencodable_reply_fails_only_that_entry(bei):
+    register(bei, lambda ctx_list: ['ok', None, 'ignored', 'ok'])
+    bei.dispatch_batch(PKTS)
+    assert bei.replies[0][1][0] == (VMI_SUCCESS, 'ok')
+    assert bei.replies[0][1][1][0] == VMI_FAILURE
+    assert bei.replies[1] == (b'c', [(VMI_SUCCESS, 'ok')])
+
+
+def test_async_only_batch_survives_a_raising_callback(bei):
+    def cb(ctx_list):
+        raise ValueError('boom')
+
+    register(bei, cb)
+    bei.dispatch_batch([packet(b'b', False, 'z')])
+    assert bei.replies == []
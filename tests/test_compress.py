@@ -0,0 +1,107 @@
+#-------------------------
+# Furnace (c) 2017-2018 Micah Bushouse
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#-------------------------
+"""
+Tests for furnace_compress: codec choice, outbound frames and the per-app inbound decoders.
+"""
+
+import os
+import zlib
+
+import pytest
+
+from constants import *
+import furnace_compress
+
+DATA = b'furnace memory page ' * 500
+
+
+def test_choose_first_available():
+    assert furnace_compress.choose([99, CODEC_ZLIB]) == CODEC_ZLIB
+    assert furnace_compress.choose([99]) == CODEC_NONE
+    assert furnace_compress.choose([]) == CODEC_NONE
+
+
+def test_compress_thresholds():
+    assert furnace_compress.compress(CODEC_NONE, DATA) == (DATA, None)
+    assert furnace_compress.compress(CODEC_ZLIB, b'short', min_bytes=1024) == (b'short', None)
+    noise = os.urandom(512)
+    assert furnace_compress.compress(CODEC_ZLIB, noise, min_bytes=0) == (noise, None)  # would not shrink
+    payload, codec = furnace_compress.compress(CODEC_ZLIB, DATA)
+    assert codec == CODEC_ZLIB and len(payload) < len(DATA)
+    assert zlib.decompress(payload) == DATA
+
+
+@pytest.mark.parametrize('cid', sorted(furnace_compress.CODECS))
+def test_self_contained_frames_round_trip(cid):
+    dec = furnace_compress.Decoders()
+    for i in range(3):
+        payload, codec = furnace_compress.compress(cid, DATA + bytes([i]), min_bytes=0)
+        assert dec.decompress('vm1', codec, payload) == DATA + bytes([i])
+
+
+def test_app_stream_flushed_at_message_boundaries():
+    dec = furnace_compress.Decoders()
+    cobj = zlib.compressobj()
+    parts = [DATA[:3000], DATA[3000:7000], DATA[7000:]]
+    out = [dec.decompress('vm1', CODEC_ZLIB, cobj.compress(p) + cobj.flush(zlib.Z_SYNC_FLUSH)) for p in parts]
+    assert out == parts
+
+
+def test_decoders_are_per_app():
+    dec = furnace_compress.Decoders()
+    a = zlib.compressobj()
+    b = zlib.compressobj()
+    first_a = a.compress(b'aaaa' * 100) + a.flush(zlib.Z_SYNC_FLUSH)
+    first_b = b.compress(b'bbbb' * 100) + b.flush(zlib.Z_SYNC_FLUSH)
+    assert dec.decompress('a', CODEC_ZLIB, first_a) == b'aaaa' * 100
+    assert dec.decompress('b', CODEC_ZLIB, first_b) == b'bbbb' * 100
+    assert dec.decompress('a', CODEC_ZLIB, a.compress(b'x') + a.flush(zlib.Z_SYNC_FLUSH)) == b'x'
+
+
+def test_new_stream_after_a_broken_one():
+    dec = furnace_compress.Decoders()
+    cobj = zlib.compressobj()
+    dec.decompress('vm1', CODEC_ZLIB, cobj.compress(b'abc') + cobj.flush(zlib.Z_SYNC_FLUSH))
+    assert dec.decompress('vm1', CODEC_ZLIB, zlib.compress(DATA)) == DATA  # the app restarted its stream
+
+
+def test_corrupt_payload_raises_and_resets():
+    dec = furnace_compress.Decoders()
+    with pytest.raises(Exception):
+        dec.decompress('vm1', CODEC_ZLIB, b'not zlib at all')
+    assert 'vm1' not in dec.streams
+    assert dec.decompress('vm1', CODEC_ZLIB, zlib.compress(b'ok')) == b'ok'
+
+
+def test_unknown_codec_raises():
+    with pytest.raises(Exception):
+        furnace_compress.Decoders().decompress('vm1', 99, b'')
+
+
+def test_expansion_limit():
+    dec = furnace_compress.Decoders(max_raw=1000)
+    with pytest.raises(Exception):
+        dec.decompress('vm1', CODEC_ZLIB, zlib.compress(bytes(5000)))
+    assert dec.decompress('vm1', CODEC_ZLIB, zlib.compress(bytes(1000))) == bytes(1000)
+
+
+def test_drop_forgets_context():
+    dec = furnace_compress.Decoders()
+    dec.decompress('vm1', CODEC_ZLIB, zlib.compress(b'x'))
+    dec.drop('vm1')
+    dec.drop('vm1')
+    assert 'vm1' not in dec.streams
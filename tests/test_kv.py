@@ -0,0 +1,140 @@
+#-------------------------
+# Furnace (c) 2017-2018 Micah Bushouse
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#-------------------------
+"""
+Tests for furnace_kv: the LRU cache and SQLite write-behind.
+"""
+
+import sqlite3
+
+import furnace_kv
+
+
+class FailingDB(object):
+    """
+    Wraps an sqlite3 connection and fails every write, as a full disk would.
+    """
+
+    def __init__(self, db):
+        self.db = db
+
+    def __enter__(self):
+        return self.db.__enter__()
+
+    def __exit__(self, *exc):
+        return self.db.__exit__(*exc)
+
+    def execute(self, *args):
+        return self.db.execute(*args)
+
+    def executemany(self, *args):
+        raise sqlite3.OperationalError('database or disk is full')
+
+
+def rows(path):
+    with sqlite3.connect(path) as db:
+        return dict(db.execute('SELECT key, value FROM kv'))
+
+
+def test_lru_evicts_least_recently_used():
+    kv = furnace_kv.KVStore(max_bytes=6)  # three 1-char keys with 1-char values
+    kv.set('a', '1')
+    kv.set('b', '2')
+    kv.set('c', '3')
+    assert kv.get('a') == '1'  # now most recently used
+    kv.set('d', '4')
+    assert kv.get('b') is None
+    assert [kv.get(k) for k in 'acd'] == ['1', '3', '4']
+    assert kv.cache_bytes == 6
+
+
+def test_set_refreshes_value_and_size():
+    kv = furnace_kv.KVStore()
+    kv.set('k', 'short')
+    kv.set('k', 'longer value')
+    assert kv.get('k') == 'longer value'
+    assert kv.cache_bytes == len('k') + len('longer value')
+
+
+def test_write_behind_until_flush(tmp_path):
+    path = str(tmp_path / 'kv.db')
+    kv = furnace_kv.KVStore(path)
+    kv.set('a', '1')
+    assert rows(path) == {}
+    assert kv.flush() == 1
+    assert rows(path) == {'a': '1'}
+    assert kv.flush() == 0
+    kv.close()
+
+
+def test_flush_when_dirty_limit_reached(tmp_path):
+    path = str(tmp_path / 'kv.db')
+    kv = furnace_kv.KVStore(path, max_dirty=3)
+    kv.set('a', '1')
+    kv.set('b', '2')
+    assert rows(path) == {}
+    kv.set('c', '3')
+    assert rows(path) == {'a': '1', 'b': '2', 'c': '3'}
+    assert kv.dirty == {}
+    kv.close()
+
+
+def test_evicted_keys_read_back_from_file(tmp_path):
+    path = str(tmp_path / 'kv.db')
+    kv = furnace_kv.KVStore(path, max_bytes=2)
+    kv.set('a', '1')
+    kv.set('b', '2')  # evicts a from the cache, it is still pending
+    assert kv.get('a') == '1'
+    kv.flush()
+    kv.set('c', '3')
+    assert kv.get('b') == '2'
+    kv.close()
+    assert furnace_kv.KVStore(path).get('c') == '3'
+
+
+def test_failed_flush_keeps_sets_pending(tmp_path):
+    path = str(tmp_path / 'kv.db')
+    logged = []
+    kv = furnace_kv.KVStore(path, log=lambda level, fmt, *args: logged.append(level))
+    kv.set('a', '1')
+    db = kv.db
+    kv.db = FailingDB(db)
+    assert kv.try_flush() == 0
+    assert kv.dirty == {'a': '1'}
+    assert kv.flush_failures == 1
+    assert logged == ['error']
+
+    kv.db = db
+    kv.set('b', '2')
+    assert kv.try_flush() == 2
+    assert kv.dirty == {}
+    assert rows(path) == {'a': '1', 'b': '2'}
+    kv.close()
+
+
+def test_failed_early_flush_does_not_raise(tmp_path):
+    path = str(tmp_path / 'kv.db')
+    kv = furnace_kv.KVStore(path, max_dirty=2)
+    db = kv.db
+    kv.db = FailingDB(db)
+    kv.set('a', '1')
+    kv.set('b', '2')  # reaches max_dirty, the flush fails quietly
+    assert kv.dirty == {'a': '1', 'b': '2'}
+    assert kv.get('a') == '1'
+    kv.db = db
+    kv.set('c', '3')
+    assert rows(path) == {'a': '1', 'b': '2', 'c': '3'}
+    kv.close()
@@ -0,0 +1,218 @@
+#-------------------------
+# Furnace (c) 2017-2018 Micah Bushouse
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#-------------------------
+"""
+Tests for furnace_stream: credit, in-order reassembly of out-of-order chunks, and FileSink resume.
+"""
+
+import os
+import types
+
+import pytest
+
+from constants import *
+import furnace_stream
+
+WINDOW = 100
+
+
+class MemorySink(object):
+    """
+    Collects what the StreamManager writes.
+    """
+
+    def __init__(self, offset=0):
+        self.offset = offset
+        self.buf = bytearray(offset)
+        self.writes = []
+        self.closed = None
+
+    def write(self, offset, data):
+        assert offset == len(self.buf), 'written out of order'
+        self.writes.append((offset, bytes(data)))
+        self.buf += data
+
+    def close(self, complete):
+        self.closed = complete
+
+
+class Harness(object):
+    """
+    A StreamManager whose tenant callback returns one sink, with its control messages recorded.
+    """
+
+    def __init__(self, sink=None):
+        self.sink = sink if sink is not None else MemorySink()
+        self.sent = []  # (ident, stream, op, offset, credit, value)
+        self.opened = []
+        self.mgr = furnace_stream.StreamManager(self.open, lambda *a: self.sent.append(a), lambda *a: None,
+                                                window=WINDOW)
+
+    def open(self, ctx):
+        self.opened.append(ctx)
+        return self.sink
+
+    def op(self, op, stream=1, offset=0, data=b'', value='', codec=0):
+        self.mgr.handle('vm1', types.SimpleNamespace(op=op, stream=stream, offset=offset, data=data, value=value,
+                                                     codec=codec))
+
+    def data(self, offset, data, **kwargs):
+        self.op(STREAM_DATA, offset=offset, data=data, **kwargs)
+
+    def credits(self):
+        return [(s[3], s[4]) for s in self.sent if s[2] == STREAM_CREDIT]
+
+
+def payload(n):
+    return bytes(i % 251 for i in range(n))
+
+
+def test_open_grants_a_window():
+    h = Harness()
+    h.op(STREAM_OPEN, value='mem', offset=500)
+    assert h.opened[0] == furnace_stream.StreamCtx(ident='vm1', stream=1, name='mem', size=500)
+    assert h.credits() == [(0, WINDOW)]
+
+
+def test_open_resumes_from_sink_offset():
+    h = Harness(MemorySink(offset=40))
+    h.op(STREAM_OPEN)
+    assert h.credits() == [(40, WINDOW)]
+    h.data(0, payload(60))  # retransmitted from the start, the first 40 bytes are already there
+    assert h.sink.writes == [(40, payload(60)[40:])]
+
+
+def test_refused_stream_is_aborted():
+    h = Harness()
+    h.sink = None
+    h.op(STREAM_OPEN)
+    assert [s[2] for s in h.sent] == [STREAM_ABORT]
+    h.data(0, b'x')
+    assert h.sent[-1][2] == STREAM_ABORT and h.sent[-1][5] == 'unknown stream'
+
+
+def test_credit_granted_every_half_window():
+    h = Harness()
+    h.op(STREAM_OPEN)
+    h.data(0, payload(30))
+    assert h.credits() == [(0, WINDOW)]
+    h.data(30, payload(80)[30:])
+    assert h.credits() == [(0, WINDOW), (80, WINDOW)]
+
+
+def test_out_of_order_chunks_are_reassembled():
+    h = Harness()
+    h.op(STREAM_OPEN)
+    data = payload(90)
+    h.data(60, data[60:90])
+    h.data(30, data[30:60])
+    assert h.sink.buf == b''
+    h.data(0, data[0:30])
+    assert h.sink.buf == data
+    assert h.mgr.streams[('vm1', 1)].pending_bytes == 0
+
+
+def test_parked_chunk_starting_inside_acked_bytes_is_trimmed():
+    h = Harness()
+    h.op(STREAM_OPEN)
+    data = payload(90)
+    h.data(50, data[50:90])  # parked
+    h.data(0, data[0:60])  # reaches past the parked chunk's start
+    assert h.sink.buf == data
+
+
+def test_parked_chunk_fully_covered_is_discarded():
+    h = Harness()
+    h.op(STREAM_OPEN)
+    data = payload(90)
+    h.data(20, data[20:40])
+    h.data(0, data[0:50])
+    h.data(50, data[50:90])
+    assert h.sink.buf == data
+    assert not h.mgr.streams[('vm1', 1)].pending
+
+
+def test_longer_retransmit_at_same_offset_is_kept():
+    h = Harness()
+    h.op(STREAM_OPEN)
+    data = payload(60)
+    h.data(20, data[20:30])
+    h.data(20, data[20:60])
+    h.data(0, data[0:20])
+    assert h.sink.buf == data
+
+
+def test_duplicates_and_overruns_are_dropped():
+    h = Harness()
+    h.op(STREAM_OPEN)
+    h.data(0, payload(20))
+    h.data(0, payload(20))  # duplicate
+    h.data(90, payload(20))  # past the window
+    assert h.sink.buf == payload(20)
+    assert h.mgr.bytes_in == 20
+
+
+def test_close_finishes_once_every_byte_arrived():
+    h = Harness()
+    h.op(STREAM_OPEN)
+    data = payload(50)
+    h.data(25, data[25:])
+    h.op(STREAM_CLOSE, offset=50)
+    assert h.sink.closed is None
+    h.data(0, data[:25])
+    assert h.sink.closed is True
+    assert h.credits()[-1] == (50, 0)
+    assert ('vm1', 1) not in h.mgr.streams
+
+
+def test_compressed_chunk_aborts_the_stream():
+    h = Harness()
+    h.op(STREAM_OPEN)
+    h.data(0, b'compressed', codec=CODEC_ZLIB)
+    assert h.sink.buf == b''
+    assert h.sink.closed is False
+    assert h.sent[-1][2] == STREAM_ABORT
+    assert ('vm1', 1) not in h.mgr.streams
+
+
+def test_drop_closes_an_apps_streams():
+    h = Harness()
+    h.op(STREAM_OPEN)
+    h.mgr.drop('vm1')
+    assert h.sink.closed is False
+    assert not h.mgr.streams
+
+
+def test_file_sink_resumes_from_checkpoint(tmp_path):
+    path = str(tmp_path / 'image.bin')
+    sink = furnace_stream.FileSink(path, size=1000)
+    sink.write(0, payload(300))
+    sink.close(False)
+    assert os.path.getsize(path) == 1000  # preallocated, so the size says nothing
+
+    sink = furnace_stream.FileSink(path, resume=True)
+    assert sink.offset == 300
+    sink.write(300, payload(400)[300:])
+    sink.close(True)
+    with open(path, 'rb') as f:
+        assert f.read(400) == payload(400)
+
+
+def test_file_sink_without_checkpoint_starts_over(tmp_path):
+    path = str(tmp_path / 'image.bin')
+    with open(path, 'wb') as f:
+        f.write(b'x' * 100)
+    assert furnace_stream.FileSink(path, resume=True).offset == 0
@@ -0,0 +1,173 @@
+#-------------------------
+# Furnace (c) 2017-2018 Micah Bushouse
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#-------------------------
+"""
+Tests for the heap-ordered timer scheduler in furnace_backend.BE: fixed-rate and fixed-delay periods, oneshots and
+lazily dropped cleared timers.
+"""
+
+import time
+
+import pytest
+
+pytest.importorskip('facilities_pb2')
+
+from constants import *
+import furnace_backend
+
+
+class Clock(object):
+    """
+    Stands in for time.monotonic.
+    """
+
+    def __init__(self, now=1000.0):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(time, 'monotonic', clock)
+    return clock
+
+
+@pytest.fixture
+def bei(tmp_path):
+    bei = furnace_backend.BE({}, ipc_dir=str(tmp_path / 'ipc'))
+    yield bei
+    bei.shutdown()
+
+
+def timer(bei, calls, clock, **edata):
+    edata.update(event_type=TIMER, callback=lambda ctx: calls.append(clock.now))
+    return bei.event_register(edata)
+
+
+def test_fixed_rate_keeps_its_phase(bei, clock):
+    calls = []
+    timer(bei, calls, clock, time_value=1.0)
+    bei.run_timers()
+    clock.now = 1001.25
+    bei.run_timers()
+    clock.now = 1002.0
+    bei.run_timers()
+    assert calls == [1000.0, 1001.25, 1002.0]
+
+
+def test_fixed_rate_skips_missed_periods(bei, clock):
+    calls = []
+    tid = timer(bei, calls, clock, time_value=1.0)
+    bei.run_timers()
+    clock.now = 1003.5  # the loop stalled through two deadlines
+    bei.run_timers()
+    assert calls == [1000.0, 1003.5]  # called once, not three times
+    assert bei.timerlist[tid]['deadline'] == 1004.0
+
+
+def test_fixed_delay_counts_from_callback_return(bei, clock):
+    calls = []
+
+    def slow(ctx):
+        calls.append(clock.now)
+        clock.now += 0.5  # the callback takes half a second
+
+    tid = bei.event_register({'event_type': TIMER, 'time_value': 1.0, 'mode': TIMER_FIXED_DELAY, 'callback': slow})
+    bei.run_timers()
+    assert bei.timerlist[tid]['deadline'] == 1001.5
+    clock.now = 1001.25
+    bei.run_timers()
+    assert calls == [1000.0]
+
+
+def test_oneshot_fires_once(bei, clock):
+    calls = []
+    tid = timer(bei, calls, clock, time_value=2.0, oneshot=True)
+    clock.now = 1001.9
+    bei.run_timers()
+    assert calls == []
+    clock.now = 1002.0
+    bei.run_timers()
+    clock.now = 1010.0
+    bei.run_timers()
+    assert calls == [1002.0]
+    assert tid not in bei.timerlist
+    assert bei.timerheap == []
+
+
+def test_time_start_delays_first_call(bei, clock):
+    calls = []
+    timer(bei, calls, clock, time_value=1.0, time_start=5.0)
+    bei.run_timers()
+    assert calls == []
+    clock.now = 1005.0
+    bei.run_timers()
+    assert calls == [1005.0]
+
+
+def test_cleared_timer_dropped_lazily(bei, clock):
+    calls = []
+    tid = timer(bei, calls, clock, time_value=1.0, time_start=1.0)
+    bei.event_clear(tid)
+    assert tid in bei.timerlist  # still on the heap until its deadline
+    clock.now = 1001.0
+    bei.run_timers()
+    assert calls == []
+    assert tid not in bei.timerlist
+    assert bei.timerheap == []
+
+
+def test_timer_cleared_from_its_callback(bei, clock):
+    calls = []
+
+    def once(ctx):
+        calls.append(clock.now)
+        bei.event_clear(tid)
+
+    tid = bei.event_register({'event_type': TIMER, 'time_value': 1.0, 'callback': once})
+    bei.run_timers()
+    clock.now = 1005.0
+    bei.run_timers()
+    assert calls == [1000.0]
+    assert tid not in bei.timerlist
+
+
+def test_due_timers_run_in_deadline_order(bei, clock):
+    order = []
+    for name, start in (('c', 3.0), ('a', 1.0), ('b', 2.0)):
+        bei.event_register({'event_type': TIMER, 'time_value': 10.0, 'time_start': start,
+                            'callback': lambda ctx, name=name: order.append(name)})
+    clock.now = 1003.0
+    bei.run_timers()
+    assert order == ['a', 'b', 'c']
+
+
+def test_next_timeout(bei, clock):
+    assert bei.next_timeout() == TIMEOUT_BE
+    timer(bei, [], clock, time_value=1.0, time_start=0.1)
+    assert bei.next_timeout() == pytest.approx(100.0)
+    clock.now = 1000.2
+    assert bei.next_timeout() == 0
+
+
+def test_bad_timer_registrations(bei, clock):
+    with pytest.raises(Exception):
+        bei.event_register({'event_type': TIMER, 'time_value': 0.0, 'callback': print})
+    with pytest.raises(Exception):
+        bei.event_register({'event_type': TIMER, 'time_value': 1.0, 'mode': 99, 'callback': print})
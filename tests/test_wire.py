@@ -0,0 +1,128 @@
+#-------------------------
+# Furnace (c) 2017-2018 Micah Bushouse
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#-------------------------
+"""
+Tests for furnace_wire: every hand-encoded envelope must be byte-for-byte what SerializeToString() produces.
+"""
+
+import pytest
+
+facilities_pb2 = pytest.importorskip('facilities_pb2')
+
+from constants import *
+import furnace_wire
+
+F = facilities_pb2.FacMessage
+
+
+def be_msg_pb(status, value=None, data=None, codec=None, topic=None, stream=None):
+    """
+    :returns: The FacMessage furnace_wire.be_msg* should produce, serialized by protobuf.
+    """
+    msg = F()
+    if topic is not None:
+        msg.topic = topic
+    msg.type.append(F.BE_MSG)
+    sub = msg.be_msg.add()
+    sub.status = status
+    if value is not None:
+        sub.value = value
+    if data is not None:
+        sub.data = data
+    if stream is not None:
+        sub.stream, sub.op, sub.offset, sub.credit = stream
+    if codec is not None:
+        sub.codec = codec
+    return msg.SerializeToString()
+
+
+@pytest.mark.parametrize('n', [0, 1, 127, 128, 300, 16383, 16384, 2 ** 32, 2 ** 63])
+def test_varint(n):
+    sub = facilities_pb2.Be_msg()
+    sub.offset = n
+    assert sub.SerializeToString() == b'\x30' + furnace_wire.varint(n)
+
+
+@pytest.mark.parametrize('value,data,codec', [
+    ('hello', None, None),
+    ('', None, None),
+    ('héllo ☃', None, None),
+    (None, b'\x00\x01binary', None),
+    (None, b'', None),
+    (None, bytes(300), CODEC_ZLIB),
+    ('x' * 200, b'y' * 70000, None),
+])
+def test_be_msg(value, data, codec):
+    for status in (VMI_SUCCESS, VMI_FAILURE):
+        assert furnace_wire.be_msg(status, value, data, codec) == be_msg_pb(status, value, data, codec)
+
+
+def test_be_msg_topic():
+    # the topic leads so SUB sockets can filter on it, where SerializeToString() puts it last
+    raw = furnace_wire.be_msg_topic('vm1', VMI_SUCCESS, 'up')
+    msg = F()
+    msg.ParseFromString(raw)
+    assert msg.SerializeToString() == be_msg_pb(VMI_SUCCESS, 'up', topic='vm1')
+    assert raw.startswith(furnace_wire.topic_prefix('vm1'))
+    assert not raw.startswith(furnace_wire.topic_prefix('vm10'))
+    assert not furnace_wire.be_msg_topic('vm10', VMI_SUCCESS, 'up').startswith(furnace_wire.topic_prefix('vm1'))
+
+
+def test_be_msg_stream():
+    raw = furnace_wire.be_msg_stream(VMI_SUCCESS, 7, STREAM_CREDIT, 2 ** 40, 8388608, 'reason')
+    assert raw == be_msg_pb(VMI_SUCCESS, 'reason', stream=(7, STREAM_CREDIT, 2 ** 40, 8388608))
+
+
+def test_be_msg_ret():
+    rets = [(VMI_SUCCESS, 'a', None), (VMI_FAILURE, 'boom', None), (VMI_SUCCESS, None, b'\xff' * 200),
+            (VMI_SUCCESS, '', None)]
+    msg = F()
+    for status, value, data in rets:
+        msg.type.append(F.BE_MSG_RET)
+        sub = msg.be_msg_ret.add()
+        sub.status = status
+        if value is not None:
+            sub.value = value
+        if data is not None:
+            sub.data = data
+    assert furnace_wire.be_msg_ret(rets) == msg.SerializeToString()
+    assert furnace_wire.be_msg_ret([]) == F().SerializeToString()
+
+
+def test_kv_ret():
+    rets = [('GET_RET', 'k1', 'v1', VMI_SUCCESS), ('SET_RET', 'k2', None, VMI_SUCCESS),
+            ('GET_RET', 'missing', None, VMI_FAILURE), ('SET_RET', 'ké', None, VMI_FAILURE)]
+    msg = F()
+    for msgtype, key, value, result in rets:
+        if msgtype == 'GET_RET':
+            msg.type.append(F.GET_RET)
+            sub = msg.get_ret.add()
+            if value is not None:
+                sub.value = value
+        else:
+            msg.type.append(F.SET_RET)
+            sub = msg.set_ret.add()
+        sub.key = key
+        sub.result = result
+    assert furnace_wire.kv_ret(rets) == msg.SerializeToString()
+
+
+def test_codecs_prefix_concatenates_into_one_message():
+    raw = furnace_wire.codecs([CODEC_ZLIB]) + furnace_wire.be_msg_ret([(VMI_SUCCESS, 'ok', None)])
+    msg = F()
+    msg.ParseFromString(raw)
+    assert list(msg.codecs) == [CODEC_ZLIB]
+    assert [r.value for r in msg.be_msg_ret] == ['ok']